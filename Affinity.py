@@ -0,0 +1,345 @@
+############## Mycelium Version 0.18.21 of 2024.04.17 ##############
+# Dialog affinity for replicas of stateful agents and interfaces. Dialog state lives in Mycelium.dialogs of one process, so
+# every message of a dialog must reach the replica which holds it. The dialogs are split into a fixed number of partitions
+# by the hash of their dialog_id (or endUserCommunicationID), every partition has its own queue, and the partitions are spread
+# over the replicas by consistent hashing. Every replica consumes the shared input queue and only forwards each message to the queue
+# of its partition, without decoding it. When replicas join or leave, only the partitions which change the owner move, and
+# their dialogs are handed over to the new owner before it starts consuming.
+#
+#   affinity = DialogAffinity(replicaId="agent-0", replicas=["agent-0", "agent-1", "agent-2"])
+#   myceliumRouter = Mycelium(..., input_chanel=agentRMQQueueName, message_received_callback=server_logic, affinity=affinity)
+#   ...
+#   affinity.set_replicas(["agent-0", "agent-1", "agent-2", "agent-3"]) #On every replica, when the deployment is scaled
+
+import aio_pika
+import asyncio
+import bisect
+from Codecs import CODEC_HEADER
+import hashlib
+import json
+from Mycelium import Dialog, DialogVersionHistory
+import threading
+import uuid
+
+AFFINITY_KEYS = ("dialog_id", "endUserCommunicationID")
+HANDOFF_HEADER = 'affinityHandoff' #"dialog" for the state of one dialog, "versions" for the latest delta base of a dialog,
+                                    #"done" when the previous owner handed all of them over
+HANDOFF_RING_HEADER = 'affinityRing' #Id of the ring the handover was made for, older "done" markers are ignored
+
+def stable_hash(value):
+    """A hash which is the same in every process, unlike hash() of a str."""
+    return int.from_bytes(hashlib.sha1(str(value).encode()).digest()[:8], 'big')
+
+class HashRing:
+    """
+    Consistent hashing: every node is placed on the ring virtualNodes times, a key belongs to the next node clockwise.
+    Adding or removing a node only moves the keys of that node.
+    """
+    def __init__(self, nodes = (), virtualNodes = 100):
+        self.virtualNodes = virtualNodes
+        self._hashes = []
+        self._nodes = []
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        for replica in range(self.virtualNodes):
+            point = stable_hash(f"{node}#{replica}")
+            index = bisect.bisect(self._hashes, point)
+            self._hashes.insert(index, point)
+            self._nodes.insert(index, node)
+
+    def remove(self, node):
+        kept = [(point, owner) for point, owner in zip(self._hashes, self._nodes) if owner != node]
+        self._hashes = [point for point, owner in kept]
+        self._nodes = [owner for point, owner in kept]
+
+    @property
+    def nodes(self):
+        return sorted(set(self._nodes))
+
+    def node_for(self, key):
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, stable_hash(key))
+        return self._nodes[index % len(self._nodes)]
+
+class DialogAffinity:
+    """
+    Which replica owns which dialogs. Pass it to Mycelium(affinity=...), start_server() then consumes the partitions of this replica.
+    :param replicaId: The name of this replica, unique and stable across restarts (e.g. the pod name of a StatefulSet).
+    :param replicas: The names of all the replicas, this one included. The same list on every replica.
+    :param partitions: Number of partition queues. All the replicas must use the same number, never change it on a running deployment.
+    :param key: "dialog_id" or "endUserCommunicationID", to keep all the dialogs of one end user on one replica.
+    :param previousReplicas: The replicas before this one joined a running deployment. The replica then waits for the state of the
+                             dialogs moved to it, the other replicas hand it over when they get set_replicas() with the new list.
+    :param handoffTimeout: Seconds to wait for the handover of a partition. The previous owner may be gone, its dialogs are lost then.
+    """
+    def __init__(self, replicaId, replicas, partitions = 64, key = "dialog_id", previousReplicas = None, virtualNodes = 100, handoffTimeout = 5):
+        if key not in AFFINITY_KEYS:
+            raise ValueError(f"key must be one of {AFFINITY_KEYS}")
+        if replicaId not in replicas:
+            raise ValueError("replicas must include replicaId")
+        self.replicaId = replicaId
+        self.partitions = partitions
+        self.key = key
+        self.virtualNodes = virtualNodes
+        self.handoffTimeout = handoffTimeout
+        self._lock = threading.Lock()
+        self._ring = HashRing(replicas, virtualNodes)
+        self._previousRing = HashRing(previousReplicas, virtualNodes) if previousReplicas is not None else None
+        self._listeners = [] #Called with the previous ring on every change, see _AffinityServer
+        self.rebalances = 0
+        self.forwarded = 0
+        self.handedOver = 0
+        self.takenOver = 0
+
+    @property
+    def replicas(self):
+        return self._ring.nodes
+
+    def ring_id(self, ring = None):
+        ring = ring if ring is not None else self._ring
+        return hashlib.sha1(",".join(ring.nodes).encode()).hexdigest()[:16]
+
+    def set_replicas(self, replicas):
+        """
+        Rebalances after replicas joined or left. Call it on every replica with the same list, from any thread.
+        The partitions this replica lost are handed over to their new owners, the ones it got are consumed after their handover.
+        A replica leaving gracefully gets the list without itself and hands all its dialogs over.
+        """
+        with self._lock:
+            previous = self._ring
+            self._ring = HashRing(replicas, self.virtualNodes)
+            self.rebalances += 1
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener(previous)
+
+    def partition_of(self, key):
+        return stable_hash(key) % self.partitions
+
+    def owner_of(self, partition, ring = None):
+        return (ring if ring is not None else self._ring).node_for(f"partition-{partition}")
+
+    def owned_partitions(self, ring = None):
+        return {partition for partition in range(self.partitions) if self.owner_of(partition, ring) == self.replicaId}
+
+    def key_of_message(self, message):
+        """The affinity key of an incoming message, read from its properties and headers without decoding the body."""
+        if self.key == "endUserCommunicationID" and message.headers.get('endUserCommunicationID'):
+            return message.headers['endUserCommunicationID']
+        return message.correlation_id
+
+    def key_of_dialog(self, dialog):
+        if self.key == "endUserCommunicationID" and dialog.endUserCommunicationID:
+            return dialog.endUserCommunicationID
+        return str(dialog.dialog_id)
+
+    def new_dialog_id(self):
+        """
+        A dialog_id in a partition of this replica. A replica starting dialogs itself (e.g. an interface) gives them such ids,
+        so the replies come back to the replica which holds the dialog.
+        """
+        owned = self.owned_partitions()
+        if not owned:
+            raise ValueError(f"Replica {self.replicaId} owns no partitions")
+        while True:
+            dialog_id = str(uuid.uuid4())
+            if self.partition_of(dialog_id) in owned:
+                return dialog_id
+
+    @staticmethod
+    def partition_queue(inputQueue, partition):
+        return f"{inputQueue}.affinity.{partition}"
+
+    @staticmethod
+    def handoff_queue(inputQueue, partition):
+        return f"{inputQueue}.affinity.{partition}.handoff"
+
+    def stats(self):
+        return {'replicaId': self.replicaId, 'replicas': self.replicas, 'ownedPartitions': len(self.owned_partitions()), 'rebalances': self.rebalances,
+                'forwarded': self.forwarded, 'handedOver': self.handedOver, 'takenOver': self.takenOver}
+
+    async def serve(self, mycelium, allowNewDialogs, concurrentDispatch):
+        """Called by Mycelium.start_server() instead of consuming the input queue directly."""
+        await _AffinityServer(self, mycelium, allowNewDialogs, concurrentDispatch).run()
+
+class _AffinityServer:
+    """The consumers of one start_server(): the input queue forwarder and one consumer per owned partition."""
+    def __init__(self, affinity, mycelium, allowNewDialogs, concurrentDispatch):
+        self.affinity = affinity
+        self.mycelium = mycelium
+        self.allowNewDialogs = allowNewDialogs
+        self.concurrentDispatch = concurrentDispatch
+        self.consumers = {} #partition -> task consuming its queue
+        self.releasing = set() #Partitions being handed over, their consumers stop at the next message
+        self.receiving = {} #partition -> messages received and not dispatched yet
+        self.dispatched = {} #partition -> set of the tasks processing its messages
+        self.rebalanceLock = asyncio.Lock()
+
+    async def run(self):
+        mycelium = self.mycelium
+        loop = asyncio.get_running_loop()
+        # Without concurrentDispatch the dialogs are still processed one at a time, as start_server() does
+        mycelium._dispatchSlots = asyncio.Semaphore(max(1, mycelium.serverAsyncModeThreads) if self.concurrentDispatch else 1)
+        mycelium._dialogTails = {}
+        listener = lambda previous: loop.call_soon_threadsafe(lambda: asyncio.ensure_future(self.rebalance(previous)))
+        with self.affinity._lock:
+            self.affinity._listeners.append(listener)
+        try:
+            # A message for a partition queue which doesn't exist yet would be dropped by RabbitMQ
+            for partition in range(self.affinity.partitions):
+                await self.declare_partition(partition)
+            await self.rebalance(self.affinity._previousRing)
+            await self.forward_incoming()
+            for partition in list(self.consumers):
+                await self.stop_consumer(partition)
+        finally:
+            with self.affinity._lock:
+                self.affinity._listeners.remove(listener)
+            for task in self.consumers.values():
+                task.cancel()
+
+    async def declare_partition(self, partition):
+        # Single active consumer: while replicas disagree on the ring during a rebalance, still only one of them gets the messages
+        return await self.mycelium.chanel.declare_queue(self.affinity.partition_queue(self.mycelium.input_chanel, partition),
+                                                        arguments={'x-single-active-consumer': True})
+
+    async def forward_incoming(self):
+        mycelium, affinity = self.mycelium, self.affinity
+        queue = await mycelium.chanel.declare_queue(mycelium.input_chanel)
+        async with queue.iterator() as queue_iter:
+            async for message in queue_iter:
+                if mycelium._serverStopping:
+                    await message.nack(requeue=True)
+                    break
+                partition = affinity.partition_of(affinity.key_of_message(message))
+                forwarded = aio_pika.Message(body=message.body, headers=dict(message.headers), correlation_id=message.correlation_id, reply_to=message.reply_to)
+                await mycelium.chanel.default_exchange.publish(forwarded, routing_key=affinity.partition_queue(mycelium.input_chanel, partition))
+                await message.ack() #After the publishing, a forwarder which dies in between leaves the message in the input queue
+                affinity.forwarded += 1
+
+    async def rebalance(self, previousRing):
+        async with self.rebalanceLock:
+            owned = self.affinity.owned_partitions()
+            for partition in [partition for partition in self.consumers if partition not in owned]:
+                await self.stop_consumer(partition)
+                await self.hand_over(partition)
+            for partition in sorted(owned - set(self.consumers)):
+                previousOwner = self.affinity.owner_of(partition, previousRing) if previousRing is not None else None
+                waitHandoff = previousOwner is not None and previousOwner != self.affinity.replicaId
+                self.consumers[partition] = asyncio.ensure_future(self.consume_partition(partition, waitHandoff))
+
+    async def consume_partition(self, partition, waitHandoff):
+        mycelium = self.mycelium
+        try:
+            if waitHandoff:
+                await self.take_over(partition)
+            queue = await self.declare_partition(partition)
+            self.receiving[partition] = 0
+            self.dispatched.setdefault(partition, set())
+            async with queue.iterator() as queue_iter:
+                async for message in queue_iter:
+                    if partition in self.releasing or mycelium._serverStopping:
+                        await message.nack(requeue=True) #Left for the next owner
+                        break
+                    self.receiving[partition] += 1
+                    mycelium._messagesInProgress += 1
+                    try:
+                        await message.ack()
+                        await mycelium._dispatchSlots.acquire()
+                    except BaseException:
+                        mycelium._messagesInProgress -= 1
+                        raise
+                    finally:
+                        self.receiving[partition] -= 1
+                    task = mycelium._dispatch_in_dialog_order(message, self.allowNewDialogs)
+                    self.dispatched[partition].add(task)
+                    task.add_done_callback(self.dispatched[partition].discard)
+        except asyncio.CancelledError:
+            raise
+        except Exception as ex:
+            print(f"Failed to consume partition {partition} of {mycelium.input_chanel}. Error: {ex}")
+
+    async def stop_consumer(self, partition):
+        """Lets the consumer of the partition finish the dialogs it received, then stops it."""
+        self.releasing.add(partition)
+        try:
+            task = self.consumers.pop(partition)
+            while not task.done() and self.receiving.get(partition):
+                await asyncio.wait([task], timeout=0.05)
+            if not task.done():
+                task.cancel() #Idle, waiting for the next message
+            await asyncio.wait([task])
+            if self.dispatched.get(partition):
+                await asyncio.wait(list(self.dispatched[partition]))
+        finally:
+            self.releasing.discard(partition)
+
+    async def hand_over(self, partition):
+        """Sends the state of the dialogs of a lost partition to its new owner, then the marker telling the handover is complete."""
+        mycelium, affinity = self.mycelium, self.affinity
+        queueName = affinity.handoff_queue(mycelium.input_chanel, partition)
+        await mycelium.chanel.declare_queue(queueName)
+        # The delta history of a dialog outlives it (a callback returning False drops the dialog), so both are looked through
+        for dialog_id in list(dict.fromkeys(list(mycelium.dialogs) + list(mycelium.deltaCache))):
+            dialog = mycelium.dialogs.get(dialog_id)
+            history = mycelium.deltaCache.get(dialog_id)
+            if dialog is None and history is None:
+                continue
+            keyDialog = dialog if dialog is not None else Dialog(dialog_id=dialog_id, endUserCommunicationID=history.endUserCommunicationID)
+            if affinity.partition_of(affinity.key_of_dialog(keyDialog)) != partition:
+                continue
+            if dialog is not None:
+                headers = {HANDOFF_HEADER: "dialog", CODEC_HEADER: mycelium.codec, 'wireCodec': dialog.wireCodec or "",
+                           'billingData': json.dumps(mycelium.lastReceivedMessageBillingData.get(dialog_id, []))}
+                body = await mycelium.encode_dialog(dialog)
+                await mycelium.chanel.default_exchange.publish(aio_pika.Message(body=body, correlation_id=str(dialog_id), headers=headers), routing_key=queueName)
+                mycelium.dialogs.pop(dialog_id, None)
+                mycelium.lastReceivedMessageBillingData.pop(dialog_id, None)
+                affinity.handedOver += 1
+            if history is not None and history.versions:
+                # The sender bases its next delta on the version acknowledged by the last reply, which is the latest one
+                version = history.latest_version()
+                versionDialog = Dialog(dialog_id=dialog_id, messages=list(history.versions[version]), endUserCommunicationID=history.endUserCommunicationID)
+                headers = {HANDOFF_HEADER: "versions", CODEC_HEADER: mycelium.codec, 'dialogVersion': version}
+                body = await mycelium.encode_dialog(versionDialog)
+                await mycelium.chanel.default_exchange.publish(aio_pika.Message(body=body, correlation_id=str(dialog_id), headers=headers), routing_key=queueName)
+            mycelium.deltaCache.pop(dialog_id, None)
+        marker = aio_pika.Message(body=b"", headers={HANDOFF_HEADER: "done", HANDOFF_RING_HEADER: affinity.ring_id()})
+        await mycelium.chanel.default_exchange.publish(marker, routing_key=queueName)
+
+    async def take_over(self, partition):
+        """Receives the dialogs of a partition from its previous owner until its marker comes or handoffTimeout passes."""
+        mycelium, affinity = self.mycelium, self.affinity
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + affinity.handoffTimeout
+        ringId = affinity.ring_id()
+        queue = await mycelium.chanel.declare_queue(affinity.handoff_queue(mycelium.input_chanel, partition))
+        async with queue.iterator() as queue_iter:
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue_iter.__anext__(), max(0, deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    print(f"No handover of partition {partition} of {mycelium.input_chanel} in {affinity.handoffTimeout} s, its previous owner may be gone")
+                    return
+                await message.ack()
+                if message.headers.get(HANDOFF_HEADER) == "done":
+                    if message.headers.get(HANDOFF_RING_HEADER) == ringId:
+                        return
+                    continue #Left by an older rebalance
+                dialog = Dialog(dialog_id=message.correlation_id)
+                await mycelium.decode_dialog(dialog, message.body, message.headers.get(CODEC_HEADER))
+                if message.headers.get(HANDOFF_HEADER) == "versions":
+                    if dialog.dialog_id not in mycelium.deltaCache:
+                        history = DialogVersionHistory()
+                        history.add(message.headers['dialogVersion'], dialog.messages)
+                        history.endUserCommunicationID = dialog.endUserCommunicationID
+                        mycelium.deltaCache[dialog.dialog_id] = history
+                    continue
+                if dialog.dialog_id not in mycelium.dialogs: #Never replaces a dialog this replica holds
+                    dialog.wireCodec = message.headers.get('wireCodec') or None
+                    mycelium.dialogs[dialog.dialog_id] = dialog
+                    mycelium.lastReceivedMessageBillingData[dialog.dialog_id] = json.loads(message.headers.get('billingData', "[]"))
+                affinity.takenOver += 1
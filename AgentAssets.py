@@ -0,0 +1,75 @@
+############## Mycelium Version 0.18.21 of 2024.04.17 ##############
+# Static media of an agent (a logo, a canned audio answer, a document template) loaded once at startup. Every asset is a
+# UnifiedPrompt kept with its wire form, and all the replies share it, so constant or partly constant replies are
+# assembled without reading files, opening images or base64-encoding them for every request.
+
+import io
+import mimetypes
+import os
+from Mycelium import BINARY_PROMPT_TYPES, Message, UnifiedPrompt
+from PIL import Image
+
+class AgentAssets:
+    """
+    A dict-like collection of shared prompts: assets["groot.png"] is the same UnifiedPrompt object in every reply.
+    Treat the assets as read-only, a message needing a changed one must get a new UnifiedPrompt.
+    :param baseDir: The directory relative file names are loaded from.
+    """
+    def __init__(self, baseDir = None):
+        self.baseDir = baseDir
+        self._prompts = {}
+
+    def load(self, path, name = None, content_type = None, mime_type = None):
+        """
+        Reads a file once and adds it as an asset named by its file name (or name). The content_type and mime_type are guessed
+        from the extension when not given: images, audio and text files by their kind, anything else is a document.
+        """
+        fullPath = os.path.join(self.baseDir, path) if self.baseDir is not None else path
+        with open(fullPath, 'rb') as file:
+            data = file.read()
+        guessedMimeType = mimetypes.guess_type(fullPath)[0] or "application/octet-stream"
+        mime_type = mime_type if mime_type is not None else guessedMimeType
+        if content_type is None:
+            kind = guessedMimeType.split('/')[0]
+            content_type = kind if kind in ('image', 'audio', 'text') else 'document'
+        if content_type == 'image':
+            prompt = UnifiedPrompt(content_type, Image.open(io.BytesIO(data)), mime_type, original_bytes=data)
+        elif content_type in BINARY_PROMPT_TYPES:
+            prompt = UnifiedPrompt(content_type, data, mime_type)
+        else:
+            prompt = UnifiedPrompt(content_type, data.decode(), mime_type)
+        return self.add(name if name is not None else os.path.basename(path), prompt)
+
+    def add(self, name, prompt):
+        """Adds a prompt created elsewhere (e.g. a generated image). Binary prompts are encoded for the wire now, once."""
+        Message(role="assistant", unified_prompts=[prompt]) #Raises InvalidPromptException for a wrong content or mime type
+        self._prompts[name] = prompt.preencode()
+        return prompt
+
+    def __getitem__(self, name):
+        return self._prompts[name]
+
+    def __contains__(self, name):
+        return name in self._prompts
+
+    def __iter__(self):
+        return iter(self._prompts)
+
+    def __len__(self):
+        return len(self._prompts)
+
+    def message(self, *parts, role = "assistant", **messageArguments):
+        """
+        Assembles a reply message. Every part is a UnifiedPrompt (an asset is taken as assets["logo.png"]) or a str which always
+        becomes a text prompt, so a user's text equal to an asset name stays text, e.g.
+        assets.message(f"Hello {name}!", assets["logo.png"], sender_info="Greeter"). Other keyword arguments go to Message().
+        """
+        prompts = []
+        for part in parts:
+            if isinstance(part, UnifiedPrompt):
+                prompts.append(part)
+            elif isinstance(part, str):
+                prompts.append(UnifiedPrompt("text", part, "text/plain"))
+            else:
+                raise TypeError("Message parts must be strings or UnifiedPrompt objects, e.g. assets[\"logo.png\"]")
+        return Message(role=role, unified_prompts=prompts, **messageArguments)
@@ -0,0 +1,102 @@
+############## Mycelium Version 0.18.21 of 2024.04.17 ##############
+# Content-addressed storage for big binary prompts. When a Mycelium has a blobStore, images, audio and documents above
+# the store threshold are put into the store and the AMQP message carries only their keys. The receiver fetches
+# the content on first access, so media forwarded through a chain of agents is neither encoded nor shipped again.
+# All the peers of a chain must use the same store (e.g. a shared volume) or stores with the same content.
+
+import hashlib
+import os
+import tempfile
+
+class BlobNotFoundException(Exception):
+    """Exception raised when a blob referenced by a dialog is missing in the store."""
+    def __init__(self, message="The blob is not found in the blob store"):
+        self.message = message
+        super().__init__(self.message)
+
+class BlobStore:
+    """
+    The interface of a blob store. Keys are derived from the content, so putting the same bytes twice stores them once.
+    :param threshold: Binary prompts smaller than this number of bytes stay inline in the message.
+    """
+    def __init__(self, threshold = 64 * 1024):
+        self.threshold = threshold
+
+    @staticmethod
+    def key_for(data):
+        return "sha256:" + hashlib.sha256(data).hexdigest()
+
+    def put(self, data):
+        """Stores the bytes and returns their key."""
+        raise NotImplementedError
+
+    def get(self, key):
+        """Returns the bytes stored under the key or raises BlobNotFoundException."""
+        raise NotImplementedError
+
+    def contains(self, key):
+        raise NotImplementedError
+
+class FileSystemBlobStore(BlobStore):
+    """Keeps blobs as files in a local (or mounted) directory, one file per key."""
+    def __init__(self, rootDir, threshold = 64 * 1024):
+        super().__init__(threshold)
+        self.rootDir = rootDir
+        os.makedirs(self.rootDir, exist_ok=True)
+
+    def _path(self, key):
+        algorithm, digest = key.split(":", 1)
+        if algorithm != "sha256" or len(digest) != 64 or not all(c in "0123456789abcdef" for c in digest):
+            raise BlobNotFoundException(f"Invalid blob key {key}")
+        return os.path.join(self.rootDir, digest[:2], digest)
+
+    def put(self, data):
+        key = self.key_for(data)
+        path = self._path(key)
+        if os.path.exists(path):
+            return key
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written under a temporary name and renamed, so a concurrent reader never sees a partial blob
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return key
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as file:
+                return file.read()
+        except FileNotFoundError:
+            raise BlobNotFoundException(f"Blob {key} is not found in {self.rootDir}")
+
+    def contains(self, key):
+        return os.path.exists(self._path(key))
+
+class CachingBlobStore(BlobStore):
+    """Puts blobs to a remote store and keeps a local copy of everything put or fetched, so each blob is downloaded once."""
+    def __init__(self, remote, local):
+        super().__init__(remote.threshold)
+        self.remote = remote
+        self.local = local
+
+    def put(self, data):
+        key = self.local.put(data)
+        if not self.remote.contains(key):
+            self.remote.put(data)
+        return key
+
+    def get(self, key):
+        if self.local.contains(key):
+            return self.local.get(key)
+        data = self.remote.get(key)
+        self.local.put(data)
+        return data
+
+    def contains(self, key):
+        return self.local.contains(key) or self.remote.contains(key)
@@ -0,0 +1,113 @@
+############## Mycelium Version 0.18.21 of 2024.04.17 ##############
+# Wire codecs of the dialogs. The codec of a message body is named in its myceliumCodec header, a message without
+# the header is zlib-compressed JSON, so peers that don't know about codecs keep working. JSON codecs send binary prompts
+# as base64 strings, binary codecs carry them as raw bytes and save the base64 third of the body.
+
+import json
+import zlib
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+CODEC_HEADER = "myceliumCodec"
+LEGACY_CODEC = "json+zlib"
+
+class UnknownCodecException(Exception):
+    """Exception raised when a message is encoded with a codec which is unknown or not installed here."""
+    def __init__(self, message="The message codec is not supported"):
+        self.message = message
+        super().__init__(self.message)
+
+class Codec:
+    """
+    Turns the dict built by Dialog.to_dict() into a message body and back.
+    :param compressionLevel: zlib level of the body, 0 sends it uncompressed (still wrapped into zlib format).
+    """
+    name = None
+    binary = False #True when the format carries bytes natively, so binary prompts are not base64-encoded.
+
+    def __init__(self, compressionLevel = 6):
+        self.compressionLevel = compressionLevel
+
+    def dumps(self, data):
+        raise NotImplementedError
+
+    def loads(self, raw):
+        raise NotImplementedError
+
+    def encode(self, data):
+        return zlib.compress(self.dumps(data), self.compressionLevel)
+
+    def decode(self, body):
+        return self.loads(zlib.decompress(body))
+
+class JsonCodec(Codec):
+    """The original format. Uses orjson when it's installed, the output is the same JSON, so old peers read it as usual."""
+    name = LEGACY_CODEC
+
+    def dumps(self, data):
+        if orjson is not None:
+            try:
+                return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+            except TypeError:
+                pass #e.g. an integer beyond 64 bits in agentConfig, the standard module handles it
+        return json.dumps(data, ensure_ascii=False).encode()
+
+    def loads(self, raw):
+        if orjson is not None:
+            try:
+                return orjson.loads(raw)
+            except orjson.JSONDecodeError:
+                pass
+        return json.loads(raw.decode())
+
+class MsgpackCodec(Codec):
+    name = "msgpack+zlib"
+    binary = True
+
+    def dumps(self, data):
+        return msgpack.packb(data, use_bin_type=True)
+
+    def loads(self, raw):
+        return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+
+class CborCodec(Codec):
+    name = "cbor+zlib"
+    binary = True
+
+    def dumps(self, data):
+        return cbor2.dumps(data)
+
+    def loads(self, raw):
+        return cbor2.loads(raw)
+
+CODECS = {LEGACY_CODEC: JsonCodec()}
+if msgpack is not None:
+    CODECS[MsgpackCodec.name] = MsgpackCodec()
+if cbor2 is not None:
+    CODECS[CborCodec.name] = CborCodec()
+
+def register_codec(codec):
+    """Adds a custom Codec instance. Both peers must register it under the same name."""
+    CODECS[codec.name] = codec
+
+def get_codec(name = None):
+    """Returns the codec by its name, the legacy JSON codec for None (a message without the codec header)."""
+    if name is None:
+        name = LEGACY_CODEC
+    codec = CODECS.get(name)
+    if codec is None:
+        raise UnknownCodecException(f"The codec {name} is not supported. Available codecs: {list(CODECS.keys())}. Install msgpack or cbor2 for the binary ones.")
+    return codec
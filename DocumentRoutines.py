@@ -63,7 +63,7 @@ class DocxToPromptsConverter:
             image_part = run.part.related_parts[image_rid]
             image_bytes = io.BytesIO(image_part.blob)
             image = Image.open(image_bytes)
-            return UnifiedPrompt("image", image, "image/jpeg")
+            return UnifiedPrompt("image", image, Image.MIME.get(image.format, "image/jpeg"), original_bytes=image_part.blob)
         return None
 
     def convert(self, docx_file):
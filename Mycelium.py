@@ -1,16 +1,24 @@
 ############## Mycelium Version 0.18.21 of 2024.04.17 ##############
 
 import aio_pika
+import asyncio
 import base64
+from Codecs import CODEC_HEADER, LEGACY_CODEC, get_codec
+from collections import OrderedDict
+from collections.abc import MutableMapping
 import copy
 from datetime import datetime
+import functools
+import hashlib
 import io
 import json
 import pika
 from PIL import Image
 import re
-import sys
+import string
 import threading
+import time
+from Transports import DIRECT_REPLY_TO_QUEUE, AmqpTransport
 import uuid
 import warnings
 import zlib
@@ -41,15 +49,224 @@ class DialogHasNoMessages(Exception):
         self.message = message
         super().__init__(self.message)
         
+BINARY_PROMPT_TYPES = ('image', 'document', 'audio') #Prompt types transferred as base64 or as blob references
+STREAM_PROMPT_TYPES = ('stream_of_bytes', 'stream_audio', 'stream_video')
+STREAM_CHUNK_GRACE_SECONDS = 5 #How long StreamAsync waits for the chunks overtaken by the final reply
+STREAM_CHUNK_DEFAULT_MIME_TYPES = {'text': 'text/plain', 'stream_of_bytes': 'application/octet-stream', 'stream_audio': 'audio/mpeg', 'stream_video': 'video/mp4'}
+
+# Message validation table: content_type -> (allowed content types, content error, allowed MIME prefixes, MIME error).
+# Errors are formatted with the index of the prompt. Prompt types with no MIME prefixes accept any MIME type.
+PROMPT_VALIDATION_RULES = {
+    'text': ((str,), "Error in text prompt at index {i}: Content must be a string.",
+             ('text/',), "Error in text prompt at index {i}: MIME type should start with 'text/'."),
+    'url': ((str,), "Error in URL prompt at index {i}: Content must be a string.",
+            ('text/', 'application/', 'image/', 'video/', 'audio/'), "Error in URL prompt at index {i}: MIME type start witj 'text/' or 'image/' or 'video/' or 'audio/' or 'application/'."),
+    'image': ((Image.Image,), "Error in image prompt at index {i}: Content must be a PIL Image object.",
+              ('image/',), "Error in image prompt at index {i}: MIME type should start with 'image/'."),
+    'document': ((bytes,), "Error in document prompt at index {i}: Content must be bytes.",
+                 ('application/',), "Error in document prompt at index {i}: MIME type should start with 'application/'."),
+    'audio': ((bytes,), "Error in audio prompt at index {i}: Content must be bytes.",
+              ('audio/',), "Error in audio prompt at index {i}: MIME type should start with 'audio/'."),
+    'video': ((bytes,), "Error in video prompt at index {i}: Content must be bytes.",
+              ('video/',), "Error in video prompt at index {i}: MIME type should start with 'video/'."),
+    'stream_of_bytes': ((bytes,), "Error in stream_of_bytes prompt at index {i}: Content must be bytes.", None, None),
+    'stream_audio': ((bytes,), "Error in stream_audio prompt at index {i}: Content must be bytes.",
+                     ('audio/',), "Error in stream_audio prompt at index {i}: MIME type should start with 'audio/'."),
+    'stream_video': ((bytes,), "Error in stream_video prompt at index {i}: Content must be bytes.",
+                     ('video/',), "Error in stream_video prompt at index {i}: MIME type should start with 'video/'."),
+}
+SUPPORTED_PROMPT_TYPES = set(PROMPT_VALIDATION_RULES)
+ROUTING_STRATEGY_CACHE_SIZE = 4096 #Interned RoutingStrategy instances, direct strategies are keyed by queue names which may be many
+
+def _pixels_digest(image, load = False):
+    """Digest of the pixel data, None when the pixels of a lazily opened image are not loaded yet (they can't have been changed)."""
+    if not load and (image._im if hasattr(image, '_im') else image.im) is None:
+        return None
+    return hashlib.blake2b(image.tobytes(), digest_size=16).digest()
+
 #Unified Prompt class
 class UnifiedPrompt:
-    def __init__(self, content_type, content, mime_type=None):
+    # Slots keep prompts small, processors create millions of them and dialog stores hold them for hours
+    __slots__ = ('content_type', 'mime_type', 'blob_ref', '_content', '_version', '_loaded', '_loader', '_encoded', '_raw', '_rawSignature')
+
+    def __init__(self, content_type, content, mime_type=None, original_bytes=None):
+        """
+        :param original_bytes: The file the image was opened from (e.g. a JPEG photo). It is sent instead of re-encoding the PIL object to PNG
+                               as long as the pixels are the same, an image changed in place (ImageDraw, paste, putpixel) is re-encoded.
+                               Call touch() after such a change of an image which was already sent.
+        """
         self.content_type = content_type
+        self._version = 0 #Incremented on every content change, invalidates the serialized form cached by the message
         self.content = content
         self.mime_type = mime_type
+        if original_bytes is not None:
+            self._raw = bytes(original_bytes)
+            self._rawSignature = self._image_signature()
+
+    @classmethod
+    def lazy(cls, content_type, loader, mime_type=None, blob_ref=None):
+        """Creates a binary prompt which calls loader() to get its encoded bytes (the file bytes of an image) on first access."""
+        prompt = cls(content_type, None, mime_type)
+        prompt._loaded = False
+        prompt._loader = loader
+        prompt.blob_ref = blob_ref
+        return prompt
+
+    @classmethod
+    def from_encoded(cls, content_type, encoded, mime_type=None):
+        """
+        Creates a binary prompt from its base64 string or raw bytes as they came over the wire. Nothing is decoded until
+        the content is accessed, and a prompt which is only forwarded is serialized again from the same string.
+        """
+        prompt = cls(content_type, None, mime_type)
+        prompt._loaded = False
+        if isinstance(encoded, str):
+            prompt._encoded = encoded
+        else:
+            prompt._raw = bytes(encoded)
+        return prompt
+
+    @property
+    def content(self):
+        if not self._loaded:
+            raw = self.raw_bytes()
+            self._loaded = True
+            if self.content_type == 'image':
+                # The received file is kept, _raw_is_current() tells whether the caller drew on the image since
+                self._content = Image.open(io.BytesIO(raw))
+                self._rawSignature = self._image_signature()
+            else:
+                self._content = raw #Immutable bytes, passed through as they are
+        return self._content
+
+    @content.setter
+    def content(self, value):
+        self._content = value
+        self._version += 1
+        self._loaded = True
+        self._loader = None
+        self._encoded = None #base64 of the content as received
+        self._raw = None #Encoded bytes of the content as received or fetched
+        self._rawSignature = None #Size, mode and pixel digest of the image when _raw was attached, see _raw_is_current()
+        self.blob_ref = None #Key of the content in a BlobStore, the new content must be stored again
+
+    @property
+    def is_loaded(self):
+        return self._loaded
+
+    def touch(self):
+        """
+        Tells that the image was changed in place (ImageDraw, paste, putpixel). The serialized form cached by the message is
+        dropped, and on the next send the pixels are compared with the kept file to tell whether it is still valid.
+        """
+        self._version += 1
+
+    def raw_bytes(self):
+        """
+        The bytes of a binary prompt without decoding them: the file bytes of an image, the bytes of audio and documents.
+        For a received prompt it only costs the base64 decoding, the image itself is not opened.
+        """
+        self._drop_outdated_raw()
+        return self._raw_bytes()
+
+    def _drop_outdated_raw(self):
+        if (self._raw is not None or self._encoded is not None or self.blob_ref is not None) and not self._raw_is_current():
+            self._raw = None #Changed in place, the original file is outdated
+            self._encoded = None
+            self.blob_ref = None
+
+    def _raw_bytes(self):
+        """raw_bytes() without checking the kept file against the image, for callers which have just checked it."""
+        if self._raw is None:
+            if self._encoded is not None:
+                self._raw = base64.b64decode(self._encoded)
+                self._encoded = None #The bytes are the smaller of the two, base64 is cheap to redo when forwarding
+            elif self._loader is not None:
+                self._raw = self._loader()
+                self._loader = None
+            elif isinstance(self._content, Image.Image):
+                # No original file, encoded once and reused by the next sends of the dialog
+                buffered = io.BytesIO()
+                self._content.save(buffered, format='PNG')
+                self._raw = buffered.getvalue()
+                self._rawSignature = self._image_signature()
+            else:
+                return self._content
+        return self._raw
+
+    def copy(self):
+        """
+        A prompt with the same content which can be changed independently. Bytes, text and base64 are immutable and shared,
+        an image is shared as its encoded file and decoded again on access, so drawing on one copy doesn't change the other.
+        """
+        result = UnifiedPrompt.__new__(UnifiedPrompt)
+        for slot in UnifiedPrompt.__slots__:
+            setattr(result, slot, getattr(self, slot))
+        if self._loaded and isinstance(self._content, Image.Image):
+            result._raw = self.raw_bytes()
+            result._encoded = self._encoded
+            result._content = None
+            result._loaded = False
+            result._rawSignature = None
+            result.blob_ref = self.blob_ref
+        return result
+
+    def preencode(self):
+        """
+        Keeps the base64 form of a binary prompt next to its bytes, so the messages sharing the prompt (a static asset of an agent
+        sent in every reply) don't encode it again. Returns the prompt.
+        """
+        if self.content_type in BINARY_PROMPT_TYPES:
+            self._raw = self.raw_bytes()
+            self._rawSignature = self._image_signature()
+            self._encoded = base64.b64encode(self._raw).decode()
+        return self
+
+    def _image_signature(self):
+        """Size, mode and pixel digest of the image, None for other content. The digest is None while the pixels are not loaded from the file."""
+        if isinstance(self._content, Image.Image):
+            return (self._content.size, self._content.mode, _pixels_digest(self._content))
+        return None
+
+    def _raw_is_current(self):
+        """True when the kept encoded bytes still match the content: bytes can't change, an image may be drawn on in place."""
+        if not self._loaded or not isinstance(self._content, Image.Image):
+            return True
+        signature = self._image_signature()
+        if signature == self._rawSignature:
+            return True
+        raw = self._raw if self._raw is not None else base64.b64decode(self._encoded) if self._encoded is not None else None
+        if raw is None or self._rawSignature is None or self._rawSignature[2] is not None or signature[:2] != self._rawSignature[:2]:
+            return False
+        # The pixels were loaded after the file was attached, so they were read or changed. Decoding the file tells which one.
+        if _pixels_digest(Image.open(io.BytesIO(raw)), load=True) != signature[2]:
+            return False
+        self._rawSignature = signature
+        return True
+
+    def encoded_size(self):
+        """The memory taken by the content which is not decoded yet."""
+        if self._encoded is not None:
+            return len(self._encoded)
+        return len(self._raw) if self._raw is not None and self._raw is not self._content else 0
+
+class _BlobLoader:
+    """Fetches prompt bytes from a BlobStore. A class rather than a closure, so lazy prompts can be pickled and deep-copied."""
+    def __init__(self, blobStore, blob_ref):
+        self.blobStore = blobStore
+        self.blob_ref = blob_ref
+
+    def __call__(self):
+        return self.blobStore.get(self.blob_ref)
         
 #Routing Strategy class with validator        
 class RoutingStrategy:
+    """
+    Instances are shared: the default one by all the messages created without a strategy, interned ones by all the messages
+    with the same strategy and params. Treat them as immutable and create a new one instead of changing attributes.
+    """
+    # Slots also guarantee there are no keys besides 'strategy' and 'params'
+    __slots__ = ('strategy', 'params', '_json')
     _rules = None
     _rules_lock = threading.Lock()
     _rules_loaded = False
@@ -59,13 +276,22 @@ class RoutingStrategy:
     def __init__(self, strategy = "auto", params = "text-to-text.en.global"):
         self.strategy = strategy
         self.params = params
+        self._json = None
         self.validate()
+
+    @classmethod
+    def interned(cls, strategy = "auto", params = "text-to-text.en.global"):
+        """Returns the shared instance for the strategy and params, e.g. ("direct", "groot") for every message sent to groot."""
+        if not isinstance(strategy, str) or not isinstance(params, str):
+            return cls(strategy, params) #Raises the validation error
+        return cls._interned(strategy, params)
+
+    @classmethod
+    @functools.lru_cache(maxsize=ROUTING_STRATEGY_CACHE_SIZE)
+    def _interned(cls, strategy, params):
+        return cls(strategy, params)
         
     def validate(self):
-        required_keys = {'strategy', 'params'}
-        # Check if all required keys are present and there are no extra keys
-        if set(self.__dict__.keys()) != required_keys:
-            raise InvalidRoutingStrategyException("Routing strategy must only have keys 'strategy' and 'params'. Strategy set to default {'strategy' : 'auto', 'params' : 'text-to-text.en.global'}")
         # Check if the values are of expected types
         if not isinstance(self.strategy, str):
             raise InvalidRoutingStrategyException("The value for 'strategy' must be a string. Strategy set to default {'strategy' : 'auto', 'params' : 'text-to-text.en.global'}")
@@ -75,30 +301,45 @@ class RoutingStrategy:
     
     def to_json(self):
         """Converts the RoutingStrategy object to a JSON string."""
-        return json.dumps(self.__dict__)
+        if self._json is None:
+            self._json = json.dumps({'strategy': self.strategy, 'params': self.params})
+        return self._json
 
     @classmethod
     def from_json(cls, json_str):
-        """Creates a RoutingStrategy instance from a JSON string."""
+        """Creates a RoutingStrategy instance from a JSON string. Equal strings give the same interned instance without parsing them again."""
+        return cls._from_json_interned(json_str)
+
+    @classmethod
+    @functools.lru_cache(maxsize=ROUTING_STRATEGY_CACHE_SIZE)
+    def _from_json_interned(cls, json_str):
         data = json.loads(json_str)
-        return cls(**data)
+        return cls.interned(**data)
     
 # Message class
 class Message:
+    __slots__ = ('sender_info', 'subAccount', 'role', 'send_datetime', 'diagnosticData', 'agentConfig', 'unified_prompts', 'billingData',
+                 'routingStrategy', 'myceliumVersion', '_serializedPrompts')
+
     def __init__(self, role, unified_prompts, sender_info="", subAccount = "", send_datetime=None, diagnosticData=None, agentConfig = None,
-                 billingData = None, routingStrategy = RoutingStrategy(), myceliumVersion = "0.18"):
+                 billingData = None, routingStrategy = RoutingStrategy(), myceliumVersion = "0.18", validate = True):
+        # validate=False is the trusted path for data which is valid by construction: dialogs decoded from the wire format
+        # (built from validated messages by the sender) and prompts produced by processors from validated messages.
         self.sender_info = sender_info
         self.subAccount = subAccount
-        self.role = self.validate_role(role)
+        self.role = self.validate_role(role) if validate else role
         self.send_datetime = send_datetime if send_datetime else datetime.now()
         self.diagnosticData = diagnosticData
         self.agentConfig = agentConfig
-        self.unified_prompts = self.validate_unified_prompts(unified_prompts) if unified_prompts else []
+        if not unified_prompts:
+            unified_prompts = []
+        self.unified_prompts = self.validate_unified_prompts(unified_prompts) if validate else unified_prompts
         if billingData is None:
             billingData = []
-        self.billingData = self.validate_billing_data(billingData)
+        self.billingData = self.validate_billing_data(billingData) if validate else billingData
         self.routingStrategy = routingStrategy
         self.myceliumVersion = myceliumVersion
+        self._serializedPrompts = None #(key, serialized prompts) cached by Dialog.to_dict()
 
     def __str__(self):
         if not self.unified_prompts or self.unified_prompts == []:
@@ -111,6 +352,16 @@ class Message:
                 messages_str_list.append(f"Prompt {k}: content type: {prompt.content_type}, mime-type: {prompt.mime_type}.")  
         return "\n".join(messages_str_list)
         
+    def copy(self, copyPrompts = False):
+        """
+        Shallow copy. Prompts are shared, lists are not, so changing attributes or prompt lists of the copy doesn't affect the original.
+        :param copyPrompts: Copy the prompts too (see UnifiedPrompt.copy), for messages handed to code which may change their content.
+        """
+        result = copy.copy(self)
+        result.unified_prompts = [prompt.copy() for prompt in self.unified_prompts] if copyPrompts else list(self.unified_prompts)
+        result.billingData = list(self.billingData)
+        return result
+
     def validate_role(self, role):
         valid_roles = {'system', 'user', 'assistant'}
         if role not in valid_roles:
@@ -118,45 +369,18 @@ class Message:
         return role
 
     def validate_unified_prompts(self, unified_prompts):
-        SUPPORTED_PROMPT_TYPES = {'text', 'url', 'image', 'document', 'audio', 'video', 'stream_of_bytes', 'stream_audio', 'stream_video'}
         for i, prompt in enumerate(unified_prompts):
             if not isinstance(prompt, UnifiedPrompt):
                 raise InvalidPromptException(f"Error in unified prompt at index {i}: Not a UnifiedPrompt object.")
-            if prompt.content_type not in SUPPORTED_PROMPT_TYPES:
+            rules = PROMPT_VALIDATION_RULES.get(prompt.content_type)
+            if rules is None:
                 raise InvalidPromptException(f"Error at index {i}: Unsupported prompt content_type '{prompt.content_type}'. Must be one of: " + str(SUPPORTED_PROMPT_TYPES) + ".")
-            if prompt.content_type == 'text':
-                if not isinstance(prompt.content, str):
-                    raise InvalidPromptException(f"Error in text prompt at index {i}: Content must be a string.")
-            elif prompt.content_type == 'url':
-                if not isinstance(prompt.content, str):
-                    raise InvalidPromptException(f"Error in URL prompt at index {i}: Content must be a string.")
-            elif prompt.content_type == 'image':
-                if not isinstance(prompt.content, Image.Image):
-                    raise InvalidPromptException(f"Error in image prompt at index {i}: Content must be a PIL Image object.")
-            elif prompt.content_type == 'document':
-                if not isinstance(prompt.content, bytes):
-                    raise InvalidPromptException(f"Error in document prompt at index {i}: Content must be bytes.")
-            elif prompt.content_type == 'audio':
-                if not isinstance(prompt.content, bytes):
-                    raise InvalidPromptException(f"Error in audio prompt at index {i}: Content must be bytes.")
-            elif prompt.content_type == 'video':
-                if not isinstance(prompt.content, bytes):
-                    raise InvalidPromptException(f"Error in video prompt at index {i}: Content must be bytes.")
-            else:
-                raise InvalidPromptException(f"Error at index {i}: Unknown prompt content_type '{prompt.content_type}'.")
-             # MIME type validation
-            if prompt.content_type == 'text' and not prompt.mime_type.startswith('text/'):
-                raise InvalidPromptException(f"Error in text prompt at index {i}: MIME type should start with 'text/'.")
-            elif prompt.content_type == 'url' and not (prompt.mime_type.startswith('text/') or prompt.mime_type.startswith('application/') or prompt.mime_type.startswith('image/') or prompt.mime_type.startswith('video/') or prompt.mime_type.startswith('audio/')):
-                raise InvalidPromptException(f"Error in URL prompt at index {i}: MIME type start witj 'text/' or 'image/' or 'video/' or 'audio/' or 'application/'.")
-            elif prompt.content_type == 'image' and not prompt.mime_type.startswith('image/'):
-                raise InvalidPromptException(f"Error in image prompt at index {i}: MIME type should start with 'image/'.")
-            elif prompt.content_type == 'document' and not prompt.mime_type.startswith('application/'):
-                raise InvalidPromptException(f"Error in document prompt at index {i}: MIME type should start with 'application/'.")
-            elif prompt.content_type == 'audio' and not prompt.mime_type.startswith('audio/'):
-                raise InvalidPromptException(f"Error in audio prompt at index {i}: MIME type should start with 'audio/'.")
-            elif prompt.content_type == 'video' and not prompt.mime_type.startswith('video/'):
-                raise InvalidPromptException(f"Error in video prompt at index {i}: MIME type should start with 'video/'.")
+            contentTypes, contentError, mimePrefixes, mimeError = rules
+            # Lazy content is checked by its loader, loading it here would defeat the purpose
+            if prompt.is_loaded and not isinstance(prompt.content, contentTypes):
+                raise InvalidPromptException(contentError.format(i=i))
+            if mimePrefixes and not prompt.mime_type.startswith(mimePrefixes):
+                raise InvalidPromptException(mimeError.format(i=i))
         return unified_prompts
 
     def validate_billing_data(self, billing_data):
@@ -195,6 +419,7 @@ class Dialog:
         self.endUserCommunicationID = endUserCommunicationID
         self.lastMessageRoutingStrategy = lastMessageRoutingStrategy
         self.myceliumVersion = myceliumVersion
+        self.wireCodec = None #The codec of the last message received in this dialog, replies are sent in it. Not serialized.
         
     @classmethod
     def Create(self, textPrompt = None, imagePrompt = None, audioPrompt = None, audioMimeType = None, 
@@ -220,7 +445,7 @@ class Dialog:
             if isinstance(imagePrompt, list):
                 for img in imagePrompt:
                     if isinstance(img, Image.Image):
-                        unifiedPrompts.append(UnifiedPrompt(content_type="image", content=img, mime_type=f"image/{imagePrompt.format.lower()}"))
+                        unifiedPrompts.append(UnifiedPrompt(content_type="image", content=img, mime_type=f"image/{(img.format or 'png').lower()}"))
                     else:
                         raise TypeError ("imagePrompt must be either a Pillow Image or a list of Pillow Images")
         if audioPrompt and audioMimeType:
@@ -254,6 +479,15 @@ class Dialog:
             resultDialog._update_totals()
         return (resultDialog)
 
+    def copy(self):
+        """
+        Copy-on-write copy. The message list is new, the Message objects are shared until one of the dialogs needs to change
+        a message: then it replaces it in its own list with message.copy(). Media is never duplicated.
+        """
+        result = copy.copy(self)
+        result.messages = list(self.messages)
+        return result
+
     def __add__(self, other):
         if not isinstance(other, Dialog) and not isinstance(other, str) and not isinstance(other, list):
             raise ValueError("Can only add Dialog and string or [string] instances together")
@@ -261,7 +495,7 @@ class Dialog:
             combined_messages = self.messages + [Message(role="user", unified_prompts=[UnifiedPrompt(content=other, content_type="text", mime_type="text/plain")],  send_datetime=datetime.now())]
             newDialog = Dialog(messages=combined_messages, dialog_id=self.dialog_id, reply_to=self.reply_to, requestAgentConfig=self.requestAgentConfig, endUserCommunicationID=self.endUserCommunicationID)
         elif isinstance(other, list):
-            combined_messages = self.messages
+            combined_messages = list(self.messages)
             for strvalue in other:
                 combined_messages.append(Message(role="user", unified_prompts=[UnifiedPrompt(content=strvalue, content_type="text", mime_type="text/plain")],  send_datetime=datetime.now()))
             newDialog = Dialog(messages=combined_messages, dialog_id=self.dialog_id, reply_to=self.reply_to, requestAgentConfig=self.requestAgentConfig, endUserCommunicationID=self.endUserCommunicationID)
@@ -293,7 +527,7 @@ class Dialog:
         if len(self.messages)<1:
             raise IndexError("Your dialog must have at least one message.")
         if isinstance(other, str):
-            newDialog = copy.deepcopy(self)
+            newDialog = self._copy_with_own_last_message()
             newDialog.messages[-1].unified_prompts = newDialog.messages[-1].unified_prompts + [UnifiedPrompt(content=other, content_type="text", mime_type="text/plain")]
             resut = newDialog
         elif isinstance(other, list):
@@ -301,14 +535,14 @@ class Dialog:
             for strvalue in other:
                 if not isinstance(strvalue, str):
                     raise ValueError("The intersected list must contain strings only")
-                newDialog = copy.deepcopy(self)
+                newDialog = self._copy_with_own_last_message()
                 newDialog.messages[-1].unified_prompts = self.messages[-1].unified_prompts + [UnifiedPrompt(content=strvalue, content_type="text", mime_type="text/plain")]
                 resultDialogs.append(newDialog)
             resut = resultDialogs
         elif isinstance(other, Dialog):
             if len(other.messages) < 1:
                 raise IndexError("Both dialogs must have at least one message.")
-            result = copy.deepcopy(self)
+            result = self._copy_with_own_last_message()
             result.messages[-1].unified_prompts = result.messages[-1].unified_prompts + other.messages[-1].unified_prompts
             resut = result
         return resut
@@ -319,7 +553,7 @@ class Dialog:
         if len(self.messages)<1:
             raise IndexError("Your dialog must have at least one message.")
         if isinstance(other, str):
-            newDialog = copy.deepcopy(self)
+            newDialog = self._copy_with_own_last_message()
             newDialog.messages[-1].unified_prompts = [UnifiedPrompt(content=other, content_type="text", mime_type="text/plain")] + newDialog.messages[-1].unified_prompts
             resut = newDialog
         elif isinstance(other, list):
@@ -327,18 +561,23 @@ class Dialog:
             for strvalue in other:
                 if not isinstance(strvalue, str):
                     raise ValueError("The intersected list must contain strings only")
-                newDialog = copy.deepcopy(self)
+                newDialog = self._copy_with_own_last_message()
                 newDialog.messages[-1].unified_prompts = [UnifiedPrompt(content=strvalue, content_type="text", mime_type="text/plain")] + newDialog.messages[-1].unified_prompts
                 resultDialogs.append(newDialog)
             resut = resultDialogs
         elif isinstance(other, Dialog):
             if len(other.messages) < 1:
                 raise IndexError("Both dialogs must have at least one message.")
-            result = copy.deepcopy(self)
+            result = self._copy_with_own_last_message()
             result.messages[-1].unified_prompts = other.messages[-1].unified_prompts + result.messages[-1].unified_prompts
             resut = result
         return resut
     
+    def _copy_with_own_last_message(self):
+        result = self.copy()
+        result.messages[-1] = result.messages[-1].copy()
+        return result
+
     def __str__(self):
         if not self.messages or self.messages == []:
             return "Dialog is empty."
@@ -357,42 +596,9 @@ class Dialog:
     def FromTemplate(self, template, valueDictionary):
         # Осталось сделать перемножение... но, [Dialog] * [DialogTemplate], по ходу, не сделаю. 
         # Такое перемножение зарулим примером, где диалоги перебираются и множатся на массивы словарей с сохарнением в общий лист.
-
-        def find_unique_placeholders(dialogTemplate):
-            if not isinstance(dialogTemplate, DialogTemplate):
-                raise TypeError ("dialogTemplate must be of type DialogTemplate")
-            pattern = r"\{(\w+)\}"  # Matches placeholders in the format {placeholder}
-            placeholders = set()
-            for message in dialogTemplate.messages:
-                for prompt in message.unified_prompts:
-                    if prompt.content_type == "text":
-                            matches = re.findall(pattern, prompt.content)
-                            placeholders.update(matches)
-            if len(placeholders) == 0:
-                raise TypeError ("dialogTemplate is not a proper DialogTemplate as there is no prompt with content_type text containing any placeholders like {placeholder_name}")
-            return placeholders
-
-        if not isinstance(template, DialogTemplate) and not isinstance(valueDictionary, dict):
+        if not isinstance(template, DialogTemplate) or not isinstance(valueDictionary, dict):
             raise TypeError ("template must be a DialogTemplate object and valueDictionary must be a dictionary of {placeholderName : value}")
-        
-        placeholders = find_unique_placeholders(template)
-        missing_placeholders = placeholders - valueDictionary.keys()
-        if missing_placeholders:
-            raise ValueError(f"Missing replacement for placeholders: {', '.join(missing_placeholders)}")
-        
-        result = Dialog(dialog_id = template.dialog_id, messages = copy.deepcopy(template.messages), reply_to = template.reply_to,
-                        lastMessageDiagnosticData = template.lastMessageDiagnosticData, requestAgentConfig = template.requestAgentConfig,
-                        lastMessageBillingData = template.lastMessageBillingData, endUserCommunicationID = template.endUserCommunicationID,
-                        lastMessageRoutingStrategy= template.lastMessageRoutingStrategy)        
-        
-        for msg in result.messages:
-            for prmpt in msg.unified_prompts:
-                if prmpt.content_type == "text":
-                    try:
-                        prmpt.content = prmpt.content.format(**valueDictionary)
-                    except KeyError as e:
-                        raise ValueError(f"Missing replacement for placeholder: {e}")
-        return result
+        return next(template.render([valueDictionary]))
 
     def _update_totals(self):
         self.message_count = len(self.messages)
@@ -401,23 +607,62 @@ class Dialog:
             self.lastMessageDiagnosticData = self.messages[-1].diagnosticData
             self.lastMessageRoutingStrategy = self.messages[-1].routingStrategy
 
-    def serialize(self):
-        serialized_messages = []
+    def content_hash(self, service = None, config = None):
+        """
+        Canonical SHA-256 of what a service gets to process: the roles, agentConfig and prompts of the messages, the service and its config.
+        Dialog ids, senders, dates and billing don't change it. Binary prompts are hashed by the digest of their bytes, the same one
+        as their BlobStore key, so a blob reference and the inline content give the same hash without fetching the blob.
+        """
+        digest = hashlib.sha256()
+        digest.update(json.dumps([service, config], sort_keys=True, default=str).encode())
         for message in self.messages:
-            # Convert unified prompts to a serializable format
-            serialized_unified_prompts = []
+            digest.update(b"\x00message" + json.dumps([message.role, message.agentConfig], sort_keys=True, default=str).encode())
             for prompt in message.unified_prompts:
-                serialized_prompt = {
-                    'content_type': prompt.content_type,
-                    'content': self._content_to_base64(prompt.content) if prompt.content_type in ['image', 'document', 'audio'] else prompt.content,
-                    'mime_type': prompt.mime_type
-                }
-                serialized_unified_prompts.append(serialized_prompt)
+                if prompt.blob_ref is not None:
+                    content = prompt.blob_ref.encode()
+                elif prompt.content_type in ('text', 'url'):
+                    content = prompt.content.encode()
+                else:
+                    content = ("sha256:" + hashlib.sha256(prompt.raw_bytes()).hexdigest()).encode()
+                digest.update(b"\x00prompt" + json.dumps([prompt.content_type, prompt.mime_type, len(content)]).encode() + content)
+        return digest.hexdigest()
 
+    def estimated_size(self):
+        """Approximate memory footprint of the dialog content in bytes. Binary prompts are counted by their size, images by their raw pixel data."""
+        size = 0
+        for message in self.messages:
+            size += MESSAGE_OVERHEAD_BYTES
+            for prompt in message.unified_prompts:
+                if not prompt.is_loaded:
+                    size += prompt.encoded_size() #Nothing for a blob which is not fetched yet
+                    continue
+                content = prompt.content
+                if isinstance(content, (bytes, bytearray)):
+                    size += len(content)
+                elif isinstance(content, str):
+                    size += len(content)
+                elif isinstance(content, Image.Image):
+                    size += content.width * content.height * len(content.getbands())
+                size += prompt.encoded_size() #The original file kept along with a decoded image
+        return size
+
+    def serialize(self, blobStore = None):
+        """
+        :param blobStore: Optional BlobStore. Binary prompts above its threshold are put there and only their keys are serialized.
+        """
+        return json.dumps(self.to_dict(blobStore), ensure_ascii=False)
+
+    def to_dict(self, blobStore = None, binary = False):
+        """
+        The dialog as plain dicts and lists, ready for a wire codec.
+        :param binary: Keep binary prompts as raw bytes instead of base64 strings, for the codecs which carry bytes natively.
+        """
+        serialized_messages = []
+        for message in self.messages:
             # Create the serialized message
             serialized_message = {
                 'role': message.role,
-                'unified_prompts': serialized_unified_prompts,
+                'unified_prompts': self._serialize_prompts(message, blobStore, binary),
                 'sender_info': message.sender_info,
                 'send_datetime': message.send_datetime.isoformat(),
                 'agentConfig' : message.agentConfig,
@@ -439,20 +684,51 @@ class Dialog:
             'lastMessageRoutingStrategy' : self.lastMessageRoutingStrategy.to_json(),
             'myceliumVersion': self.myceliumVersion
         }
-        return json.dumps(dialog_data, ensure_ascii=False)
-
-    def _content_to_base64(self, content):
-        if isinstance(content, Image.Image):
-            buffered = io.BytesIO()
-            content.save(buffered, format='PNG')
-            return base64.b64encode(buffered.getvalue()).decode()
-        elif isinstance(content, bytes):
-            return base64.b64encode(content).decode()
+        return dialog_data
+
+    def _serialize_prompts(self, message, blobStore, binary):
+        """
+        Serialized prompts are cached by the message, so sending a growing dialog again only encodes the new messages.
+        The cache is valid while the message keeps the same prompt objects with the same content, content_type and mime_type.
+        An image changed in place is not noticed here, UnifiedPrompt.touch() drops its cached form.
+        """
+        key = (binary, blobStore, tuple((prompt, prompt._version, prompt.content_type, prompt.mime_type) for prompt in message.unified_prompts))
+        cached = message._serializedPrompts
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        serialized_unified_prompts = [self._serialize_prompt(prompt, blobStore, binary) for prompt in message.unified_prompts]
+        message._serializedPrompts = (key, serialized_unified_prompts)
+        return serialized_unified_prompts
+
+    def _serialize_prompt(self, prompt, blobStore, binary = False):
+        if prompt.content_type not in BINARY_PROMPT_TYPES:
+            return {'content_type': prompt.content_type, 'content': prompt.content, 'mime_type': prompt.mime_type}
+        # The only place the pixels of an image are compared with its kept file: right before the file goes on the wire
+        prompt._drop_outdated_raw()
+        if blobStore is not None and prompt.blob_ref is not None:
+            # A prompt received as a reference is forwarded as is, without fetching
+            return {'content_type': prompt.content_type, 'content': None, 'mime_type': prompt.mime_type, 'blob': prompt.blob_ref}
+        if prompt._encoded is not None and not binary and (blobStore is None or len(prompt._encoded) * 3 // 4 < blobStore.threshold):
+            # Received and never decoded or pre-encoded with preencode(), sent as is
+            return {'content_type': prompt.content_type, 'content': prompt._encoded, 'mime_type': prompt.mime_type}
+        data = prompt._raw_bytes()
+        if blobStore is not None and len(data) >= blobStore.threshold:
+            prompt.blob_ref = blobStore.put(data)
+            return {'content_type': prompt.content_type, 'content': None, 'mime_type': prompt.mime_type, 'blob': prompt.blob_ref}
+        if isinstance(data, str):
+            content = data #Already base64
         else:
-            return content  # For non-binary content
+            content = bytes(data) if binary else base64.b64encode(data).decode()
+        return {'content_type': prompt.content_type, 'content': content, 'mime_type': prompt.mime_type}
+
+    def deserialize(self, serialized_data, blobStore = None):
+        """
+        :param blobStore: The BlobStore to fetch prompts serialized as blob references. They are fetched on first access to their content.
+        """
+        self.from_dict(json.loads(serialized_data), blobStore)
 
-    def deserialize(self, serialized_data):
-        dialog_data = json.loads(serialized_data)
+    def from_dict(self, dialog_data, blobStore = None):
+        """Fills the dialog from the output of to_dict(). Binary prompts may come either as base64 strings or as raw bytes."""
         self.dialog_id = dialog_data['dialog_id']
         self.reply_to = dialog_data['reply_to']
         self.lastMessageDiagnosticData = dialog_data['lastMessageDiagnosticData']
@@ -467,7 +743,19 @@ class Dialog:
             # Reconstruct unified prompts from serialized data
             unified_prompts = []
             for serialized_prompt in data['unified_prompts']:
-                content = self._base64_to_content(serialized_prompt['content'], serialized_prompt['content_type']) if serialized_prompt['content_type'] in ['image', 'document', 'audio'] else serialized_prompt['content']
+                blob_ref = serialized_prompt.get('blob')
+                if blob_ref is not None:
+                    if blobStore is None:
+                        raise InvalidPromptException(f"The prompt refers to blob {blob_ref}, but no blob store is configured to fetch it.")
+                    prompt = UnifiedPrompt.lazy(serialized_prompt['content_type'], _BlobLoader(blobStore, blob_ref),
+                                                mime_type=serialized_prompt.get('mime_type'), blob_ref=blob_ref)
+                    unified_prompts.append(prompt)
+                    continue
+                if serialized_prompt['content_type'] in BINARY_PROMPT_TYPES and serialized_prompt['content'] is not None:
+                    # Decoded on first access, an agent reading only the text prompts never pays for the media in the history
+                    unified_prompts.append(UnifiedPrompt.from_encoded(serialized_prompt['content_type'], serialized_prompt['content'], serialized_prompt.get('mime_type')))
+                    continue
+                content = serialized_prompt['content']
                 prompt = UnifiedPrompt(
                     content_type=serialized_prompt['content_type'],
                     content=content,
@@ -486,28 +774,40 @@ class Dialog:
                 sender_info=data['sender_info'],
                 subAccount=data['subAccount'],
                 routingStrategy = RoutingStrategy.from_json(data['routingStrategy']),
-                send_datetime=datetime.fromisoformat(data['send_datetime'])
+                send_datetime=datetime.fromisoformat(data['send_datetime']),
+                validate = False
             )
             self.messages.append(message)
         self._update_totals()
 
-    def _base64_to_content(self, base64_string, content_type):
-        if content_type in ['image', 'document', 'audio']:
-            byte_content = base64.b64decode(base64_string)
-            if content_type == 'image':
-                return Image.open(io.BytesIO(byte_content))
-            else:
-                return byte_content
-        else:
-            return base64_string  # For non-binary content
+    def serialize_and_compress(self, blobStore = None, codec = None):
+        """
+        :param codec: The name of a wire codec from Codecs.py, the zlib-compressed JSON when None.
+        """
+        codec = get_codec(codec)
+        return codec.encode(self.to_dict(blobStore, codec.binary))
 
-    def serialize_and_compress(self):
-        serialized_data = self.serialize()
-        return zlib.compress(serialized_data.encode())
+    def decompress_and_deserialize(self, compressed_data, blobStore = None, codec = None):
+        """
+        :param codec: The codec named in the myceliumCodec header of the message, the zlib-compressed JSON when None.
+        """
+        self.from_dict(get_codec(codec).decode(compressed_data), blobStore)
+
+    async def serialize_and_compress_async(self, executor = None, blobStore = None, codec = None):
+        """
+        serialize_and_compress() running in an executor, so big dialogs don't block the event loop.
+        The worker gets a copy of the dialog made on the loop, messages appended or replaced meanwhile don't change what it iterates.
+        :param executor: A concurrent.futures executor. None means the default thread pool of the loop.
+        """
+        return await asyncio.get_running_loop().run_in_executor(executor, _serialize_and_compress, self.copy(), blobStore, codec)
 
-    def decompress_and_deserialize(self, compressed_data):
-        decompressed_data = zlib.decompress(compressed_data)
-        self.deserialize(decompressed_data.decode())
+    async def decompress_and_deserialize_async(self, compressed_data, executor = None, blobStore = None, codec = None):
+        """
+        decompress_and_deserialize() running in an executor, so big dialogs don't block the event loop.
+        :param executor: A concurrent.futures executor. None means the default thread pool of the loop.
+        """
+        decoded = await asyncio.get_running_loop().run_in_executor(executor, _decompress_and_deserialize, compressed_data, blobStore, codec)
+        self.__dict__.update(decoded.__dict__)
         
     async def generate_error_message(self, errorMessage, billingData=None, sender_info=None, diagnosticData=None, 
                                      subAccount = None):
@@ -531,7 +831,7 @@ class Dialog:
             billingData=billingData,
             diagnosticData = diagnosticData,
             subAccount = subAccount,
-            routingStrategy=RoutingStrategy("direct", self.reply_to)
+            routingStrategy=RoutingStrategy.interned("direct", self.reply_to)
         )
         self.messages.append(error_message)
         self._update_totals()
@@ -572,15 +872,178 @@ class Dialog:
                 dialog_instance.deserialize(data_to_load.decode())  # Decode since we read in binary mode
             return dialog_instance
 
+# Module level, so they can be sent to a ProcessPoolExecutor
+def _serialize_and_compress(dialog, blobStore = None, codec = None):
+    return dialog.serialize_and_compress(blobStore, codec)
+
+def _decompress_and_deserialize(compressed_data, blobStore = None, codec = None):
+    dialog = Dialog()
+    dialog.decompress_and_deserialize(compressed_data, blobStore, codec)
+    return dialog
+
+MESSAGE_OVERHEAD_BYTES = 512 #Rough per-message cost of the metadata, used by Dialog.estimated_size()
+
+class BoundedDialogStore(MutableMapping):
+    """
+    A dict-like storage for Mycelium.dialogs which runs in fixed memory. Dialogs are evicted in the least recently used order
+    when there are more than maxDialogs of them or their estimated size exceeds maxBytes, and after idleTTL seconds without access.
+    The dialog accessed last is never evicted, so an active conversation is not dropped in the middle of processing.
+    """
+    def __init__(self, maxDialogs = None, maxBytes = None, idleTTL = None, onEvict = None):
+        self.maxDialogs = maxDialogs
+        self.maxBytes = maxBytes
+        self.idleTTL = idleTTL
+        self.onEvict = onEvict #Optional callable(dialog_id, dialog, reason)
+        self._dialogs = OrderedDict()
+        self._sizes = {}
+        self._lastAccess = {}
+        self.totalBytes = 0
+        self.evictions = {"lru": 0, "ttl": 0, "bytes": 0}
+        self.evictedBytes = 0
+
+    def stats(self):
+        return {
+            "dialogs": len(self._dialogs),
+            "totalBytes": self.totalBytes,
+            "evictedByCount": self.evictions["lru"],
+            "evictedByTTL": self.evictions["ttl"],
+            "evictedBySize": self.evictions["bytes"],
+            "evictedBytes": self.evictedBytes
+        }
+
+    def __getitem__(self, dialog_id):
+        self._expire()
+        dialog = self._dialogs[dialog_id]
+        self._touch(dialog_id)
+        # Dialogs are changed in place (messages appended), so the size is refreshed on every access
+        self._resize(dialog_id)
+        self._enforce_limits()
+        return dialog
+
+    def __setitem__(self, dialog_id, dialog):
+        self._expire()
+        self._dialogs[dialog_id] = dialog
+        self._touch(dialog_id)
+        self._resize(dialog_id)
+        self._enforce_limits()
+
+    def __delitem__(self, dialog_id):
+        del self._dialogs[dialog_id]
+        self.totalBytes -= self._sizes.pop(dialog_id)
+        del self._lastAccess[dialog_id]
+
+    def __contains__(self, dialog_id):
+        self._expire()
+        return dialog_id in self._dialogs
+
+    def __iter__(self):
+        self._expire()
+        return iter(list(self._dialogs))
+
+    def __len__(self):
+        self._expire()
+        return len(self._dialogs)
+
+    def _touch(self, dialog_id):
+        self._dialogs.move_to_end(dialog_id)
+        self._lastAccess[dialog_id] = time.monotonic()
+
+    def _resize(self, dialog_id):
+        size = self._dialogs[dialog_id].estimated_size()
+        self.totalBytes += size - self._sizes.get(dialog_id, 0)
+        self._sizes[dialog_id] = size
+
+    def _evict(self, dialog_id, reason):
+        dialog = self._dialogs[dialog_id]
+        self.evictedBytes += self._sizes[dialog_id]
+        del self[dialog_id]
+        self.evictions[reason] += 1
+        if self.onEvict:
+            self.onEvict(dialog_id, dialog, reason)
+
+    def _expire(self):
+        if self.idleTTL is None:
+            return
+        deadline = time.monotonic() - self.idleTTL
+        # Access order and access time go together, so the expired dialogs are at the beginning
+        while self._dialogs:
+            dialog_id = next(iter(self._dialogs))
+            if self._lastAccess[dialog_id] > deadline:
+                break
+            self._evict(dialog_id, "ttl")
+
+    def _enforce_limits(self):
+        while len(self._dialogs) > 1:
+            if self.maxDialogs is not None and len(self._dialogs) > self.maxDialogs:
+                self._evict(next(iter(self._dialogs)), "lru")
+            elif self.maxBytes is not None and self.totalBytes > self.maxBytes:
+                self._evict(next(iter(self._dialogs)), "bytes")
+            else:
+                break
+
+DELTA_VERSIONS_KEPT = 4
+
+class DialogVersionHistory:
+    """
+    The last few versions of a dialog used by the delta transmission. The sender keeps what it has sent,
+    the receiver keeps what it has rebuilt, so a delta can be based on any version both of them still have.
+    """
+    def __init__(self, keep = DELTA_VERSIONS_KEPT):
+        self.keep = keep
+        self.versions = OrderedDict()
+        self.acknowledged = None #Sender side only. The version the receiver confirmed in its last reply.
+        self.endUserCommunicationID = None #Receiver side only. Lets a dialog affinity find the partition after the dialog itself is dropped.
+
+    def add(self, version, messages):
+        self.versions[version] = messages
+        while len(self.versions) > self.keep:
+            self.versions.popitem(last=False)
+
+    def latest_version(self):
+        return next(reversed(self.versions)) if self.versions else 0
+
+    def estimated_size(self):
+        # The versions share message objects, the latest one is a fair estimate of all of them
+        return Dialog(messages=list(self.versions[self.latest_version()])).estimated_size() if self.versions else 0
+
+class _CoalescedReply:
+    """
+    The reply received for a coalesced request, as it is handed to one of the dialogs which waited for it. Carries the fields
+    of the received message, and the dialog decoded from it if the first dialog got that far, so the body isn't decoded again.
+    """
+    __slots__ = ('body', 'headers', 'correlation_id', 'reply_to', 'decoded')
+
+    def __init__(self, body, headers, correlation_id, reply_to, decoded = None):
+        self.body = body
+        self.headers = headers
+        self.correlation_id = correlation_id
+        self.reply_to = reply_to
+        self.decoded = decoded
+
+    @classmethod
+    def for_follower(cls, message, dialog_id, decoded):
+        # The version acknowledgement is about the delta history of the first dialog, the others were never sent
+        headers = {name: value for name, value in (message.headers or {}).items() if name != 'dialogVersionAck'}
+        return cls(message.body, headers, dialog_id, message.reply_to, decoded)
+
+    def copy_into(self, dialog):
+        """Fills the dialog with its own copies of the messages and prompts, so no callback changes what the other dialogs get."""
+        dialog.__dict__.update(self.decoded.__dict__)
+        dialog.messages = [message.copy(copyPrompts=True) for message in self.decoded.messages]
+
+REPLY_MODES = ("shared", "exclusive", "direct")
+
 # Mycelium class
 class Mycelium:
-    def __init__(self, host="65.109.141.56", vhost="myceliumVersion018", username=None, password=None, input_chanel=None, output_chanel=None, ComradeAIToken=None, dialogs=None, message_received_callback=None, lastReceivedMessageBillingData = {}, serverAsyncModeThreads = 10, myceliumVersion = "0.18"):
+    def __init__(self, host="65.109.141.56", vhost="myceliumVersion018", username=None, password=None, input_chanel=None, output_chanel=None, ComradeAIToken=None, dialogs=None, message_received_callback=None, lastReceivedMessageBillingData = {}, serverAsyncModeThreads = 10, myceliumVersion = "0.18",
+                 replyMode = "shared", codecOffloadThreshold = None, codecExecutor = None, deltaTransmission = False, blobStore = None, codec = None, transport = None,
+                 coalesceRequests = False, coalesceTimeout = 600, affinity = None):
         #TODO. Don't forget to switch to 020 after testing is done.
         #TODO. I must allow to use different Mycelium hosts. In order to do it, I have to lauch one in Russia, like in the Office on Pushkina 38 :)
         self.myceliumVersion = myceliumVersion
         self.input_chanel = input_chanel if ComradeAIToken is None else ComradeAIToken
         self.output_chanel = output_chanel if output_chanel is not None else "myceliumRouter" + self.myceliumVersion
-        self.dialogs = {} if dialogs is None else dialogs
+        self.dialogs = {} if dialogs is None else dialogs #Any dict-like storage, e.g. BoundedDialogStore to keep the memory bounded
         self.rabbitmq_host = host
         self.rabbitmq_username = username if ComradeAIToken is None else ComradeAIToken
         self.rabbitmq_password = password if ComradeAIToken is None else ComradeAIToken
@@ -590,6 +1053,49 @@ class Mycelium:
         self.lastReceivedMessageBillingData = lastReceivedMessageBillingData
         self.message_received_callback = message_received_callback #Only used in a server mode when start_server is awaited.
         self.serverAsyncModeThreads = serverAsyncModeThreads
+        # Where Agent requests get their replies. "shared" - the input_chanel (ComradeAIToken queue), purged before each request.
+        # "exclusive" - a private auto-delete queue per connection, "direct" - RabbitMQ direct reply-to. Private modes never purge,
+        # so any number of clients can share one token.
+        if replyMode not in REPLY_MODES:
+            raise ValueError(f"replyMode must be one of {REPLY_MODES}")
+        self.replyMode = replyMode
+        self.replyQueue = self.input_chanel #Reply queue of the blocking connection, redefined by connect() in private modes.
+        self.asyncReplyQueue = self.input_chanel #Reply queue of the InvokeAsync consumer.
+        # Dialogs bigger than codecOffloadThreshold bytes are encoded and decoded in codecExecutor (the default thread pool when None)
+        # instead of the event loop. A ProcessPoolExecutor also takes JSON and base64 work off the GIL. None disables offloading.
+        self.codecOffloadThreshold = codecOffloadThreshold
+        self.codecExecutor = codecExecutor
+        # Opt-in. When sending a dialog which is not a reply, only the messages added since the version acknowledged by the receiver are sent.
+        # The receiver rebuilds the dialog from its own copy. Both peers must support it; the receiver side is always on.
+        self.deltaTransmission = deltaTransmission
+        self._deltaSent = BoundedDialogStore(maxDialogs=100000, idleTTL=24 * 3600)
+        self.deltaCache = BoundedDialogStore(maxDialogs=10000, idleTTL=3600)
+        self.blobStore = blobStore #Optional BlobStore for big binary prompts, see BlobStore.py
+        # The wire codec of the dialogs we send, see Codecs.py. Incoming messages are decoded with the codec named in their header
+        # and replies go in the codec of the request, so peers using the default zlib-compressed JSON are always understood.
+        self.codec = get_codec(codec).name
+        # Creates the connections, RabbitMQ by default. Transports.InMemoryTransport runs agents and clients in one process with no network.
+        self.transport = transport if transport is not None else AmqpTransport()
+        self.replyConnection = None #Used by Agent.InvokeAsync only. A long-lived consumer of the replies, shared by all the requests in flight.
+        self.replyChanel = None
+        self._replyConsumerLock = None
+        self._pendingReplies = {}
+        self._pendingStreams = {} #correlation_id -> asyncio.Queue of the chunks and the final reply of Agent.StreamAsync
+        self._streamRequests = set() #Server side. Dialogs whose clients asked for streaming
+        self._streamSequences = {} #Server side. dialog_id -> number of chunks sent
+        # Opt-in single-flight. While a request with the same content, service and config is waiting for its reply, an identical one
+        # is not sent: Agent.InvokeAsync and batch Invoke share the reply of the first request, a dialog sent with send_to_mycelium gets
+        # a copy of the first dialog's reply through message_received_callback. A request without a reply in coalesceTimeout seconds
+        # stops being joined. Copies are not billed by the router, they get the billingData of the first reply.
+        self.coalesceRequests = coalesceRequests
+        self.coalesceTimeout = coalesceTimeout
+        self._inFlightRequests = {} #Request hash -> asyncio.Future with the reply of Agent.InvokeAsync
+        self._inFlightSends = OrderedDict() #Request hash -> (dialog_id, deadline, [dialog_ids waiting for its reply]) of send_to_mycelium
+        self._inFlightSendKeys = {} #dialog_id -> request hash
+        # Replicas of a stateful agent or interface: every dialog is processed by the replica holding it, see Affinity.DialogAffinity
+        self.affinity = affinity
+        self._serverStopping = False #Set by stop_server()
+        self._messagesInProgress = 0 #Received by start_server() and not processed yet
 
     def dialog_count(self):
         return len(self.dialogs)
@@ -625,78 +1131,206 @@ class Mycelium:
         return newDialog
     
     async def connectAsync(self):
-        self.connection = await aio_pika.connect_robust(
-            host=self.rabbitmq_host,
-            login=self.rabbitmq_username,
-            password=self.rabbitmq_password,
-            virtualhost=self.rabbitmq_vhost
-        )
+        self.connection = await self.transport.connect_async(self)
         self.chanel = await self.connection.channel()
         await self.chanel.set_qos(prefetch_count=self.serverAsyncModeThreads)
 
     async def connect_to_mycelium(self): 
         #Will be deprecated in further releases. 
         warnings.warn("connect_to_mycelium() is deprecated and will be removed in a future versions. Use connect() or await connectAsync() instead.", DeprecationWarning, stacklevel=2)
-        self.connection = await aio_pika.connect_robust(
-            host=self.rabbitmq_host,
-            login=self.rabbitmq_username,
-            password=self.rabbitmq_password,
-            virtualhost=self.rabbitmq_vhost
-        )
+        self.connection = await self.transport.connect_async(self)
         self.chanel = await self.connection.channel()
         await self.chanel.set_qos(prefetch_count=self.serverAsyncModeThreads)
 
     def connect(self):      
-        self.connection = pika.BlockingConnection(
-            pika.ConnectionParameters(
-                host=self.rabbitmq_host,
-                virtual_host=self.rabbitmq_vhost,  # Include the virtual host here
-                credentials=pika.PlainCredentials(
-                    self.rabbitmq_username, self.rabbitmq_password
-                )
-            )
-        )
+        self.connection = self.transport.connect_blocking(self)
         self.chanel = self.connection.channel()
+        if self.replyMode == "exclusive":
+            self.replyQueue = self.chanel.queue_declare(queue='', exclusive=True, auto_delete=True).method.queue
+        elif self.replyMode == "direct":
+            self.replyQueue = DIRECT_REPLY_TO_QUEUE
             
-    async def start_server(self, allowNewDialogs = False):
+    async def start_server(self, allowNewDialogs = False, concurrentDispatch = False):
+        """
+        Consume the input queue and pass every incoming dialog to message_received_callback.
+        :param allowNewDialogs: Accept dialogs which are not in self.dialogs yet (agents) or only replies to known ones (clients).
+        :param concurrentDispatch: Run up to serverAsyncModeThreads callbacks at once. Messages of the same dialog_id
+                                   are still processed strictly in the order they were received, different dialogs run in parallel.
+        """
         try:
+            self._serverStopping = False
             await self.connect_to_mycelium()
+            if self.affinity is not None:
+                await self.affinity.serve(self, allowNewDialogs, concurrentDispatch)
+                return
             queue = await self.chanel.declare_queue(self.input_chanel)
+            if concurrentDispatch:
+                self._dispatchSlots = asyncio.Semaphore(max(1, self.serverAsyncModeThreads))
+                self._dialogTails = {}
             async with queue.iterator() as queue_iter:
                 async for message in queue_iter:
+                    if self._serverStopping:
+                        break #Not acknowledged, the broker gives it to another consumer
+                    self._messagesInProgress += 1
                     await message.ack()
-                    try:                        
-                        headers = message.headers
-                        dialog = Dialog(reply_to=message.reply_to, dialog_id=message.correlation_id)
-                        dialog_id = dialog.dialog_id #We use it further to find the dialog after adding to self.dialogs.
-                        if dialog_id in self.dialogs:
-                            dialog.decompress_and_deserialize(message.body)
-                            self.dialogs[dialog_id].messages += dialog.messages
-                            self.dialogs[dialog_id].requestAgentConfig = dialog.requestAgentConfig
-                        elif dialog_id not in self.dialogs and allowNewDialogs:
-                            dialog.decompress_and_deserialize(message.body)
-                            self.dialogs[dialog_id] = dialog
-                        else:
-                            continue
-                        # Updating billing data to apply new bills from Router
-                        lastMessageBillingData = json.loads(message.headers.get("billingData", []))
-                        self.lastReceivedMessageBillingData[dialog_id] = lastMessageBillingData
-                        if self.dialogs[dialog_id].messages:
-                            self.dialogs[dialog_id].messages[-1].billingData = lastMessageBillingData
-                            diagnosticData = headers.get('diagnosticData', None)
-                            if diagnosticData:
-                                self.dialogs[dialog_id].messages[-1].diagnosticData = diagnosticData
-                        self.dialogs[dialog_id]._update_totals()
-                        if self.message_received_callback:
-                            if await self.message_received_callback(dialog):
-                                self.dialogs[dialog_id]._update_totals() #We call it for the 2nd time to update after possible manipulations in message_received_callback()
-                            else:
-                                self.dialogs = {}
-                    except Exception as process_ex:
-                        print(f"Error processing message: {process_ex}")
+                    if concurrentDispatch:
+                        # Blocks the consumer when all the slots are busy, so we never hold more than serverAsyncModeThreads messages in memory.
+                        await self._dispatchSlots.acquire()
+                        self._dispatch_in_dialog_order(message, allowNewDialogs)
+                    else:
+                        try:
+                            await self._process_incoming_message(message, allowNewDialogs)
+                        finally:
+                            self._messagesInProgress -= 1
+            if concurrentDispatch and self._dialogTails:
+                await asyncio.wait(list(self._dialogTails.values()))
         except Exception as ex:
             print("Failed to start server. Error: " + str(ex))
+
+    def stop_server(self):
+        """
+        Graceful stop: start_server() returns when the dialog in progress (all of them with concurrentDispatch) is processed and
+        the next message arrives, which is left to the other consumers of the queue. Cancel start_server() when the queue is idle.
+        """
+        self._serverStopping = True
+
+    @property
+    def is_processing(self):
+        """True while start_server() holds received messages which are not processed yet."""
+        return self._messagesInProgress > 0
+
+    def _dispatch_in_dialog_order(self, message, allowNewDialogs):
+        dialog_id = message.correlation_id
+        previous = self._dialogTails.get(dialog_id)
+
+        async def run_after_previous():
+            try:
+                if previous is not None:
+                    await asyncio.wait([previous])
+                await self._process_incoming_message(message, allowNewDialogs)
+            finally:
+                self._dispatchSlots.release()
+                self._messagesInProgress -= 1
+                if self._dialogTails.get(dialog_id) is task:
+                    del self._dialogTails[dialog_id]
+
+        task = asyncio.ensure_future(run_after_previous())
+        self._dialogTails[dialog_id] = task
+        return task
+
+    async def _process_incoming_message(self, message, allowNewDialogs):
+        followers = self._take_coalesced_followers(message.correlation_id) if self._inFlightSendKeys else []
+        decoded = None #The reply as it was received, kept for the followers before the callback can change it
+        try:
+            headers = message.headers
+            dialog = Dialog(reply_to=message.reply_to, dialog_id=message.correlation_id)
+            dialog_id = dialog.dialog_id #We use it further to find the dialog after adding to self.dialogs.
+            if headers.get('streamRequested'):
+                self._streamRequests.add(dialog_id)
+            if dialog_id in self._deltaSent:
+                # Every reply tells which version the receiver holds, no acknowledgement means the next send must be a full one
+                self._deltaSent[dialog_id].acknowledged = headers.get('dialogVersionAck')
+            codec = headers.get(CODEC_HEADER)
+            if dialog_id not in self.dialogs and not allowNewDialogs:
+                return
+            if isinstance(message, _CoalescedReply) and message.decoded is not None:
+                message.copy_into(dialog)
+            else:
+                await self.decode_dialog(dialog, message.body, codec)
+            if followers:
+                decoded = copy.copy(dialog)
+                decoded.messages = [received.copy(copyPrompts=True) for received in dialog.messages]
+            if dialog_id in self.dialogs:
+                dialog.dialog_id = dialog_id #A reply shared by coalesced dialogs carries the id of the one which was sent
+                self._apply_delta(dialog, headers)
+                self.dialogs[dialog_id].messages += dialog.messages
+                self.dialogs[dialog_id].requestAgentConfig = dialog.requestAgentConfig
+            else:
+                self._apply_delta(dialog, headers)
+                self.dialogs[dialog_id] = dialog
+            self.dialogs[dialog_id].wireCodec = codec
+            # Updating billing data to apply new bills from Router
+            lastMessageBillingData = json.loads(message.headers.get("billingData", []))
+            self.lastReceivedMessageBillingData[dialog_id] = lastMessageBillingData
+            if self.dialogs[dialog_id].messages:
+                self.dialogs[dialog_id].messages[-1].billingData = lastMessageBillingData
+                diagnosticData = headers.get('diagnosticData', None)
+                if diagnosticData:
+                    self.dialogs[dialog_id].messages[-1].diagnosticData = diagnosticData
+            self.dialogs[dialog_id]._update_totals()
+            if self.message_received_callback:
+                if await self.message_received_callback(dialog):
+                    if dialog_id in self.dialogs:
+                        self.dialogs[dialog_id]._update_totals() #We call it for the 2nd time to update after possible manipulations in message_received_callback()
+                else:
+                    # Only the finished dialog is dropped, other users keep their context. In the concurrent mode other dialogs may be in the middle of processing.
+                    self.dialogs.pop(dialog_id, None)
+                    self.lastReceivedMessageBillingData.pop(dialog_id, None)
+        except Exception as process_ex:
+            print(f"Error processing message: {process_ex}")
+        finally:
+            for follower_id in followers:
+                await self._process_incoming_message(_CoalescedReply.for_follower(message, follower_id, decoded), allowNewDialogs)
             
+    def _apply_delta(self, dialog, headers):
+        """Rebuilds the full dialog from a delta and remembers the result, so the next delta can be based on it."""
+        version = headers.get('dialogVersion')
+        if version is None:
+            return
+        baseVersion = headers.get('dialogBaseVersion')
+        if baseVersion is None:
+            history = DialogVersionHistory()
+            messages = list(dialog.messages)
+        else:
+            history = self.deltaCache.get(dialog.dialog_id)
+            base = history.versions.get(baseVersion) if history else None
+            if base is None:
+                print(f"{str(datetime.now())} Dialog {dialog.dialog_id}: the base version {baseVersion} of the delta is unknown, only the new messages are processed")
+                self.deltaCache.pop(dialog.dialog_id, None) #The reply goes without acknowledgement, so the sender falls back to a full dialog
+                return
+            messages = base[headers.get('dialogBaseDrop', 0):] + dialog.messages
+        history.add(version, messages)
+        history.endUserCommunicationID = dialog.endUserCommunicationID
+        self.deltaCache[dialog.dialog_id] = history
+        # The cached messages are kept intact whatever the callback does with the dialog
+        dialog.messages = [message.copy() for message in messages]
+        dialog._update_totals()
+
+    def _make_delta(self, dialog):
+        """Returns (the dialog to send, extra headers) and records the version being sent."""
+        history = self._deltaSent.get(dialog.dialog_id)
+        if history is None:
+            history = DialogVersionHistory()
+        version = history.latest_version() + 1
+        headers = {'dialogVersion': version}
+        toSend = dialog
+        base = history.versions.get(history.acknowledged) if history.acknowledged is not None else None
+        if base and dialog.messages:
+            # Messages are compared by identity. Dropping the oldest messages is fine, anything else makes a full send.
+            drop = next((i for i, message in enumerate(base) if message is dialog.messages[0]), None)
+            if drop is not None and len(dialog.messages) > len(base) - drop and all(a is b for a, b in zip(base[drop:], dialog.messages)):
+                toSend = copy.copy(dialog)
+                toSend.messages = dialog.messages[len(base) - drop:]
+                headers['dialogBaseVersion'] = history.acknowledged
+                headers['dialogBaseDrop'] = drop
+        history.add(version, list(dialog.messages))
+        self._deltaSent[dialog.dialog_id] = history
+        return toSend, headers
+
+    async def encode_dialog(self, dialog, codec = None):
+        """:param codec: The codec name, self.codec when None."""
+        codec = codec if codec is not None else self.codec
+        if self.codecOffloadThreshold is not None and dialog.estimated_size() >= self.codecOffloadThreshold:
+            return await dialog.serialize_and_compress_async(self.codecExecutor, self.blobStore, codec)
+        return dialog.serialize_and_compress(self.blobStore, codec)
+
+    async def decode_dialog(self, dialog, body, codec = None):
+        """:param codec: The codec name from the myceliumCodec header, None for the legacy format."""
+        if self.codecOffloadThreshold is not None and len(body) >= self.codecOffloadThreshold:
+            await dialog.decompress_and_deserialize_async(body, self.codecExecutor, self.blobStore, codec)
+        else:
+            dialog.decompress_and_deserialize(body, self.blobStore, codec)
+
     async def ensure_connected(self):
         if not self.connection or self.connection.is_closed:
             await self.connectAsync()  # Assumes connectAsync() is your method to asynchronously connect
@@ -714,32 +1348,52 @@ class Mycelium:
         if isReply:
             if self.dialogs[dialog_id].reply_to == None:
                 raise DialogDoesNotSupportReplies()
-            routingStrategy = RoutingStrategy("direct", self.dialogs[dialog_id].reply_to)
-            temp_dialog = copy.deepcopy(self.dialogs[dialog_id])
+            routingStrategy = RoutingStrategy.interned("direct", self.dialogs[dialog_id].reply_to)
+            temp_dialog = self.dialogs[dialog_id].copy() #Only the messages changed below are copied, the prompts are never duplicated
             if newestMessagesToSend > len(temp_dialog.messages) - 1:
                 #We can't send more messages than we have - the one we received to reply to
                 newestMessagesToSend = len(temp_dialog.messages) - 1
             
             if autogenerateRoutingStrategies:
-                temp_dialog.messages = temp_dialog.messages[-newestMessagesToSend:]
+                temp_dialog.messages = [msg.copy() for msg in temp_dialog.messages[-newestMessagesToSend:]]
                 for msg in temp_dialog.messages:
-                    msg.routingStrategy = RoutingStrategy("direct", temp_dialog.reply_to)
+                    msg.routingStrategy = RoutingStrategy.interned("direct", temp_dialog.reply_to)
+            else:
+                temp_dialog.messages[-1] = temp_dialog.messages[-1].copy()
             tmpBillingData = tmpBillingData = self.lastReceivedMessageBillingData.get(dialog_id, [])
             tmpBillingData.extend(temp_dialog.messages[-1].billingData)
             temp_dialog.messages[-1].billingData = tmpBillingData
             last_message.billingData = tmpBillingData
-            compressed_dialog = temp_dialog.serialize_and_compress()
+            # The requester may be a peer which only knows the legacy format, so the reply goes in the codec of the request
+            codec = self.dialogs[dialog_id].wireCodec or LEGACY_CODEC
+            compressed_dialog = await self.encode_dialog(temp_dialog, codec)
         else:
+            codec = self.codec
             if self.dialogs[dialog_id].reply_to == None:
                 self.dialogs[dialog_id].reply_to = self.input_chanel
             routingStrategy = last_message.routingStrategy
-            compressed_dialog = self.dialogs[dialog_id].serialize_and_compress()
+            if self.coalesceRequests and self._join_in_flight_send(dialog_id, routingStrategy):
+                return
+            if self.deltaTransmission:
+                toSend, deltaHeaders = self._make_delta(self.dialogs[dialog_id])
+                compressed_dialog = await self.encode_dialog(toSend)
+            else:
+                compressed_dialog = await self.encode_dialog(self.dialogs[dialog_id])
         headers = {
             'billingData' : json.dumps(last_message.billingData),
             'routingStrategy' : routingStrategy.to_json(),
             'endUserCommunicationID' : self.dialogs[dialog_id].endUserCommunicationID,
-            'subAccount' : last_message.subAccount
+            'subAccount' : last_message.subAccount,
+            CODEC_HEADER : codec
         }
+        if not isReply and self.deltaTransmission:
+            headers.update(deltaHeaders)
+        if isReply and dialog_id in self.deltaCache:
+            headers['dialogVersionAck'] = self.deltaCache[dialog_id].latest_version()
+        if isReply and dialog_id in self._streamRequests:
+            # The full reply closes the stream and tells the client how many chunks were sent
+            self._streamRequests.discard(dialog_id)
+            headers['streamChunks'] = self._streamSequences.pop(dialog_id, 0)
         if last_message.diagnosticData is not None:
             headers['diagnosticData'] = last_message.diagnosticData
         if self.dialogs[dialog_id].requestAgentConfig is not None:
@@ -759,20 +1413,156 @@ class Mycelium:
         except Exception as e:
             print(f"Failed to sort connection problem by reconnecting: {e}")
     
+    def _join_in_flight_send(self, dialog_id, routingStrategy):
+        """Returns True when an identical dialog is waiting for its reply, then the dialog will get a copy of it. Otherwise registers the dialog."""
+        now = time.monotonic()
+        while self._inFlightSends:
+            key, (leader_id, deadline, followers) = next(iter(self._inFlightSends.items()))
+            if deadline > now:
+                break
+            del self._inFlightSends[key]
+            self._inFlightSendKeys.pop(leader_id, None)
+        if dialog_id in self._inFlightSendKeys:
+            return False #Still waiting for the reply to its previous request, which the joined dialogs wait for as well
+        dialog = self.dialogs[dialog_id]
+        key = dialog.content_hash(routingStrategy.to_json(), dialog.requestAgentConfig)
+        flight = self._inFlightSends.get(key)
+        if flight is not None:
+            flight[2].append(dialog_id)
+            return True
+        self._inFlightSends[key] = (dialog_id, now + self.coalesceTimeout, [])
+        self._inFlightSendKeys[dialog_id] = key
+        return False
+
+    def _take_coalesced_followers(self, dialog_id):
+        key = self._inFlightSendKeys.pop(dialog_id, None)
+        if key is None:
+            return []
+        flight = self._inFlightSends.pop(key, None)
+        return flight[2] if flight is not None else []
+
+    async def _ensure_reply_consumer(self):
+        if self._replyConsumerLock is None:
+            self._replyConsumerLock = asyncio.Lock()
+        async with self._replyConsumerLock:
+            if self.replyConnection and not self.replyConnection.is_closed:
+                return
+            self.replyConnection = await self.transport.connect_async(self)
+            self.replyChanel = await self.replyConnection.channel()
+            await self.replyChanel.set_qos(prefetch_count=self.serverAsyncModeThreads)
+            if self.replyMode == "direct":
+                queue = await self.replyChanel.get_queue(DIRECT_REPLY_TO_QUEUE, ensure=False)
+                await queue.consume(self._on_async_reply, no_ack=True)
+            else:
+                if self.replyMode == "exclusive":
+                    queue = await self.replyChanel.declare_queue(exclusive=True, auto_delete=True)
+                else:
+                    queue = await self.replyChanel.declare_queue(self.input_chanel)
+                await queue.consume(self._on_async_reply)
+            self.asyncReplyQueue = queue.name
+
+    async def send_stream_chunk(self, dialog_id, content, content_type = "text", mime_type = None):
+        """
+        Server side. Sends a partial result (a text token, an audio frame etc.) to the client which awaits the dialog with Agent.StreamAsync.
+        Chunks are numbered per dialog, the stream is closed by the usual send_to_mycelium(dialog_id, isReply=True).
+        Returns False and sends nothing when the client didn't ask for streaming, so it's safe to call it for any request.
+        :param content: str for the "text" content_type, bytes for stream_of_bytes, stream_audio and stream_video.
+        """
+        if dialog_id not in self._streamRequests:
+            return False
+        if content_type not in STREAM_CHUNK_DEFAULT_MIME_TYPES:
+            raise InvalidPromptException(f"Stream chunk content_type must be one of {list(STREAM_CHUNK_DEFAULT_MIME_TYPES.keys())}.")
+        if not isinstance(content, str if content_type == "text" else bytes):
+            raise InvalidPromptException("Stream chunk content must be a string for text chunks and bytes for others.")
+        if not self.chanel:
+            await self.connect_to_mycelium()
+        dialog = self.dialogs[dialog_id]
+        if dialog.reply_to == None:
+            raise DialogDoesNotSupportReplies()
+        sequence = self._streamSequences.get(dialog_id, 0)
+        self._streamSequences[dialog_id] = sequence + 1
+        headers = {
+            'billingData' : json.dumps([]),
+            'routingStrategy' : RoutingStrategy.interned("direct", dialog.reply_to).to_json(),
+            'endUserCommunicationID' : dialog.endUserCommunicationID,
+            'streamSequence' : sequence,
+            'streamContentType' : content_type,
+            'streamMimeType' : mime_type if mime_type else STREAM_CHUNK_DEFAULT_MIME_TYPES[content_type]
+        }
+        # Chunks are raw bytes with no Dialog envelope to keep the time to the first token low
+        body = content.encode() if content_type == "text" else content
+        message = aio_pika.Message(body=body, correlation_id=str(dialog_id), headers=headers, reply_to=dialog.reply_to)
+        await self.ensure_connected()
+        await self.chanel.default_exchange.publish(message, routing_key=self.output_chanel)
+        return True
+
+    async def _on_async_reply(self, message):
+        if self.replyMode != "direct":
+            await message.ack()
+        stream = self._pendingStreams.get(message.correlation_id)
+        if stream is not None:
+            await self._on_stream_message(stream, message)
+            return
+        future = self._pendingReplies.get(message.correlation_id)
+        if future is None or future.done():
+            return #Not ours or already timed out, the same way the sync consumer drops unknown dialogs.
+        try:
+            reply = Dialog(reply_to=message.reply_to, dialog_id=message.correlation_id)
+            await self.decode_dialog(reply, message.body, (message.headers or {}).get(CODEC_HEADER))
+            future.set_result(reply)
+        except Exception as ex:
+            future.set_exception(ex)
+
+    async def _on_stream_message(self, stream, message):
+        headers = message.headers or {}
+        try:
+            if headers.get('streamSequence') is not None:
+                content_type = headers.get('streamContentType', 'stream_of_bytes')
+                content = message.body.decode() if content_type == "text" else bytes(message.body)
+                stream.put_nowait(("chunk", headers['streamSequence'], UnifiedPrompt(content_type=content_type, content=content, mime_type=headers.get('streamMimeType'))))
+            else:
+                reply = Dialog(reply_to=message.reply_to, dialog_id=message.correlation_id)
+                await self.decode_dialog(reply, message.body, headers.get(CODEC_HEADER))
+                stream.put_nowait(("final", headers.get('streamChunks'), reply))
+        except Exception as ex:
+            stream.put_nowait(("error", None, ex))
+
+    async def publish_async(self, body, correlation_id, headers, reply_to):
+        message = aio_pika.Message(body=body, correlation_id=correlation_id, headers=headers, reply_to=reply_to)
+        try:
+            await self._ensure_reply_consumer()
+            await self.replyChanel.default_exchange.publish(message, routing_key=self.output_chanel)
+        except aio_pika.exceptions.AMQPConnectionError as e:
+            print(f"Connection error detected: {e}. Attempting to reconnect...")
+            self.replyConnection = None
+            await self._ensure_reply_consumer()
+            await self.replyChanel.default_exchange.publish(message, routing_key=self.output_chanel)  # Retry publishing
+
     async def close(self):
-        await self.connection.close()
+        if self.replyConnection and not self.replyConnection.is_closed:
+            await self.replyConnection.close()
+        if self.connection:
+            await self.connection.close()
         
 class Agent:
-    def __init__(self, mycelium, service, serviceParams = "", timeoutOfSyncRequest = 600):
+    def __init__(self, mycelium, service, serviceParams = "", timeoutOfSyncRequest = 600, batchMode = False, maxInFlight = 100, itemTimeout = None,
+                 responseCache = None):
         self.mycelium = mycelium
         self.service = service
         self.serviceParams = serviceParams
         self.timeoutOfSyncRequest = timeoutOfSyncRequest
+        self.batchMode = batchMode #When True a list of dialogs is published up front and the replies are collected as they arrive.
+        self.maxInFlight = maxInFlight
+        self.itemTimeout = itemTimeout #Batch mode only. Seconds to wait for every single reply, timeoutOfSyncRequest when None.
+        # Optional ResponseCache.ResponseCache. Invoke and InvokeAsync answer repeated requests from it without sending them, None disables it.
+        self.responseCache = responseCache
         
     def __rrshift__(self, other):
         return self.Invoke(other)
         
     def PurgeAwaitingIncomeMessages(self):
+        if self.mycelium.replyMode != "shared":
+            return #Private reply queues only ever get our own replies, there is nothing to purge.
         if not self.mycelium.connection:
             self.mycelium.connect()
         try:
@@ -781,7 +1571,8 @@ class Agent:
             print(str(datetime.now()) + " Error purging awaiting messages: " + str(ex))
         
     def Invoke(self, dialogs):
-        dialogs = copy.deepcopy(dialogs)
+        # Copy-on-write copies, the replies are added to the copies and the input dialogs stay as they were
+        dialogs = [dialog.copy() if isinstance(dialog, Dialog) else dialog for dialog in dialogs] if isinstance(dialogs, list) else (dialogs.copy() if isinstance(dialogs, Dialog) else dialogs)
         # Conceptual point. If the imput type is Dialog, we return a Dialog
         # But if it's a list of dialogs, we retrun a list of Dialog
         errorMessage = "Only a Dialog object, a string or a list of dialog objects/strings can be processed"
@@ -792,7 +1583,12 @@ class Agent:
             result = self.__Process(dialogs)
         if isinstance(dialogs, str):
             result = self.__Process(Dialog.Create(dialogs))
-        if isinstance (dialogs, list):
+        if isinstance (dialogs, list) and self.batchMode:
+            for dialog in dialogs:
+                if not isinstance(dialog, Dialog) and not isinstance(dialog, str):
+                    raise TypeError(errorMessage)
+            result = self.__ProcessBatch([dialog if isinstance(dialog, Dialog) else Dialog.Create(dialog) for dialog in dialogs])
+        elif isinstance (dialogs, list):
             resultDialogs = []
             for dialog in dialogs:
                 if isinstance(dialog, Dialog):
@@ -804,34 +1600,144 @@ class Agent:
             result = resultDialogs
         return result
     
-    def __Process(self, dialog) -> Dialog:     
-        errorMessage = "Only a Dialog object or a list of dialog class objects can be processed"
-        if not isinstance(dialog, Dialog):
+    async def InvokeAsync(self, dialogs):
+        """
+        Asynchronous version of Invoke. All the requests share one long-lived consumer of the reply queue
+        and are matched with their replies by correlation_id, so any number of them can be awaited at once.
+        """
+        # Every list item is copied on its own, the same dialog passed twice must become two independent requests.
+        dialogs = [dialog.copy() if isinstance(dialog, Dialog) else dialog for dialog in dialogs] if isinstance(dialogs, list) else (dialogs.copy() if isinstance(dialogs, Dialog) else dialogs)
+        errorMessage = "Only a Dialog object, a string or a list of dialog objects/strings can be processed"
+        if not isinstance(dialogs, Dialog) and not isinstance(dialogs, str) and not isinstance(dialogs, list):
             raise TypeError (errorMessage)
+        if isinstance(dialogs, Dialog):
+            return await self.__ProcessAsync(dialogs)
+        if isinstance(dialogs, str):
+            return await self.__ProcessAsync(Dialog.Create(dialogs))
+        for dialog in dialogs:
+            if not isinstance(dialog, Dialog) and not isinstance(dialog, str):
+                raise TypeError(errorMessage)
+        return list(await asyncio.gather(*[self.__ProcessAsync(dialog if isinstance(dialog, Dialog) else Dialog.Create(dialog)) for dialog in dialogs]))
 
-        if not self.mycelium.connection or not self.mycelium.connection.is_open:
-            self.mycelium.connect()
+    async def __ProcessAsync(self, dialog) -> Dialog:
+        if not isinstance(dialog, Dialog):
+            raise TypeError ("Only a Dialog object or a list of dialog class objects can be processed")
+        requestKey = self.__RequestKey(dialog)
+        if self.__ReplyFromCache(dialog, requestKey):
+            return dialog
+        flight = self.mycelium._inFlightRequests.get(requestKey) if self.mycelium.coalesceRequests else None
+        if flight is not None:
+            # An identical request is waiting for its reply, this one gets a copy of it
+            result = await asyncio.shield(flight)
+            if isinstance(result, Exception):
+                raise result
+            if result is not None:
+                self.__AddReply(dialog, [message.copy() for message in result[0]], result[1])
+            return dialog
+        if self.mycelium.coalesceRequests:
+            flight = self.mycelium._inFlightRequests[requestKey] = asyncio.get_running_loop().create_future()
+        messageCount = len(dialog.messages)
+        result = None #(reply messages, requestAgentConfig) for the joined requests, None when there is no reply
+        try:
+            await self.mycelium._ensure_reply_consumer()
+            if dialog.dialog_id in self.mycelium._pendingReplies:
+                # The reply is matched by dialog_id, so a copy of a dialog which is already in flight needs its own id.
+                dialog.dialog_id = str(uuid.uuid4())
+            headers = self.__PrepareRequest(dialog, self.mycelium.asyncReplyQueue)
+            future = asyncio.get_running_loop().create_future()
+            self.mycelium._pendingReplies[dialog.dialog_id] = future
+            try:
+                await self.mycelium.publish_async(await self.mycelium.encode_dialog(dialog), str(dialog.dialog_id), headers, dialog.reply_to)
+                reply = await asyncio.wait_for(future, self.timeoutOfSyncRequest)
+                dialog.messages += reply.messages
+                dialog.requestAgentConfig = reply.requestAgentConfig
+                dialog._update_totals()
+                self.__CacheReply(requestKey, dialog, messageCount)
+                result = (dialog.messages[messageCount:], dialog.requestAgentConfig)
+            except asyncio.TimeoutError:
+                print(f"{str(datetime.now())} No reply for dialog {dialog.dialog_id} in {self.timeoutOfSyncRequest} seconds")
+            finally:
+                self.mycelium._pendingReplies.pop(dialog.dialog_id, None)
+        except Exception as ex:
+            result = ex
+            raise
+        finally:
+            if flight is not None:
+                self.mycelium._inFlightRequests.pop(requestKey, None)
+                flight.set_result(result)
+        return dialog
 
-        self.PurgeAwaitingIncomeMessages()
+    def __RequestKey(self, dialog):
+        """The hash of what the service gets, None when neither the response cache nor coalescing needs it."""
+        if self.responseCache is None and not self.mycelium.coalesceRequests:
+            return None
+        # The same config __PrepareRequest sends
+        config = self.serviceParams if self.serviceParams != "" and self.serviceParams is not None else dialog.requestAgentConfig
+        return dialog.content_hash(self.service, config)
+
+    def __AddReply(self, dialog, messages, requestAgentConfig):
+        """Adds a reply which was not received for this dialog (cached or shared) as if it came from the agent."""
+        dialog.messages += messages
+        dialog.requestAgentConfig = requestAgentConfig
+        dialog._update_totals()
+        self.mycelium.dialogs[dialog.dialog_id] = dialog
+
+    def __ReplyFromCache(self, dialog, requestKey):
+        """Adds the cached reply to the dialog. Returns False when there is none."""
+        if self.responseCache is None or requestKey is None:
+            return False
+        cached = self.responseCache.get(requestKey)
+        if cached is None:
+            return False
+        self.__AddReply(dialog, *cached)
+        return True
 
+    def __CacheReply(self, requestKey, dialog, messageCount):
+        if self.responseCache is None or requestKey is None or dialog is None:
+            return
+        reply = dialog.messages[messageCount:]
+        # No reply means a timeout, diagnosticData is how agents report errors, neither is worth repeating
+        if reply and not any(message.diagnosticData for message in reply):
+            self.responseCache.put(requestKey, reply, dialog.requestAgentConfig)
+
+    def __PrepareRequest(self, dialog, replyTo):
         # Define headers
         headers = {
             'billingData': json.dumps([]),
-            'routingStrategy': RoutingStrategy(strategy="direct", params=self.service).to_json(),
+            'routingStrategy': RoutingStrategy.interned(strategy="direct", params=self.service).to_json(),
+            CODEC_HEADER: self.mycelium.codec
         }
-        dialog.lastMessageRoutingStrategy = RoutingStrategy(strategy="direct", params=self.service)
+        dialog.lastMessageRoutingStrategy = RoutingStrategy.interned(strategy="direct", params=self.service)
         
         if self.serviceParams != "" and self.serviceParams is not None:
             dialog.requestAgentConfig = self.serviceParams
             headers['requestAgentConfig'] = json.dumps(self.serviceParams)
 
         # Put the dialog into Mycelium and add relevant reply_to
-        dialog.reply_to = self.mycelium.input_chanel
+        dialog.reply_to = replyTo
         self.mycelium.dialogs[dialog.dialog_id] = dialog
+        return headers
+
+    def __Process(self, dialog) -> Dialog:     
+        errorMessage = "Only a Dialog object or a list of dialog class objects can be processed"
+        if not isinstance(dialog, Dialog):
+            raise TypeError (errorMessage)
+        requestKey = self.__RequestKey(dialog)
+        if self.__ReplyFromCache(dialog, requestKey):
+            return dialog
+        messageCount = len(dialog.messages)
+
+        if not self.mycelium.connection or not self.mycelium.connection.is_open:
+            self.mycelium.connect()
+
+        self.PurgeAwaitingIncomeMessages()
+
+        headers = self.__PrepareRequest(dialog, self.mycelium.replyQueue)
+        autoAck = self.mycelium.replyMode == "direct" #Direct reply-to only works in no-ack mode
         
         # Place message
         properties = pika.BasicProperties(
-            reply_to=self.mycelium.input_chanel,
+            reply_to=self.mycelium.replyQueue,
             correlation_id=str(dialog.dialog_id),
             headers=headers
         )
@@ -839,15 +1745,38 @@ class Agent:
             self.mycelium.chanel.basic_publish(
                 exchange='',
                 routing_key=self.mycelium.output_chanel,
-                body=dialog.serialize_and_compress(),
+                body=dialog.serialize_and_compress(self.mycelium.blobStore, self.mycelium.codec),
                 properties=properties
             )
+        def callback(ch, method, properties, body):
+            if not autoAck:
+                ch.basic_ack(delivery_tag=method.delivery_tag)
+            if properties.correlation_id != str(dialog.dialog_id):
+                return #A late reply to a request which timed out, the reply to this one is still to come
+            new_dialog = Dialog(reply_to=properties.reply_to, dialog_id=properties.correlation_id)
+            dialog_id = new_dialog.dialog_id
+            if dialog_id in self.mycelium.dialogs:
+                new_dialog.decompress_and_deserialize(body, self.mycelium.blobStore, (properties.headers or {}).get(CODEC_HEADER))
+                self.mycelium.dialogs[dialog_id].messages += new_dialog.messages
+                self.mycelium.dialogs[dialog_id].requestAgentConfig = new_dialog.requestAgentConfig
+            self.mycelium.chanel.stop_consuming()
+
+        def TrySubscribe():
+            # Subscribing before publishing, direct reply-to requires it and a fast reply can't be missed.
+            self.mycelium.chanel.basic_consume(queue=self.mycelium.replyQueue, on_message_callback=callback, auto_ack=autoAck)
         def TryConsume():
             def stop_consuming():
-                self.mycelium.channel.stop_consuming()
-            self.mycelium.connection.call_later(self.timeoutOfSyncRequest, stop_consuming)
-            self.mycelium.chanel.basic_consume(queue=self.mycelium.input_chanel, on_message_callback=callback, auto_ack=False)
+                self.mycelium.chanel.stop_consuming()
+            timer = self.mycelium.connection.call_later(self.timeoutOfSyncRequest, stop_consuming)
             self.mycelium.chanel.start_consuming()
+            self.mycelium.connection.remove_timeout(timer) #Otherwise it would stop one of the next requests
+
+        try:
+            TrySubscribe()
+        except pika.exceptions.AMQPError:
+            self.mycelium.connect()
+            properties.reply_to = dialog.reply_to = self.mycelium.replyQueue
+            TrySubscribe()
 
         try:
             TryPublish(self, dialog, properties)
@@ -857,16 +1786,6 @@ class Agent:
         except Exception as e:
             print(f"{str(datetime.now())} Unexpected error during PUBLISH stage connection check: {e}")
 
-        def callback(ch, method, properties, body):
-            new_dialog = Dialog(reply_to=properties.reply_to, dialog_id=properties.correlation_id)
-            dialog_id = new_dialog.dialog_id
-            if dialog_id in self.mycelium.dialogs:
-                new_dialog.decompress_and_deserialize(body)
-                self.mycelium.dialogs[dialog_id].messages += new_dialog.messages
-                self.mycelium.dialogs[dialog_id].requestAgentConfig = new_dialog.requestAgentConfig
-            ch.basic_ack(delivery_tag=method.delivery_tag)
-            self.mycelium.chanel.stop_consuming()
-
         try:
             TryConsume()
         except aio_pika.exceptions.AMQPError as e:
@@ -875,15 +1794,164 @@ class Agent:
         except Exception as e:
             print(f"{str(datetime.now())} Unexpected error during CONSUME stage connection check: {e}")
         
+        self.__CacheReply(requestKey, self.mycelium.dialogs.get(dialog.dialog_id), messageCount)
         return self.mycelium.dialogs.get(dialog.dialog_id)
     
+    def __ProcessBatch(self, dialogs):
+        """
+        Publishes the dialogs without waiting for each reply, keeping at most maxInFlight of them unanswered.
+        Replies are matched by correlation_id, so the total time is defined by the slowest reply, not by the sum of them.
+        The result keeps the input order. A dialog with no reply in itemTimeout seconds is returned as is.
+        """
+        requests = {} #id(dialog) -> (request key, message count) of the dialogs which are sent
+        toPublish = []
+        leaders = {} #Request key -> the dialog sent for it, when coalescing
+        followers = {} #id(dialog) -> identical dialogs which get copies of its reply instead of being sent
+        for dialog in dialogs:
+            requestKey = self.__RequestKey(dialog)
+            if self.__ReplyFromCache(dialog, requestKey):
+                continue
+            if self.mycelium.coalesceRequests:
+                if requestKey in leaders:
+                    followers[id(leaders[requestKey])].append(dialog)
+                    continue
+                leaders[requestKey] = dialog
+                followers[id(dialog)] = []
+            requests[id(dialog)] = (requestKey, len(dialog.messages))
+            toPublish.append(dialog)
+        if not toPublish:
+            return dialogs
+        if not self.mycelium.connection or not self.mycelium.connection.is_open:
+            self.mycelium.connect()
+        self.PurgeAwaitingIncomeMessages()
+        itemTimeout = self.itemTimeout if self.itemTimeout is not None else self.timeoutOfSyncRequest
+        maxInFlight = max(1, self.maxInFlight) if self.maxInFlight else len(dialogs)
+        pending = {} # correlation_id -> deadline
+        nextToPublish = 0
+
+        def publish(dialog):
+            if dialog.dialog_id in pending:
+                # The reply is matched by dialog_id, so a copy of a dialog which is already in flight needs its own id.
+                dialog.dialog_id = str(uuid.uuid4())
+            headers = self.__PrepareRequest(dialog, self.mycelium.replyQueue)
+            properties = pika.BasicProperties(reply_to=dialog.reply_to, correlation_id=str(dialog.dialog_id), headers=headers)
+            body = dialog.serialize_and_compress(self.mycelium.blobStore, self.mycelium.codec)
+            try:
+                self.mycelium.chanel.basic_publish(exchange='', routing_key=self.mycelium.output_chanel, body=body, properties=properties)
+            except pika.exceptions.AMQPConnectionError:
+                self.mycelium.connect()
+                self.mycelium.chanel.basic_publish(exchange='', routing_key=self.mycelium.output_chanel, body=body, properties=properties)
+            pending[str(dialog.dialog_id)] = time.monotonic() + itemTimeout
+
+        def callback(ch, method, properties, body):
+            if not autoAck:
+                ch.basic_ack(delivery_tag=method.delivery_tag)
+            dialog_id = properties.correlation_id
+            if pending.pop(dialog_id, None) is None:
+                return
+            new_dialog = Dialog(reply_to=properties.reply_to, dialog_id=dialog_id)
+            new_dialog.decompress_and_deserialize(body, self.mycelium.blobStore, (properties.headers or {}).get(CODEC_HEADER))
+            self.mycelium.dialogs[dialog_id].messages += new_dialog.messages
+            self.mycelium.dialogs[dialog_id].requestAgentConfig = new_dialog.requestAgentConfig
+            self.mycelium.dialogs[dialog_id]._update_totals()
+
+        autoAck = self.mycelium.replyMode == "direct"
+        consumer_tag = self.mycelium.chanel.basic_consume(queue=self.mycelium.replyQueue, on_message_callback=callback, auto_ack=autoAck)
+        try:
+            while nextToPublish < len(toPublish) or pending:
+                while nextToPublish < len(toPublish) and len(pending) < maxInFlight:
+                    publish(toPublish[nextToPublish])
+                    nextToPublish += 1
+                now = time.monotonic()
+                for dialog_id in [dialog_id for dialog_id, deadline in pending.items() if deadline <= now]:
+                    del pending[dialog_id]
+                    print(f"{str(datetime.now())} No reply for dialog {dialog_id} in {itemTimeout} seconds")
+                if pending:
+                    self.mycelium.connection.process_data_events(time_limit=max(0, min(1, min(pending.values()) - now)))
+        finally:
+            self.mycelium.chanel.basic_cancel(consumer_tag)
+        for dialog in toPublish:
+            requestKey, messageCount = requests[id(dialog)]
+            self.__CacheReply(requestKey, dialog, messageCount)
+            reply = dialog.messages[messageCount:]
+            for follower in followers.get(id(dialog), []) if reply else []:
+                self.__AddReply(follower, [message.copy() for message in reply], dialog.requestAgentConfig)
+        return dialogs
+
     async def StreamAsync(self, dialogs):
-        return False
+        """
+        Sends a dialog and yields the partial results as the agent publishes them with Mycelium.send_stream_chunk(): UnifiedPrompt objects
+        with "text", "stream_of_bytes", "stream_audio" or "stream_video" content_type, in the order the agent sent them.
+        The generator ends with the agent's final reply, then the complete dialog is available in mycelium.dialogs[dialog.dialog_id].
+        Agents without streaming support just send the final reply, then its prompts are yielded instead of the chunks.
+        """
+        if isinstance(dialogs, str):
+            dialog = Dialog.Create(dialogs)
+        elif isinstance(dialogs, Dialog):
+            dialog = dialogs.copy()
+        else:
+            raise TypeError ("Only a Dialog object or a string can be streamed")
+        await self.mycelium._ensure_reply_consumer()
+        if dialog.dialog_id in self.mycelium._pendingReplies or dialog.dialog_id in self.mycelium._pendingStreams:
+            dialog.dialog_id = str(uuid.uuid4())
+        headers = self.__PrepareRequest(dialog, self.mycelium.asyncReplyQueue)
+        headers['streamRequested'] = True
+        stream = asyncio.Queue()
+        self.mycelium._pendingStreams[dialog.dialog_id] = stream
+        buffered = {}
+        nextSequence = 0
+        try:
+            await self.mycelium.publish_async(await self.mycelium.encode_dialog(dialog), str(dialog.dialog_id), headers, dialog.reply_to)
+            while True:
+                try:
+                    kind, value, payload = await asyncio.wait_for(stream.get(), self.timeoutOfSyncRequest)
+                except asyncio.TimeoutError:
+                    print(f"{str(datetime.now())} No stream data for dialog {dialog.dialog_id} in {self.timeoutOfSyncRequest} seconds")
+                    return
+                if kind == "error":
+                    raise payload
+                if kind == "chunk":
+                    # Chunks may overtake each other on the way, they are released strictly by their sequence numbers
+                    buffered[value] = payload
+                    while nextSequence in buffered:
+                        yield buffered.pop(nextSequence)
+                        nextSequence += 1
+                    continue
+                # The final reply tells how many chunks were sent, the ones it overtook are still awaited for a while
+                chunkCount = value or 0
+                deadline = time.monotonic() + min(self.timeoutOfSyncRequest, STREAM_CHUNK_GRACE_SECONDS)
+                while nextSequence < chunkCount:
+                    while nextSequence in buffered:
+                        yield buffered.pop(nextSequence)
+                        nextSequence += 1
+                    if nextSequence >= chunkCount:
+                        break
+                    try:
+                        kind, sequence, chunk = await asyncio.wait_for(stream.get(), max(0, deadline - time.monotonic()))
+                    except asyncio.TimeoutError:
+                        print(f"{str(datetime.now())} Stream chunks {sorted(set(range(nextSequence, chunkCount)) - set(buffered))} of dialog {dialog.dialog_id} never came")
+                        break
+                    if kind == "chunk":
+                        buffered[sequence] = chunk
+                for sequence in sorted(buffered):
+                    yield buffered[sequence]
+                if chunkCount == 0 and nextSequence == 0 and not buffered:
+                    # Not a streaming agent, the whole answer comes at once
+                    for message in payload.messages:
+                        for prompt in message.unified_prompts:
+                            yield prompt
+                dialog.messages += payload.messages
+                dialog.requestAgentConfig = payload.requestAgentConfig
+                dialog._update_totals()
+                return
+        finally:
+            self.mycelium._pendingStreams.pop(dialog.dialog_id, None)
 
 class DialogTemplate():
     def __init__(self, messages=None, context=None, reply_to = None, lastMessageDiagnosticData = None, requestAgentConfig = None,
                  lastMessageBillingData = None, endUserCommunicationID = None, lastMessageRoutingStrategy = RoutingStrategy()):
         self.dialog_id = None
+        self._compiled = None #(key, result of compile())
         self.reply_to = reply_to
         self.messages = context if context else []
         if lastMessageBillingData is None:
@@ -916,17 +1984,78 @@ class DialogTemplate():
         if len(self.messages)<1:
             raise IndexError("DialogTemplate must have at least one message.")
         if isinstance(other, dict):
-            result = Dialog.FromTemplate(self, other)
+            result = next(self.render([other]))
         elif isinstance(other, list):
-            resultDialogs = []
-            for item in other:
-                if not isinstance(item, dict):
-                    raise ValueError("Can only create Dialog(s) from DialogTemplate and dict or [dict]")
-                newDialog = Dialog.FromTemplate(self, item)
-                resultDialogs.append(newDialog)
-            result = resultDialogs
+            result = list(self.render(other))
         return result
 
+    def render(self, valueDictionaries):
+        """
+        Generator of dialogs, one per dictionary of {placeholderName : value}. Dialogs are created as they are consumed,
+        so any iterable of dictionaries (e.g. read line by line from a file) is rendered in constant memory.
+        Text prompts are new in every dialog, other prompts are shared with the template.
+        """
+        compiledMessages, placeholders = self.compile()
+        for valueDictionary in valueDictionaries:
+            if not isinstance(valueDictionary, dict):
+                raise ValueError("Can only create Dialog(s) from DialogTemplate and dict or [dict]")
+            missing_placeholders = placeholders - valueDictionary.keys()
+            if missing_placeholders:
+                raise ValueError(f"Missing replacement for placeholders: {', '.join(missing_placeholders)}")
+            messages = []
+            for message, compiledPrompts in compiledMessages:
+                rendered = message.copy()
+                rendered.unified_prompts = [prompt if segments is False else self._render_prompt(prompt, segments, valueDictionary) for prompt, segments in compiledPrompts]
+                messages.append(rendered)
+            yield Dialog(dialog_id = self.dialog_id, messages = messages, reply_to = self.reply_to,
+                         lastMessageDiagnosticData = self.lastMessageDiagnosticData, requestAgentConfig = self.requestAgentConfig,
+                         lastMessageBillingData = self.lastMessageBillingData, endUserCommunicationID = self.endUserCommunicationID,
+                         lastMessageRoutingStrategy= self.lastMessageRoutingStrategy)
+
+    def compile(self):
+        """
+        Parses the placeholders of the text prompts once. Returns ([(message, [(prompt, segments)])], placeholders), where segments are
+        False for prompts shared as is, None for text rendered with str.format() and a list of (literal, placeholder) otherwise.
+        The result is cached until the template messages or prompts change.
+        """
+        key = tuple((message, tuple((prompt, prompt._version) for prompt in message.unified_prompts)) for message in self.messages)
+        if self._compiled is not None and self._compiled[0] == key:
+            return self._compiled[1]
+        placeholders = set()
+        compiledMessages = []
+        for message in self.messages:
+            compiledPrompts = []
+            for prompt in message.unified_prompts:
+                if prompt.content_type != "text":
+                    compiledPrompts.append((prompt, False))
+                    continue
+                parsed = list(string.Formatter().parse(prompt.content))
+                names = [field for _, field, _, _ in parsed if field is not None]
+                if not names and "{" not in prompt.content and "}" not in prompt.content:
+                    compiledPrompts.append((prompt, False)) #No placeholders and no escaped braces, shared as is
+                    continue
+                placeholders.update(re.split(r"[.\[]", field, 1)[0] for field in names)
+                if all(field is None or (field.isidentifier() and not spec and not conversion) for _, field, spec, conversion in parsed):
+                    compiledPrompts.append((prompt, [(literal, field) for literal, field, _, _ in parsed]))
+                else:
+                    compiledPrompts.append((prompt, None)) #Attributes, indexes or format specs, left to str.format()
+            compiledMessages.append((message, compiledPrompts))
+        placeholders.discard("")
+        if len(placeholders) == 0:
+            raise TypeError ("dialogTemplate is not a proper DialogTemplate as there is no prompt with content_type text containing any placeholders like {placeholder_name}")
+        self._compiled = (key, (compiledMessages, placeholders))
+        return self._compiled[1]
+
+    def _render_prompt(self, prompt, segments, valueDictionary):
+        try:
+            if segments is None:
+                content = prompt.content.format(**valueDictionary)
+            else:
+                content = "".join(literal + format(valueDictionary[field]) if field is not None else literal for literal, field in segments)
+        except KeyError as e:
+            raise ValueError(f"Missing replacement for placeholder: {e}")
+        return UnifiedPrompt(content_type="text", content=content, mime_type=prompt.mime_type)
+
     @classmethod
     def Create(self, textPrompt = None, imagePrompt = None, audioPrompt = None, audioMimeType = None, 
                documentPrompt = None, documentMimeType = None, url = None, urlMimeType = None):
@@ -950,7 +2079,7 @@ class DialogTemplate():
             if isinstance(imagePrompt, list):
                 for img in imagePrompt:
                     if isinstance(img, Image.Image):
-                        unifiedPrompts.append(UnifiedPrompt(content_type="image", content=img, mime_type=f"image/{imagePrompt.format.lower()}"))
+                        unifiedPrompts.append(UnifiedPrompt(content_type="image", content=img, mime_type=f"image/{(img.format or 'png').lower()}"))
                     else:
                         raise TypeError ("imagePrompt must be either a Pillow Image or a list of Pillow Images")
         if audioPrompt and audioMimeType:
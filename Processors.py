@@ -75,7 +75,7 @@ class TextLineSplitter:
                             lines = prompt.content.splitlines()
                             for line in lines:
                                 unified_prompt = UnifiedPrompt(content_type="text", content=line, mime_type="text/plain")
-                                message = Message(unified_prompts=[unified_prompt], role = msg.role, sender_info=msg.sender_info, send_datetime=msg.send_datetime, diagnosticData=msg.diagnosticData, agentConfig=msg.agentConfig, billingData=msg.billingData, routingStrategy=msg.routingStrategy)
+                                message = Message(unified_prompts=[unified_prompt], role = msg.role, sender_info=msg.sender_info, send_datetime=msg.send_datetime, diagnosticData=msg.diagnosticData, agentConfig=msg.agentConfig, billingData=msg.billingData, routingStrategy=msg.routingStrategy, validate=False)
                                 result.append(Dialog(messages=[message]))
                 i += 1
             return result
@@ -123,7 +123,7 @@ class TextListSplitter:
                                     line_content = line[content_start_index:] if self.removeListMarks else line
                                     if len(line_content)>0 and len(re.sub(r"[ \t]", "", line_content)) > 0:
                                         unified_prompt = UnifiedPrompt(content_type="text", content=line_content, mime_type="text/plain")
-                                        message = Message(unified_prompts=[unified_prompt], role=msg.role, sender_info=msg.sender_info, send_datetime=msg.send_datetime, diagnosticData=msg.diagnosticData, agentConfig=msg.agentConfig, billingData=msg.billingData, routingStrategy=msg.routingStrategy)
+                                        message = Message(unified_prompts=[unified_prompt], role=msg.role, sender_info=msg.sender_info, send_datetime=msg.send_datetime, diagnosticData=msg.diagnosticData, agentConfig=msg.agentConfig, billingData=msg.billingData, routingStrategy=msg.routingStrategy, validate=False)
                                         result.append(Dialog(messages=[message]))
                 i += 1
             return result
@@ -168,7 +168,7 @@ class TextRegExpSplitter:
                                 line_content = line[content_start_index:] if self.removePattern else line
                                 if line_content.strip():  # Ensure the line has content besides whitespace
                                     unified_prompt = UnifiedPrompt(content_type="text", content=line_content, mime_type="text/plain")
-                                    new_message = Message(unified_prompts=[unified_prompt], role=msg.role, sender_info=msg.sender_info, send_datetime=msg.send_datetime, diagnosticData=msg.diagnosticData, agentConfig=msg.agentConfig, billingData=msg.billingData, routingStrategy=msg.routingStrategy)
+                                    new_message = Message(unified_prompts=[unified_prompt], role=msg.role, sender_info=msg.sender_info, send_datetime=msg.send_datetime, diagnosticData=msg.diagnosticData, agentConfig=msg.agentConfig, billingData=msg.billingData, routingStrategy=msg.routingStrategy, validate=False)
                                     result.append(Dialog(messages=[new_message]))
         return result
 
@@ -229,7 +229,7 @@ class DocxLoader:
             image_part = run.part.related_parts[image_rid]
             image_bytes = io.BytesIO(image_part.blob)
             image = Image.open(image_bytes)
-            return UnifiedPrompt("image", image, "image/jpeg")
+            return UnifiedPrompt("image", image, Image.MIME.get(image.format, "image/jpeg"), original_bytes=image_part.blob)
         return None
 
     def convert(self, docx_file):
@@ -443,7 +443,7 @@ class XlsxSplitter:
                             for line in lines:
                                 if len(line)>0 and len(re.sub(r"[ \t]", "", line)) > 0:
                                     unified_prompt = UnifiedPrompt(content_type="text", content=line, mime_type="text/plain")
-                                    message = Message(unified_prompts=[unified_prompt], role = msg.role, sender_info=msg.sender_info, send_datetime=msg.send_datetime, diagnosticData=msg.diagnosticData, agentConfig=msg.agentConfig, billingData=msg.billingData, routingStrategy=msg.routingStrategy)
+                                    message = Message(unified_prompts=[unified_prompt], role = msg.role, sender_info=msg.sender_info, send_datetime=msg.send_datetime, diagnosticData=msg.diagnosticData, agentConfig=msg.agentConfig, billingData=msg.billingData, routingStrategy=msg.routingStrategy, validate=False)
                                     result.append(Dialog(messages=[message]))
                 i += 1
             return result
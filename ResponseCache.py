@@ -0,0 +1,173 @@
+############## Mycelium Version 0.18.21 of 2024.04.17 ##############
+# Opt-in memoization of agent replies. An Agent with a responseCache answers a request from the cache when the same dialog content
+# was already sent to the same service with the same configuration, so repeated translations, OCR of the same document
+# or evals at temperature 0 don't go to the broker again. Only use it for services whose answers are deterministic enough.
+# The key ignores dialog ids, senders, dates and billing, it only depends on what the service gets to process.
+
+from collections import OrderedDict
+from Mycelium import Dialog
+import queue
+import sqlite3
+import threading
+import time
+
+class ResponseCache:
+    """
+    In-memory LRU of the replies with a time to live, optionally backed by an SQLite file which outlives the process.
+    One cache may be shared by any number of agents, the service name is a part of the key. The memory tier is updated at once,
+    the disk writes go to a writer thread which commits them in batches, so a put() never waits for the disk.
+    :param maxEntries: Replies kept in memory, the least recently used ones are dropped first.
+    :param ttl: Seconds a reply stays valid, None to keep it until evicted.
+    :param diskPath: SQLite file of the on-disk tier, None to keep the replies in memory only.
+    """
+    def __init__(self, maxEntries = 10000, ttl = 24 * 3600, diskPath = None):
+        self.maxEntries = maxEntries
+        self.ttl = ttl
+        self.diskPath = diskPath
+        self._entries = OrderedDict() #key -> (expires, reply messages, requestAgentConfig)
+        self._lock = threading.Lock() #The memory tier and the counters
+        self._diskLock = threading.Lock() #The SQLite connection, used by the callers for reads and by the writer thread
+        self._disk = None
+        self._writes = None #Operations for the writer thread: ("put", key, expires, messages, requestAgentConfig), ("delete", key), ("clear",) or None to stop
+        self._writer = None
+        if diskPath is not None:
+            self._disk = sqlite3.connect(diskPath, check_same_thread=False)
+            # WAL with synchronous=NORMAL doesn't sync the file on every commit, a crash may lose only the last replies
+            self._disk.execute("PRAGMA journal_mode=WAL")
+            self._disk.execute("PRAGMA synchronous=NORMAL")
+            self._disk.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, expires REAL, body BLOB)")
+            self._disk.commit()
+            self._writes = queue.Queue()
+            self._writer = threading.Thread(target=self._write_disk, name="ResponseCache writer", daemon=True)
+            self._writer.start()
+        self.hits = 0
+        self.diskHits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def key_for(dialog, service, config = None):
+        """The key of the reply of the service to the dialog, see Dialog.content_hash()."""
+        return dialog.content_hash(service, config)
+
+    def get(self, key):
+        """Returns (reply messages, requestAgentConfig) or None. The messages and their prompts are copies, changing them doesn't change the cache."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is not None and entry[0] <= now:
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return [message.copy(copyPrompts=True) for message in entry[1]], entry[2]
+        entry = self._disk_get(key, now)
+        if entry is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+            self.diskHits += 1
+            self._remember(key, entry)
+        return [message.copy(copyPrompts=True) for message in entry[1]], entry[2]
+
+    def put(self, key, messages, requestAgentConfig = None):
+        """Stores copies of the messages of a reply and of their prompts, so the caller may go on changing its dialog."""
+        entry = (time.time() + self.ttl if self.ttl is not None else None, [message.copy(copyPrompts=True) for message in messages], requestAgentConfig)
+        with self._lock:
+            self.stores += 1
+            self._remember(key, entry)
+        if self._writes is not None:
+            # The writer encodes its own copies, get() may be copying the entry meanwhile. The prompts of the entry are not decoded, copying them is cheap.
+            self._writes.put(("put", key, entry[0], [message.copy(copyPrompts=True) for message in entry[1]], requestAgentConfig))
+
+    def flush(self):
+        """Waits until the replies put so far are committed to the disk."""
+        if self._writes is not None:
+            self._writes.join()
+
+    def _write_disk(self):
+        while True:
+            operations = [self._writes.get()]
+            # Everything queued meanwhile goes in the same transaction, one commit for the whole batch
+            while operations[-1] is not None and len(operations) < 1000:
+                try:
+                    operations.append(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                rows = {}
+                with self._diskLock:
+                    for operation in operations:
+                        if operation is None:
+                            break
+                        if operation[0] == "put":
+                            body = Dialog(messages=operation[3], requestAgentConfig=operation[4]).serialize_and_compress()
+                            self._disk.execute("INSERT OR REPLACE INTO responses (key, expires, body) VALUES (?, ?, ?)", (operation[1], operation[2], body))
+                        elif operation[0] == "delete":
+                            self._disk.execute("DELETE FROM responses WHERE key = ?", (operation[1],))
+                        else:
+                            self._disk.execute("DELETE FROM responses")
+                    self._disk.commit()
+            except Exception as ex:
+                print(f"ResponseCache failed to write {len(operations)} operations to {self.diskPath}. Error: {ex}")
+                with self._diskLock:
+                    self._disk.rollback() #The next batch must not commit a half of this one
+            finally:
+                for operation in operations:
+                    self._writes.task_done()
+            if operations[-1] is None:
+                return
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxEntries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _disk_get(self, key, now):
+        if self._disk is None:
+            return None
+        with self._diskLock:
+            row = self._disk.execute("SELECT expires, body FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is not None and row[0] is not None and row[0] <= now:
+            self._writes.put(("delete", key))
+            with self._lock:
+                self.expirations += 1
+            row = None
+        if row is None:
+            return None
+        reply = Dialog()
+        reply.decompress_and_deserialize(row[1])
+        return (row[0], reply.messages, reply.requestAgentConfig)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self._writes is not None:
+            self._writes.put(("clear",)) #After the puts queued before, so none of them comes back
+            self.flush()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self._entries), 'hits': self.hits, 'diskHits': self.diskHits, 'misses': self.misses,
+                    'hitRatio': self.hits / lookups if lookups else 0.0, 'stores': self.stores, 'evictions': self.evictions, 'expirations': self.expirations}
+
+    def close(self):
+        """Commits the queued writes and closes the file."""
+        if self._writer is not None:
+            self._writes.put(None)
+            self._writer.join()
+            self._writer = None
+            self._writes = None
+        if self._disk is not None:
+            with self._diskLock:
+                self._disk.close()
+                self._disk = None
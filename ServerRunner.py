@@ -0,0 +1,244 @@
+############## Mycelium Version 0.18.21 of 2024.04.17 ##############
+# Runs an agent in several processes, so CPU-bound work (PIL, zlib, JSON, document conversion) uses all the cores of a node.
+# Every worker process has its own connection and consumer on the same input queue, the broker spreads the dialogs between them.
+# The runner restarts the workers which crash, stops them gracefully on SIGTERM or Ctrl+C and sums up their statistics.
+#
+#   myceliumRouter = Mycelium(..., input_chanel=agentRMQQueueName, message_received_callback=server_logic)
+#   if __name__ == "__main__":
+#       ServerRunner(myceliumRouter, workers=16).run()
+#
+# Dialogs live in Mycelium.dialogs of the worker which received them, so only stateless agents (every request carries the whole
+# dialog, like echo and groot) scale this way as is. The workers need a real broker, an InMemoryBroker is not shared between processes.
+
+import asyncio
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import sys
+import time
+
+WORKER_STAT_KEYS = ('dialogs', 'errors', 'busySeconds')
+
+class ServerRunner:
+    """
+    Supervisor of the worker processes. The agent code is unchanged: every worker calls the same message_received_callback(dialog)
+    of its own copy of the Mycelium.
+    :param mycelium: A Mycelium configured for start_server() and never connected, the workers get its copies by fork.
+                     Or a function returning one, called in every worker; required where fork is not available (Windows, macOS spawn).
+    :param workers: Number of worker processes, the number of cores by default.
+    :param restartDelay: Seconds before restarting a crashed worker. Doubled for every crash within crashWindow seconds after the start,
+                         up to maxRestartDelay, so a worker failing at startup (e.g. the broker is down) doesn't spin.
+    :param shutdownTimeout: Seconds the workers get to finish the callbacks in progress before they are killed.
+    :param statsInterval: Seconds between the statistics reports of the workers.
+    :param logInterval: Seconds between the printed summaries of stats(), None to print nothing.
+    """
+    def __init__(self, mycelium, workers = None, allowNewDialogs = True, concurrentDispatch = False, restartDelay = 1, maxRestartDelay = 60,
+                 crashWindow = 10, shutdownTimeout = 30, statsInterval = 5, logInterval = 60):
+        self.mycelium = mycelium
+        self.workers = workers if workers is not None else os.cpu_count() or 1
+        self.allowNewDialogs = allowNewDialogs
+        self.concurrentDispatch = concurrentDispatch
+        self.restartDelay = restartDelay
+        self.maxRestartDelay = maxRestartDelay
+        self.crashWindow = crashWindow
+        self.shutdownTimeout = shutdownTimeout
+        self.statsInterval = statsInterval
+        self.logInterval = logInterval
+        # Fork keeps the module-level Mycelium and callbacks of the agent script as they are, spawn needs a factory function
+        startMethod = "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+        if startMethod == "spawn" and not callable(self.mycelium):
+            raise ValueError("fork is not available on this platform, pass a function returning the Mycelium instead of the Mycelium")
+        self._context = multiprocessing.get_context(startMethod)
+        self._statsQueue = None
+        self._processes = {} #slot -> Process
+        self._started = {} #slot -> start time of its process
+        self._delays = {} #slot -> current restart delay
+        self._restartAt = {} #slot -> time to restart the crashed worker
+        self._workerStats = {} #slot -> the latest report of the running process
+        self._finishedStats = {} #slot -> totals of its previous processes, so the totals never go back after a restart
+        self.restarts = 0
+        self._stopping = False
+
+    def run(self):
+        """Starts the workers and supervises them until SIGTERM or SIGINT, then stops them. Blocks, call it from the main thread."""
+        self._statsQueue = self._context.Queue()
+        previousHandlers = {signum: signal.signal(signum, self._request_stop) for signum in (signal.SIGTERM, signal.SIGINT)}
+        try:
+            for slot in range(self.workers):
+                self._delays[slot] = self.restartDelay
+                self._start_worker(slot)
+            lastLog = time.monotonic()
+            while not self._stopping:
+                self._supervise(timeout=0.5)
+                if self.logInterval is not None and time.monotonic() - lastLog >= self.logInterval:
+                    lastLog = time.monotonic()
+                    self._print_stats()
+        finally:
+            self._stop_workers()
+            for signum, handler in previousHandlers.items():
+                signal.signal(signum, handler)
+            self._drain_stats()
+            if self.logInterval is not None:
+                self._print_stats()
+
+    def stop(self):
+        """Makes run() stop the workers and return, e.g. from another thread."""
+        self._stopping = True
+
+    def stats(self):
+        """Totals of all the workers since run() was called, and the latest report of every worker."""
+        self._drain_stats()
+        totals = {key: 0 for key in WORKER_STAT_KEYS}
+        perWorker = []
+        for slot in range(self.workers):
+            current = self._workerStats.get(slot, {})
+            finished = self._finishedStats.get(slot, {})
+            for key in WORKER_STAT_KEYS:
+                totals[key] += current.get(key, 0) + finished.get(key, 0)
+            process = self._processes.get(slot)
+            perWorker.append({'slot': slot, 'pid': process.pid if process is not None else None, 'alive': process is not None and process.is_alive(),
+                              **{key: current.get(key, 0) for key in WORKER_STAT_KEYS}, 'inFlight': current.get('inFlight', 0)})
+        return {'workers': self.workers, 'alive': sum(1 for worker in perWorker if worker['alive']), 'restarts': self.restarts, **totals, 'perWorker': perWorker}
+
+    def _request_stop(self, signum, frame):
+        self._stopping = True
+
+    def _start_worker(self, slot):
+        process = self._context.Process(target=_run_worker, args=(slot, self.mycelium, self._statsQueue, self.allowNewDialogs, self.concurrentDispatch,
+                                                                  self.statsInterval, self.shutdownTimeout), name=f"mycelium-worker-{slot}", daemon=True)
+        process.start()
+        self._processes[slot] = process
+        self._started[slot] = time.monotonic()
+        self._restartAt.pop(slot, None)
+
+    def _supervise(self, timeout):
+        sentinels = [process.sentinel for process in self._processes.values() if process is not None]
+        if sentinels:
+            multiprocessing.connection.wait(sentinels, timeout=timeout)
+        else:
+            time.sleep(timeout) #All the workers are waiting for their restart
+        self._drain_stats()
+        now = time.monotonic()
+        for slot, process in list(self._processes.items()):
+            if process is not None and not process.is_alive():
+                process.join()
+                self._retire_stats(slot)
+                delay = self._delays[slot] if now - self._started[slot] < self.crashWindow else self.restartDelay
+                self._delays[slot] = min(delay * 2, self.maxRestartDelay) #For the next crash
+                print(f"Worker {slot} (pid {process.pid}) exited with code {process.exitcode}, restarting in {delay} s")
+                self._processes[slot] = None
+                self._restartAt[slot] = now + delay
+        for slot, restartAt in list(self._restartAt.items()):
+            if restartAt <= now and not self._stopping:
+                self.restarts += 1
+                self._start_worker(slot)
+
+    def _stop_workers(self):
+        self._stopping = True
+        alive = [process for process in self._processes.values() if process is not None and process.is_alive()]
+        for process in alive:
+            os.kill(process.pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.shutdownTimeout
+        for process in alive:
+            # The stats queue is drained meanwhile, a worker blocked on a full queue pipe would never exit
+            while process.is_alive() and time.monotonic() < deadline:
+                self._drain_stats()
+                process.join(timeout=0.1)
+            if process.is_alive():
+                print(f"Worker {process.name} (pid {process.pid}) did not stop in {self.shutdownTimeout} s, killing it")
+                process.kill()
+                process.join()
+        for slot, process in self._processes.items():
+            if process is not None:
+                self._retire_stats(slot)
+        self._processes = {slot: None for slot in self._processes}
+
+    def _drain_stats(self):
+        while self._statsQueue is not None:
+            try:
+                slot, pid, report = self._statsQueue.get_nowait()
+            except Exception:
+                return
+            process = self._processes.get(slot)
+            if process is not None and process.pid == pid: #Late reports of a retired process are already counted
+                self._workerStats[slot] = report
+
+    def _retire_stats(self, slot):
+        self._drain_stats()
+        report = self._workerStats.pop(slot, {})
+        finished = self._finishedStats.setdefault(slot, {key: 0 for key in WORKER_STAT_KEYS})
+        for key in WORKER_STAT_KEYS:
+            finished[key] += report.get(key, 0)
+
+    def _print_stats(self):
+        stats = self.stats()
+        print(f"Workers: {stats['alive']}/{stats['workers']} alive, {stats['restarts']} restarts, {stats['dialogs']} dialogs, "
+              f"{stats['errors']} errors, {stats['busySeconds']:.1f} s in callbacks")
+
+class _WorkerStats:
+    """Wraps message_received_callback of a worker, counting the dialogs, the exceptions and the time spent in the callback."""
+    def __init__(self, callback):
+        self.callback = callback
+        self.dialogs = 0
+        self.errors = 0
+        self.busySeconds = 0.0
+        self.inFlight = 0
+
+    async def __call__(self, dialog):
+        self.inFlight += 1
+        started = time.perf_counter()
+        try:
+            return await self.callback(dialog)
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self.busySeconds += time.perf_counter() - started
+            self.dialogs += 1
+            self.inFlight -= 1
+
+    def report(self):
+        return {'dialogs': self.dialogs, 'errors': self.errors, 'busySeconds': self.busySeconds, 'inFlight': self.inFlight}
+
+def _run_worker(slot, mycelium, statsQueue, allowNewDialogs, concurrentDispatch, statsInterval, shutdownTimeout):
+    signal.signal(signal.SIGINT, signal.SIG_IGN) #Ctrl+C reaches the whole process group, the supervisor decides when to stop
+    signal.signal(signal.SIGTERM, signal.SIG_DFL) #Not the handler of the supervisor, nothing is received before serve() starts
+    if not hasattr(mycelium, 'start_server'):
+        mycelium = mycelium()
+    stats = _WorkerStats(mycelium.message_received_callback) if mycelium.message_received_callback else None
+    if stats is not None:
+        mycelium.message_received_callback = stats
+    report = lambda: statsQueue.put((slot, os.getpid(), stats.report() if stats is not None else {}))
+
+    async def serve():
+        loop = asyncio.get_running_loop()
+        stopRequested = asyncio.Event()
+        loop.add_signal_handler(signal.SIGTERM, stopRequested.set)
+        server = asyncio.ensure_future(mycelium.start_server(allowNewDialogs=allowNewDialogs, concurrentDispatch=concurrentDispatch))
+        stopping = asyncio.ensure_future(stopRequested.wait())
+        while not server.done() and not stopRequested.is_set():
+            await asyncio.wait([server, stopping], timeout=statsInterval, return_when=asyncio.FIRST_COMPLETED)
+            report()
+        if server.done():
+            return False #start_server() returns by itself only when it failed, e.g. it could not connect
+        # The dialogs in progress are finished, the messages not received yet (prefetched included) stay for the other consumers
+        mycelium.stop_server()
+        deadline = loop.time() + shutdownTimeout
+        while not server.done() and mycelium.is_processing and loop.time() < deadline:
+            await asyncio.wait([server], timeout=0.05)
+        if not server.done():
+            server.cancel() #Idle, waiting for the next message
+        await asyncio.wait([server])
+        try:
+            await mycelium.close()
+        except Exception as ex:
+            print(f"Worker {slot} failed to close its connection. Error: {ex}")
+        return True
+
+    stopped = asyncio.run(serve())
+    report()
+    statsQueue.close()
+    statsQueue.join_thread()
+    sys.stdout.flush()
+    os._exit(0 if stopped else 1)
@@ -0,0 +1,444 @@
+############## Mycelium Version 0.18.21 of 2024.04.17 ##############
+# Transports create the connections of a Mycelium. AmqpTransport connects to RabbitMQ as before. InMemoryTransport connects
+# to an InMemoryBroker living in the same process: agents and clients exchange messages without a network, which gives
+# reproducible throughput tests and lets co-located pipelines skip the broker round-trip.
+# The in-memory connections implement the part of the aio_pika (async) and pika (blocking) interfaces used by Mycelium and Agent,
+# so the code paths are the same for both transports.
+
+import aio_pika
+import asyncio
+from collections import OrderedDict, deque
+import json
+import pika
+import threading
+import time
+import uuid
+
+DIRECT_REPLY_TO_QUEUE = "amq.rabbitmq.reply-to"
+DIRECT_REPLIES_KEPT = 100000 #correlation_id -> private reply queue of the requests sent with direct reply-to
+
+class AmqpTransport:
+    """The default transport, RabbitMQ through aio_pika for the async code and pika for the blocking Agent calls."""
+    async def connect_async(self, mycelium):
+        return await aio_pika.connect_robust(
+            host=mycelium.rabbitmq_host,
+            login=mycelium.rabbitmq_username,
+            password=mycelium.rabbitmq_password,
+            virtualhost=mycelium.rabbitmq_vhost
+        )
+
+    def connect_blocking(self, mycelium):
+        return pika.BlockingConnection(
+            pika.ConnectionParameters(
+                host=mycelium.rabbitmq_host,
+                virtual_host=mycelium.rabbitmq_vhost,  # Include the virtual host here
+                credentials=pika.PlainCredentials(
+                    mycelium.rabbitmq_username, mycelium.rabbitmq_password
+                )
+            )
+        )
+
+class InMemoryTransport:
+    """
+    Connects Mycelium objects to an InMemoryBroker. All the peers which must talk to each other use the same broker.
+    Blocking Agent calls (Invoke) wait for the reply, so they must run in a different thread than the event loop of the agent they call.
+    """
+    def __init__(self, broker = None):
+        self.broker = broker if broker is not None else InMemoryBroker()
+
+    async def connect_async(self, mycelium):
+        return InMemoryConnection(self.broker, mycelium.output_chanel)
+
+    def connect_blocking(self, mycelium):
+        return InMemoryBlockingConnection(self.broker, mycelium.output_chanel)
+
+class InMemoryMessage:
+    """A delivered message. Serves both as an aio_pika incoming message and as pika method and properties of a blocking delivery."""
+    __slots__ = ('body', 'headers', 'correlation_id', 'reply_to', 'delivery_tag', 'routing_key', 'queue')
+
+    def __init__(self, body, headers = None, correlation_id = None, reply_to = None, routing_key = None):
+        self.body = bytes(body)
+        self.headers = dict(headers) if headers else {} #A copy, as a real broker never shares the headers of the sender
+        self.correlation_id = correlation_id
+        self.reply_to = reply_to
+        self.routing_key = routing_key
+        self.delivery_tag = None
+        self.queue = None #The _MemoryQueue it was put to, for nack()
+
+    @classmethod
+    def of(cls, message, routing_key, reply_to = None):
+        """Copies an aio_pika.Message (or any object with body, headers, correlation_id and reply_to)."""
+        return cls(message.body, message.headers, message.correlation_id, reply_to if reply_to is not None else message.reply_to, routing_key)
+
+    async def ack(self):
+        pass #The broker forgets a message once it's delivered
+
+    async def nack(self, requeue = True):
+        if requeue and self.queue is not None:
+            with self.queue.broker.lock:
+                self.queue.put(self, first=True)
+
+class _MemoryQueue:
+    """FIFO of one queue. All the methods but get() are called with the broker lock held."""
+    def __init__(self, broker, name):
+        self.broker = broker
+        self.name = name
+        self.messages = deque()
+        self.waiters = deque() #(loop, future) of the async consumers waiting for a message
+
+    def put(self, message, first = False):
+        """:param first: Put it at the head of the queue, for a message given back by its consumer."""
+        message.queue = self
+        while self.waiters:
+            loop, future = self.waiters.popleft()
+            if future.done():
+                continue #The consumer was cancelled
+            try:
+                loop.call_soon_threadsafe(self._hand_over, future, message)
+                return
+            except RuntimeError:
+                continue #The loop of the consumer is closed
+        if first:
+            self.messages.appendleft(message)
+        else:
+            self.messages.append(message)
+        self.broker.condition.notify_all()
+
+    def _hand_over(self, future, message):
+        if future.done():
+            # Cancelled after the message was given to it, the message goes to the next consumer
+            with self.broker.lock:
+                self.put(message)
+        else:
+            future.set_result(message)
+
+    def get_nowait(self):
+        return self.messages.popleft() if self.messages else None
+
+    async def get(self):
+        with self.broker.lock:
+            if self.messages:
+                return self.messages.popleft()
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self.waiters.append((loop, future))
+        return await future
+
+class InMemoryBroker:
+    """
+    Queues of one process, thread-safe, so blocking and async peers in different threads share it.
+    Messages published to the Mycelium router queue are routed the way the router does: by the routingStrategy header.
+    A "direct" strategy goes to the queue named by its params, other strategies only go where the routes say.
+    The router billing is not emulated, billingData headers are passed as they are.
+    :param routes: {service or routing params : queue name}, e.g. {"text-to-text.en.global" : "groot"}. Direct strategies
+                   without a route go to the queue with the name of the service.
+    """
+    def __init__(self, routes = None):
+        self.routes = dict(routes) if routes else {}
+        self.queues = {}
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock) #Notified on every message, blocking consumers wait on it
+        self.published = 0
+        self.unroutable = 0
+        # The dialog may carry the reply-to pseudo-queue name instead of the private one, replies to it are matched by correlation_id
+        self.directReplies = OrderedDict()
+
+    def _queue(self, name):
+        queue = self.queues.get(name)
+        if queue is None:
+            queue = self.queues[name] = _MemoryQueue(self, name)
+        return queue
+
+    def declare_queue(self, name = None):
+        """Returns the queue, creating it when needed. An empty name creates a queue with a unique name."""
+        with self.lock:
+            return self._queue(name if name else "amq.gen-" + uuid.uuid4().hex)
+
+    def delete_queue(self, name):
+        with self.lock:
+            self.queues.pop(name, None)
+
+    def purge_queue(self, name):
+        with self.lock:
+            queue = self.queues.get(name)
+            if queue is None:
+                return 0
+            count = len(queue.messages)
+            queue.messages.clear()
+            return count
+
+    def message_count(self, name):
+        with self.lock:
+            queue = self.queues.get(name)
+            return len(queue.messages) if queue is not None else 0
+
+    def publish(self, routing_key, message):
+        # Like a durable queue declared in advance, a message sent before its consumer started waits for it
+        with self.lock:
+            self.published += 1
+            if routing_key == DIRECT_REPLY_TO_QUEUE:
+                routing_key = self.directReplies.get(message.correlation_id, routing_key)
+            self._queue(routing_key).put(message)
+
+    def _remember_direct_reply(self, correlation_id, queueName):
+        with self.lock:
+            self.directReplies[correlation_id] = queueName
+            self.directReplies.move_to_end(correlation_id)
+            while len(self.directReplies) > DIRECT_REPLIES_KEPT:
+                self.directReplies.popitem(last=False)
+
+    def route(self, message):
+        """Delivers a message sent to the router queue, returns the name of the destination queue or None when it's unroutable."""
+        try:
+            routingStrategy = json.loads(message.headers.get('routingStrategy'))
+            strategy, params = routingStrategy['strategy'], routingStrategy['params']
+        except (TypeError, ValueError, KeyError):
+            routingStrategy, strategy, params = None, None, None
+        destination = self.routes.get(params, params if strategy == "direct" else None) if params is not None else None
+        if destination is None:
+            with self.lock:
+                self.unroutable += 1
+            print(f"In-memory broker can't route message {message.correlation_id} with routing strategy {routingStrategy}")
+            return None
+        self.publish(destination, message)
+        return destination
+
+    def _deliver(self, routerQueue, routing_key, message):
+        if routing_key == routerQueue:
+            self.route(message)
+        else:
+            self.publish(routing_key, message)
+
+class _InMemoryExchange:
+    def __init__(self, chanel):
+        self.chanel = chanel
+
+    async def publish(self, message, routing_key):
+        connection = self.chanel.connection
+        connection.check_open()
+        reply_to = connection.reply_to_of(message.reply_to, message.correlation_id)
+        connection.broker._deliver(connection.routerQueue, routing_key, InMemoryMessage.of(message, routing_key, reply_to))
+
+class _InMemoryQueueIterator:
+    def __init__(self, queue):
+        self.queue = queue
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.queue.get()
+
+class _InMemoryAsyncQueue:
+    """The part of aio_pika.Queue used by Mycelium."""
+    def __init__(self, connection, queue):
+        self.connection = connection
+        self.queue = queue
+        self.name = queue.name
+
+    def iterator(self):
+        return _InMemoryQueueIterator(self.queue)
+
+    async def consume(self, callback, no_ack = False):
+        async def consume_forever():
+            while True:
+                message = await self.queue.get()
+                try:
+                    await callback(message)
+                except Exception as ex:
+                    print(f"In-memory consumer of {self.name} failed: {ex}")
+        self.connection.tasks.append(asyncio.ensure_future(consume_forever()))
+        return self.name
+
+class _InMemoryChanel:
+    def __init__(self, connection):
+        self.connection = connection
+        self.default_exchange = _InMemoryExchange(self)
+
+    async def set_qos(self, prefetch_count = 0):
+        pass
+
+    async def declare_queue(self, name = None, exclusive = False, auto_delete = False, **kwargs):
+        queue = self.connection.broker.declare_queue(name)
+        if exclusive or auto_delete:
+            self.connection.privateQueues.add(queue.name)
+        return _InMemoryAsyncQueue(self.connection, queue)
+
+    async def get_queue(self, name, ensure = True):
+        if name == DIRECT_REPLY_TO_QUEUE:
+            return _InMemoryAsyncQueue(self.connection, self.connection.direct_reply_queue())
+        return _InMemoryAsyncQueue(self.connection, self.connection.broker.declare_queue(name))
+
+class _ConnectionBase:
+    def __init__(self, broker, routerQueue):
+        self.broker = broker
+        self.routerQueue = routerQueue #Messages published to it are routed by the broker
+        self.privateQueues = set() #Exclusive queues, deleted with the connection
+        self.directReplyQueue = None
+        self.is_closed = False
+
+    @property
+    def is_open(self):
+        return not self.is_closed
+
+    def check_open(self):
+        if self.is_closed:
+            raise aio_pika.exceptions.AMQPConnectionError("The in-memory connection is closed")
+
+    def direct_reply_queue(self):
+        # The pseudo-queue of RabbitMQ direct reply-to, replies to it come to a private queue of this connection
+        if self.directReplyQueue is None:
+            self.directReplyQueue = self.broker.declare_queue(DIRECT_REPLY_TO_QUEUE + "." + uuid.uuid4().hex)
+            self.privateQueues.add(self.directReplyQueue.name)
+        return self.directReplyQueue
+
+    def reply_to_of(self, reply_to, correlation_id):
+        if reply_to == DIRECT_REPLY_TO_QUEUE and self.directReplyQueue is not None:
+            self.broker._remember_direct_reply(correlation_id, self.directReplyQueue.name)
+            return self.directReplyQueue.name
+        return reply_to
+
+    def _delete_private_queues(self):
+        self.is_closed = True
+        for name in self.privateQueues:
+            self.broker.delete_queue(name)
+        self.privateQueues.clear()
+
+class InMemoryConnection(_ConnectionBase):
+    """The part of aio_pika.RobustConnection used by Mycelium."""
+    def __init__(self, broker, routerQueue):
+        super().__init__(broker, routerQueue)
+        self.tasks = [] #Consumers started by queue.consume()
+
+    async def channel(self):
+        self.check_open()
+        return _InMemoryChanel(self)
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks.clear()
+        self._delete_private_queues()
+
+class _DeclareOk:
+    """Mimics the pika Queue.DeclareOk frame, the queue name is in result.method.queue."""
+    def __init__(self, queue):
+        self.method = self
+        self.queue = queue
+
+class _InMemoryBlockingChanel:
+    """The part of pika BlockingChannel used by Agent."""
+    def __init__(self, connection):
+        self.connection = connection
+        self.consumers = {} #consumer_tag -> (queue, callback)
+        self._consuming = False
+
+    def queue_declare(self, queue = '', exclusive = False, auto_delete = False, **kwargs):
+        declared = self.connection.broker.declare_queue(queue)
+        if exclusive or auto_delete:
+            self.connection.privateQueues.add(declared.name)
+        return _DeclareOk(declared.name)
+
+    def queue_purge(self, queue):
+        return self.connection.broker.purge_queue(queue)
+
+    def basic_publish(self, exchange, routing_key, body, properties = None):
+        self.connection.check_open()
+        message = InMemoryMessage(body, properties.headers if properties else None, properties.correlation_id if properties else None,
+                                  self.connection.reply_to_of(properties.reply_to, properties.correlation_id) if properties else None, routing_key)
+        self.connection.broker._deliver(self.connection.routerQueue, routing_key, message)
+
+    def basic_consume(self, queue, on_message_callback, auto_ack = False, **kwargs):
+        self.connection.check_open()
+        declared = self.connection.direct_reply_queue() if queue == DIRECT_REPLY_TO_QUEUE else self.connection.broker.declare_queue(queue)
+        consumer_tag = "ctag-" + uuid.uuid4().hex
+        self.consumers[consumer_tag] = (declared, on_message_callback)
+        return consumer_tag
+
+    def basic_cancel(self, consumer_tag):
+        self.consumers.pop(consumer_tag, None)
+
+    def basic_ack(self, delivery_tag = None, multiple = False):
+        pass
+
+    def start_consuming(self):
+        self._consuming = True
+        while self._consuming and self.consumers:
+            self.connection.process_data_events(time_limit=None)
+
+    def stop_consuming(self, consumer_tag = None):
+        # As in pika, all the consumers of the channel are cancelled
+        self._consuming = False
+        self.consumers.clear()
+
+    def _dispatch(self):
+        """Delivers the waiting messages to the consumers, returns the number of delivered ones."""
+        delivered = 0
+        for consumer_tag, (queue, callback) in list(self.consumers.items()):
+            if consumer_tag not in self.consumers:
+                continue #Cancelled by a callback
+            with self.connection.broker.lock:
+                message = queue.get_nowait()
+            if message is None:
+                continue
+            self.connection.deliveryCount += 1
+            message.delivery_tag = self.connection.deliveryCount
+            callback(self, message, message, message.body)
+            delivered += 1
+        return delivered
+
+class InMemoryBlockingConnection(_ConnectionBase):
+    """The part of pika BlockingConnection used by Agent."""
+    def __init__(self, broker, routerQueue):
+        super().__init__(broker, routerQueue)
+        self.chanels = []
+        self.timers = {} #timer id -> (deadline, callback)
+        self.deliveryCount = 0
+
+    def channel(self):
+        self.check_open()
+        chanel = _InMemoryBlockingChanel(self)
+        self.chanels.append(chanel)
+        return chanel
+
+    def call_later(self, delay, callback):
+        timer = uuid.uuid4().hex
+        self.timers[timer] = (time.monotonic() + delay, callback)
+        return timer
+
+    def remove_timeout(self, timer):
+        self.timers.pop(timer, None)
+
+    def _fire_timers(self):
+        fired = 0
+        now = time.monotonic()
+        for timer, (deadline, callback) in list(self.timers.items()):
+            if deadline <= now and self.timers.pop(timer, None) is not None:
+                callback()
+                fired += 1
+        return fired
+
+    def process_data_events(self, time_limit = 0):
+        """Delivers the waiting messages or waits for them up to time_limit seconds (until the next timer when None)."""
+        deadline = None if time_limit is None else time.monotonic() + time_limit
+        while True:
+            if self._fire_timers() or sum(chanel._dispatch() for chanel in self.chanels):
+                return
+            wakeUp = min([timerDeadline for timerDeadline, callback in self.timers.values()] + ([deadline] if deadline is not None else []), default=None)
+            timeout = None if wakeUp is None else wakeUp - time.monotonic()
+            if timeout is not None and timeout <= 0:
+                if deadline is not None and deadline <= time.monotonic():
+                    return
+                continue
+            with self.broker.condition:
+                if not any(queue.messages for chanel in self.chanels for queue, callback in chanel.consumers.values()):
+                    self.broker.condition.wait(timeout)
+
+    def close(self):
+        self._delete_private_queues()
@@ -0,0 +1,214 @@
+############## Mycelium Version 0.18.21 of 2024.04.17 ##############
+# End-to-end load generator. N simulated clients send dialogs with Agent.InvokeAsync to an agent served by Mycelium.start_server
+# and wait for its replies. Reports throughput, p50/p95/p99 latency, the depth of the agent input queue (broker queue lag)
+# and the distribution of the request sizes. Use it to size serverAsyncModeThreads and the number of agent replicas.
+#
+#   python benchmarks/loadgen.py --clients 50 --duration 30 --shape text --shape image
+#       An echo agent (the logic of echo/src/agent.py) in this process, on the in-memory broker
+#   python benchmarks/loadgen.py --agent-delay 0.2 --server-threads 20 --concurrent-dispatch
+#       The same with 200 ms of backend work per request, served by 20 concurrent callbacks
+#   python benchmarks/loadgen.py --broker rabbitmq --host HOST --vhost VHOST --token TOKEN --service echo --agent-queue echo
+#       A running agent behind a real Mycelium router
+
+import argparse
+import asyncio
+from datetime import datetime
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Mycelium import Agent, Dialog, Message, Mycelium, UnifiedPrompt
+from Transports import InMemoryBroker, InMemoryTransport
+from run import Payloads
+
+DIALOG_VARIANTS = 16 #Different dialogs per shape, sizes differ within a shape
+
+def text_dialogs(payloads, rng):
+    dialogs = []
+    for variant in range(DIALOG_VARIANTS):
+        lines = rng.sample(payloads.transcript, rng.randint(1, 10))
+        dialogs.append(Dialog(messages=[Message(role="user", unified_prompts=[UnifiedPrompt("text", "\n".join(lines), "text/plain")])]))
+    return dialogs
+
+def image_dialogs(payloads, rng):
+    dialogs = []
+    for variant in range(DIALOG_VARIANTS):
+        prompts = [UnifiedPrompt("text", "Describe these images.", "text/plain")]
+        for number in range(rng.randint(1, 3)):
+            index = rng.randrange(len(payloads.pngs))
+            prompts.append(UnifiedPrompt("image", payloads.images[index], "image/png", original_bytes=payloads.pngs[index]))
+        dialogs.append(Dialog(messages=[Message(role="user", unified_prompts=prompts)]))
+    return dialogs
+
+def long_history_dialogs(payloads, rng):
+    dialogs = []
+    for variant in range(DIALOG_VARIANTS):
+        messages = [Message(role="user" if number % 2 == 0 else "assistant", unified_prompts=[UnifiedPrompt("text", rng.choice(payloads.transcript), "text/plain")])
+                    for number in range(rng.randint(50, 200) | 1)] #Odd, so the last message is the user's one
+        dialogs.append(Dialog(messages=messages))
+    return dialogs
+
+SHAPES = {'text': text_dialogs, 'image': image_dialogs, 'long_history': long_history_dialogs}
+
+def percentile(sortedValues, percent):
+    if not sortedValues:
+        return None
+    return sortedValues[min(len(sortedValues) - 1, int(round(percent / 100 * (len(sortedValues) - 1))))]
+
+def distribution(values):
+    values = sorted(values)
+    return {'count': len(values), 'mean': sum(values) / len(values) if values else None, 'min': values[0] if values else None,
+            'p50': percentile(values, 50), 'p95': percentile(values, 95), 'p99': percentile(values, 99), 'max': values[-1] if values else None}
+
+def start_echo_agent(broker, queueName, args):
+    """Runs the echo agent in its own thread and event loop, as if it was another process. Returns its Mycelium."""
+    async def server_logic(dialog):
+        if args.agent_delay:
+            await asyncio.sleep(args.agent_delay) #The backend work
+        echo.dialogs[dialog.dialog_id].messages[-1].role = "assistant"
+        echo.dialogs[dialog.dialog_id].messages[-1].sender_info = "echo"
+        echo.dialogs[dialog.dialog_id].messages[-1].send_datetime = datetime.now()
+        await echo.send_to_mycelium(dialog.dialog_id, isReply=True, newestMessagesToSend=1, autogenerateRoutingStrategies=True)
+        return False
+
+    echo = Mycelium(input_chanel=queueName, message_received_callback=server_logic, serverAsyncModeThreads=args.server_threads,
+                    transport=InMemoryTransport(broker))
+    thread = threading.Thread(target=lambda: asyncio.run(echo.start_server(allowNewDialogs=True, concurrentDispatch=args.concurrent_dispatch)), daemon=True)
+    thread.start()
+    return echo
+
+class QueueLagSampler:
+    """Samples the number of messages waiting in the agent input queue."""
+    def __init__(self, args, broker):
+        self.args = args
+        self.broker = broker
+        self.samples = []
+        self.chanel = None
+
+    def depth(self):
+        if self.broker is not None:
+            return self.broker.message_count(self.args.agent_queue)
+        if self.chanel is None:
+            import pika
+            credentials = pika.PlainCredentials(self.args.username or self.args.token, self.args.password or self.args.token)
+            connection = pika.BlockingConnection(pika.ConnectionParameters(host=self.args.host, virtual_host=self.args.vhost, credentials=credentials))
+            self.chanel = connection.channel()
+        return self.chanel.queue_declare(queue=self.args.agent_queue, passive=True).method.message_count
+
+    async def run(self, deadline):
+        loop = asyncio.get_running_loop()
+        while time.monotonic() < deadline:
+            try:
+                self.samples.append(await loop.run_in_executor(None, self.depth))
+            except Exception as ex:
+                print(f"Failed to sample the depth of {self.args.agent_queue}: {ex}", file=sys.stderr)
+                return
+            await asyncio.sleep(self.args.sample_interval)
+
+async def run_client(agent, dialogs, rng, deadline, stats):
+    while time.monotonic() < deadline:
+        dialog, size = rng.choice(dialogs)
+        started = time.perf_counter()
+        try:
+            reply = await agent.InvokeAsync(dialog)
+        except Exception as ex:
+            stats['errors'] += 1
+            print(f"Request failed: {ex}", file=sys.stderr)
+            continue
+        latency = time.perf_counter() - started
+        stats['requestBytes'].append(size)
+        if len(reply.messages) > len(dialog.messages):
+            stats['latencies'].append(latency)
+        else:
+            stats['timeouts'] += 1
+
+async def generate_load(args):
+    rng = random.Random(args.seed)
+    broker = InMemoryBroker() if args.broker == "memory" else None
+    echo = start_echo_agent(broker, args.agent_queue, args) if broker is not None else None
+
+    def client_mycelium():
+        if broker is not None:
+            return Mycelium(input_chanel="loadgen-" + uuid.uuid4().hex, replyMode=args.reply_mode, codec=args.codec, transport=InMemoryTransport(broker))
+        return Mycelium(host=args.host, vhost=args.vhost, username=args.username, password=args.password, ComradeAIToken=args.token,
+                        replyMode=args.reply_mode, codec=args.codec)
+
+    payloads = Payloads()
+    myceliums = [client_mycelium() for client in range(args.clients)]
+    # Sizes are measured once per dialog, encoding every request twice would halve the load the clients generate
+    dialogs = [(dialog, len(dialog.serialize_and_compress(codec=myceliums[0].codec))) for shape in args.shape for dialog in SHAPES[shape](payloads, rng)]
+    agents = [Agent(mycelium, args.service, timeoutOfSyncRequest=args.timeout) for mycelium in myceliums]
+    stats = {'latencies': [], 'requestBytes': [], 'timeouts': 0, 'errors': 0}
+    if args.warmup:
+        await asyncio.gather(*[run_client(agent, dialogs, random.Random(rng.random()), time.monotonic() + args.warmup, {'latencies': [], 'requestBytes': [], 'timeouts': 0, 'errors': 0})
+                               for agent in agents])
+    sampler = QueueLagSampler(args, broker)
+    started = time.monotonic()
+    deadline = started + args.duration
+    await asyncio.gather(sampler.run(deadline), *[run_client(agent, dialogs, random.Random(rng.random()), deadline, stats) for agent in agents])
+    elapsed = time.monotonic() - started #Includes the replies to the requests sent before the deadline
+    for mycelium in myceliums:
+        await mycelium.close()
+    completed = len(stats['latencies'])
+    return {
+        'created': datetime.now().isoformat(), 'broker': args.broker, 'service': args.service, 'clients': args.clients, 'shapes': args.shape,
+        'codec': myceliums[0].codec, 'replyMode': args.reply_mode, 'serverAsyncModeThreads': args.server_threads if echo else None,
+        'concurrentDispatch': args.concurrent_dispatch if echo else None, 'agentDelay': args.agent_delay if echo else None,
+        'seconds': elapsed, 'completed': completed, 'timeouts': stats['timeouts'], 'errors': stats['errors'],
+        'throughput_per_sec': completed / elapsed if elapsed else None,
+        'latency_seconds': distribution(stats['latencies']), 'request_bytes': distribution(stats['requestBytes']),
+        'queue_depth': distribution(sampler.samples),
+    }
+
+def print_report(report):
+    latency, size, depth = report['latency_seconds'], report['request_bytes'], report['queue_depth']
+    milliseconds = lambda value: f"{value * 1000:.1f}" if value is not None else "-"
+    print(f"{report['completed']} replies in {report['seconds']:.1f} s from {report['clients']} clients ({report['broker']} broker, shapes {', '.join(report['shapes'])})")
+    print(f"throughput      {report['throughput_per_sec']:.1f} replies/sec, {report['timeouts']} timeouts, {report['errors']} errors")
+    print(f"latency ms      p50 {milliseconds(latency['p50'])}  p95 {milliseconds(latency['p95'])}  p99 {milliseconds(latency['p99'])}  max {milliseconds(latency['max'])}")
+    print(f"queue depth     mean {depth['mean']:.1f}  p95 {depth['p95']}  max {depth['max']}  ({depth['count']} samples)" if depth['count'] else "queue depth     not sampled")
+    print(f"request bytes   min {size['min']}  p50 {size['p50']}  p95 {size['p95']}  max {size['max']}")
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="Drives simulated clients against a Mycelium agent and reports throughput and latency.")
+    parser.add_argument("--clients", type=int, default=10, help="Number of simulated clients, each awaits its reply before sending the next request.")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds to generate the load.")
+    parser.add_argument("--warmup", type=float, default=1, help="Seconds of load before the measurement.")
+    parser.add_argument("--shape", action="append", choices=sorted(SHAPES), help="Dialog shape, may be repeated to mix them. text by default.")
+    parser.add_argument("--codec", default=None, help="Wire codec of the requests, json+zlib by default.")
+    parser.add_argument("--reply-mode", default="exclusive", choices=["shared", "exclusive", "direct"])
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds to wait for every reply.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--sample-interval", type=float, default=0.2, help="Seconds between the samples of the agent queue depth.")
+    parser.add_argument("--broker", default="memory", choices=["memory", "rabbitmq"])
+    parser.add_argument("--service", default="echo", help="Service name the requests are routed to.")
+    parser.add_argument("--agent-queue", default=None, help="Input queue of the agent, the service name when not set.")
+    parser.add_argument("--server-threads", type=int, default=10, help="In-memory echo agent only. serverAsyncModeThreads of the agent.")
+    parser.add_argument("--concurrent-dispatch", action="store_true", help="In-memory echo agent only. start_server(concurrentDispatch=True).")
+    parser.add_argument("--agent-delay", type=float, default=0, help="In-memory echo agent only. Seconds of simulated work per request.")
+    parser.add_argument("--host")
+    parser.add_argument("--vhost")
+    parser.add_argument("--username")
+    parser.add_argument("--password")
+    parser.add_argument("--token", help="ComradeAI token, used instead of the username and the password.")
+    parser.add_argument("-o", "--output", help="Save the report to this JSON file.")
+    args = parser.parse_args(argv)
+    args.shape = args.shape or ["text"]
+    args.agent_queue = args.agent_queue or args.service
+    if args.broker == "rabbitmq" and not args.host:
+        parser.error("--host is required for --broker rabbitmq")
+
+    report = asyncio.run(generate_load(args))
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+if __name__ == "__main__":
+    main()
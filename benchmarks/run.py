@@ -0,0 +1,236 @@
+############## Mycelium Version 0.18.21 of 2024.04.17 ##############
+# Microbenchmarks of the hot paths: the Dialog codec, the document loaders and the splitters.
+# Payloads are built from docs/examples. For every operation it reports ops/sec, the size of the result in bytes
+# and the peak memory allocated by one run. Results can be saved as JSON and compared with the results of another version.
+#
+#   python benchmarks/run.py                                   # all the benchmarks
+#   python benchmarks/run.py -k compress -k xlsx --min-time 2  # only the names containing "compress" or "xlsx"
+#   python benchmarks/run.py -o new.json --compare old.json    # save the results and print the speedup against old.json
+#   git worktree add /tmp/baseline <revision>
+#   python benchmarks/run.py --repo /tmp/baseline -o old.json  # measure another version of the modules with these benchmarks
+#
+# Older versions lack some features (codecs, original image bytes, lazy decoding, the serialization cache). The benchmarks still
+# run there, and the results whose meaning differs between versions carry a note, so such speedups aren't taken at face value.
+
+import argparse
+from datetime import datetime
+import gc
+import inspect
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+BENCHMARKS_REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The modules are imported before main() parses the arguments, so --repo is looked up first
+_repoParser = argparse.ArgumentParser(add_help=False)
+_repoParser.add_argument("--repo", default=BENCHMARKS_REPO_DIR)
+REPO_DIR = os.path.abspath(_repoParser.parse_known_args()[0].repo)
+sys.path.insert(0, REPO_DIR)
+
+from Mycelium import Dialog, Message, UnifiedPrompt
+from Processors import DocxLoader, MessageSplitter, TextLineSplitter, TextListSplitter, TextRegExpSplitter, XlsxLoader, XlsxSplitter
+from PIL import Image
+try:
+    from Codecs import CODECS, LEGACY_CODEC
+except ImportError: #Versions before the pluggable codecs only have the zlib-compressed JSON
+    CODECS, LEGACY_CODEC = None, "json+zlib"
+
+EXAMPLES_DIR = os.path.join(BENCHMARKS_REPO_DIR, "docs", "examples")
+LONG_HISTORY_MESSAGES = 200
+HAS_ORIGINAL_BYTES = 'original_bytes' in inspect.signature(UnifiedPrompt.__init__).parameters
+
+class Benchmark:
+    """
+    One measured operation. setup() is called before every run and is not measured, its result is passed to run().
+    :param size: Returns the size in bytes of the result of run(), None when the size makes no sense.
+    """
+    def __init__(self, name, run, setup = None, size = None, note = None):
+        self.name = name
+        self.run = run
+        self.setup = setup if setup is not None else (lambda: None)
+        self.size = size
+        self.note = note #What the result means in this version, when it differs between versions
+
+    def measure(self, minTime, minRuns = 3):
+        # Timing and memory are measured in separate runs, tracemalloc slows the allocations down a lot
+        argument = self.setup()
+        result = self.run(argument)
+        size = self.size(result) if self.size is not None else None
+        del result
+        elapsed, runs = 0.0, 0
+        while elapsed < minTime or runs < minRuns:
+            argument = self.setup()
+            started = time.perf_counter()
+            self.run(argument)
+            elapsed += time.perf_counter() - started
+            runs += 1
+        argument = self.setup()
+        gc.collect()
+        tracemalloc.start()
+        try:
+            self.run(argument)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        return {'name': self.name, 'ops_per_sec': runs / elapsed, 'mean_seconds': elapsed / runs, 'runs': runs, 'bytes': size, 'peak_memory_bytes': peak,
+                'note': self.note}
+
+def read_example(filename):
+    with open(os.path.join(EXAMPLES_DIR, filename), 'rb') as file:
+        return file.read()
+
+class Payloads:
+    """Raw example files, read once. Dialogs are built from them anew for every run, so no run reuses what a previous one cached."""
+    def __init__(self):
+        self.text = read_example("ISS_01_sttext.txt").decode()
+        self.transcript = [f"{segment['Speaker']}: {segment['Speech'].strip()}" for segment in json.loads(read_example("ISS_01_stscript.txt"))]
+        self.pngs = [read_example(name) for name in ("demo_image_1.png", "demo_image_2.png")]
+        self.images = [Image.open(io.BytesIO(png)) for png in self.pngs]
+        for image in self.images:
+            image.load()
+        self.mp3s = [read_example(f"ISS_0{number}.mp3") for number in range(1, 5)]
+        self.docxPath = os.path.join(EXAMPLES_DIR, "contract.docx")
+        self.xlsxPath = os.path.join(EXAMPLES_DIR, "who_stat_2023_annex1.xlsx")
+        self.xlsxText = XlsxLoader(xlsxFile=self.xlsxPath).convert(self.xlsxPath)[0].content
+
+    def text_dialog(self):
+        return Dialog(messages=[Message(role="user", unified_prompts=[UnifiedPrompt("text", self.text, "text/plain")])])
+
+    def image_dialog(self):
+        prompts = [UnifiedPrompt("text", "Describe these images.", "text/plain")]
+        if HAS_ORIGINAL_BYTES:
+            prompts += [UnifiedPrompt("image", image, "image/png", original_bytes=png) for image, png in zip(self.images, self.pngs)]
+        else:
+            prompts += [UnifiedPrompt("image", image, "image/png") for image in self.images]
+        return Dialog(messages=[Message(role="user", unified_prompts=prompts)])
+
+    def audio_dialog(self):
+        prompts = [UnifiedPrompt("audio", mp3, "audio/mpeg") for mp3 in self.mp3s]
+        return Dialog(messages=[Message(role="user", unified_prompts=prompts)])
+
+    def long_history_dialog(self):
+        messages = [Message(role="user" if number % 2 == 0 else "assistant", unified_prompts=[UnifiedPrompt("text", self.transcript[number % len(self.transcript)], "text/plain")])
+                    for number in range(LONG_HISTORY_MESSAGES)]
+        return Dialog(messages=messages)
+
+    def lines_dialog(self):
+        return Dialog(messages=[Message(role="assistant", unified_prompts=[UnifiedPrompt("text", "\n".join(self.transcript), "text/plain")])])
+
+    def list_dialog(self):
+        listText = "\n".join(f"{number + 1}. {line}" for number, line in enumerate(self.transcript))
+        return Dialog(messages=[Message(role="assistant", unified_prompts=[UnifiedPrompt("text", listText, "text/plain")])])
+
+    def xlsx_dialog(self):
+        return Dialog(messages=[Message(role="user", unified_prompts=[UnifiedPrompt("text", self.xlsxText, "text/plain")])])
+
+def compress(dialog, codecName):
+    return dialog.serialize_and_compress(codec=codecName) if CODECS is not None else dialog.serialize_and_compress()
+
+def decompress(data, codecName):
+    dialog = Dialog()
+    if CODECS is not None:
+        dialog.decompress_and_deserialize(data, codec=codecName)
+    else:
+        dialog.decompress_and_deserialize(data)
+    return dialog
+
+def feature_notes(payloads):
+    """Notes for the shapes whose results mean something else in this version: {(operation, shape): note}."""
+    notes = {}
+    received = Dialog()
+    received.deserialize(payloads.image_dialog().serialize())
+    lazy = getattr(received.messages[0].unified_prompts[1], '_loaded', True) is False
+    for shape in ("image", "audio"):
+        notes[("decode", shape)] = ("lazy decoding: the media is decoded on the first access of the content, not in this run" if lazy
+                                    else "the media is decoded in this run")
+    notes[("encode", "image")] = ("the original PNG files are sent as they are" if HAS_ORIGINAL_BYTES else "the images are encoded to PNG in this run")
+    if not hasattr(Message(role="user", unified_prompts=[UnifiedPrompt("text", "-", "text/plain")]), '_serializedPrompts'):
+        notes[("cached", None)] = "no serialization cache in this version, the same work as serialize"
+    return notes
+
+def build_benchmarks(payloads):
+    benchmarks = []
+    notes = feature_notes(payloads)
+    dialogs = [("text", payloads.text_dialog), ("image", payloads.image_dialog), ("audio", payloads.audio_dialog), ("long_history", payloads.long_history_dialog)]
+    for shape, makeDialog in dialogs:
+        encodeNote, decodeNote = notes.get(("encode", shape)), notes.get(("decode", shape))
+        serialized = makeDialog().serialize()
+        benchmarks.append(Benchmark(f"serialize[{shape}]", lambda dialog: dialog.serialize(), makeDialog, len, encodeNote))
+        # The per-message cache makes sending the same dialog again cheap, e.g. when an agent forwards it
+        cached = makeDialog()
+        cached.serialize()
+        benchmarks.append(Benchmark(f"serialize_cached[{shape}]", lambda dialog: dialog.serialize(), lambda cached=cached: cached, len, notes.get(("cached", None))))
+        benchmarks.append(Benchmark(f"deserialize[{shape}]", lambda data: Dialog().deserialize(data), lambda serialized=serialized: serialized, note=decodeNote))
+        for codecName in (CODECS if CODECS is not None else [LEGACY_CODEC]):
+            compressed = compress(makeDialog(), codecName)
+            benchmarks.append(Benchmark(f"serialize_and_compress[{shape},{codecName}]",
+                                        lambda dialog, codecName=codecName: compress(dialog, codecName), makeDialog, len, encodeNote))
+            benchmarks.append(Benchmark(f"decompress_and_deserialize[{shape},{codecName}]", lambda data, codecName=codecName: decompress(data, codecName),
+                                        lambda compressed=compressed: compressed, note=decodeNote))
+    promptsSize = lambda prompts: sum(len(prompt.content) for prompt in prompts if prompt.content_type == "text")
+    benchmarks.append(Benchmark("DocxLoader.convert[contract.docx]", lambda path: DocxLoader(path).convert(path), lambda: payloads.docxPath, promptsSize))
+    benchmarks.append(Benchmark("XlsxLoader.convert[who_stat_2023_annex1.xlsx]", lambda path: XlsxLoader(xlsxFile=path).convert(path), lambda: payloads.xlsxPath, promptsSize))
+    splitters = [("MessageSplitter", MessageSplitter(), payloads.long_history_dialog), ("TextLineSplitter", TextLineSplitter(), payloads.lines_dialog),
+                 ("TextListSplitter", TextListSplitter(), payloads.list_dialog), ("TextRegExpSplitter", TextRegExpSplitter(r"SPEAKER_\d+:\s*"), payloads.lines_dialog),
+                 ("XlsxSplitter", XlsxSplitter(), payloads.xlsx_dialog)]
+    for name, splitter, makeDialog in splitters:
+        benchmarks.append(Benchmark(name, lambda dialog, splitter=splitter: dialog >> splitter, makeDialog, None))
+    return benchmarks
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except Exception:
+        return None
+
+def print_results(results, baseline = None):
+    baseline = {result['name']: result for result in baseline['results']} if baseline else {}
+    print(f"{'benchmark':<60} {'ops/sec':>12} {'mean ms':>10} {'bytes':>12} {'peak KiB':>10}" + (f" {'speedup':>8}" if baseline else ""))
+    for result in results:
+        line = f"{result['name']:<60} {result['ops_per_sec']:>12.1f} {result['mean_seconds'] * 1000:>10.3f} {result['bytes'] if result['bytes'] is not None else '-':>12} {result['peak_memory_bytes'] / 1024:>10.1f}"
+        if baseline:
+            previous = baseline.get(result['name'])
+            changed = previous is not None and previous.get('note') != result['note'] #A different measure, e.g. decoding became lazy
+            line += f" {result['ops_per_sec'] / previous['ops_per_sec']:>7.2f}{'*' if changed else 'x'}" if previous else f" {'new':>8}"
+        print(line)
+    noted = [result for result in results if result['note'] or (baseline.get(result['name']) or {}).get('note')]
+    if noted:
+        print("\nNotes" + (" (* marks the speedups of benchmarks which measure different work in the two versions)" if baseline else "") + ":")
+    for result in noted:
+        print(f"  {result['name']}: {result['note'] or '-'}")
+        previous = baseline.get(result['name'])
+        if previous is not None and previous.get('note') != result['note']:
+            print(f"  {'':<{len(result['name'])}}  compared with: {previous.get('note') or '-'}")
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the Dialog codec, the document loaders and the splitters.")
+    parser.add_argument("-k", "--filter", action="append", default=[], help="Run only the benchmarks whose names contain this substring, may be repeated.")
+    parser.add_argument("--min-time", type=float, default=0.5, help="Seconds to spend measuring every benchmark.")
+    parser.add_argument("-o", "--output", help="Save the results to this JSON file.")
+    parser.add_argument("--compare", help="JSON file with the results of another version to compare with.")
+    parser.add_argument("--repo", default=BENCHMARKS_REPO_DIR, help="Directory of the Mycelium version to measure, e.g. a git worktree of an older revision.")
+    args = parser.parse_args(argv)
+
+    benchmarks = [benchmark for benchmark in build_benchmarks(Payloads()) if not args.filter or any(pattern in benchmark.name for pattern in args.filter)]
+    results = []
+    for benchmark in benchmarks:
+        results.append(benchmark.measure(args.min_time))
+        print(f"{benchmark.name}: {results[-1]['ops_per_sec']:.1f} ops/sec", file=sys.stderr)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+    print_results(results, baseline)
+    if args.output:
+        report = {'created': datetime.now().isoformat(), 'revision': git_revision(), 'python': sys.version.split()[0], 'platform': platform.platform(),
+                  'codecs': list(CODECS) if CODECS is not None else [LEGACY_CODEC], 'results': results}
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,7 @@
 #------------------------------------------------------------------------------------------------------------#
 
 from ComradeAI.DocumentRoutines import DocxToPromptsConverter, XlsxToPromptsConverter
-from ComradeAI.Mycelium import Mycelium, Message, Dialog, UnifiedPrompt, RoutingStrategy
+from ComradeAI.Mycelium import Mycelium, Message, Dialog, UnifiedPrompt, RoutingStrategy, BoundedDialogStore
 from dotenv import load_dotenv
 import io
 from io import BytesIO
@@ -22,6 +22,9 @@ import uuid
 load_dotenv()
 discord_token = os.getenv('DISCORD_TOKEN')
 comradeai_token = os.getenv('COMRADEAI_TOKEN')
+max_dialogs = int(os.getenv('MAX_DIALOGS', '100000'))
+max_dialogs_bytes = int(os.getenv('MAX_DIALOGS_BYTES', str(2 * 1024 ** 3)))
+dialog_idle_ttl = int(os.getenv('DIALOG_IDLE_TTL', str(24 * 3600)))
 
 # Initialize the bot
 intents = nextcord.Intents.default()
@@ -62,7 +65,8 @@ async def message_received_handler(dialog):
     return True
 
 dialog_configurations = {}
-myceliumRouter = Mycelium(ComradeAIToken=comradeai_token, message_received_callback=message_received_handler, dialogs={})
+myceliumRouter = Mycelium(ComradeAIToken=comradeai_token, message_received_callback=message_received_handler, 
+                         dialogs=BoundedDialogStore(maxDialogs=max_dialogs, maxBytes=max_dialogs_bytes, idleTTL=dialog_idle_ttl))
 
 def remove_mentions(text):
     pattern = r"<@\d+>"
@@ -80,7 +84,7 @@ def create_unified_prompt_from_url(url):
     if mime_type.startswith('text/') or mime_type in ['application/xml', 'text/xml']:
         return [UnifiedPrompt(content_type="text", content=content.decode('utf-8'), mime_type=mime_type)]
     elif mime_type.startswith('image/'):
-        return [UnifiedPrompt(content_type="image", content=Image.open(io.BytesIO(content)), mime_type=mime_type)]
+        return [UnifiedPrompt(content_type="image", content=Image.open(io.BytesIO(content)), mime_type=mime_type, original_bytes=content)]
     elif mime_type.startswith('application/vnd.openxmlformats-officedocument.wordprocessingml.document'):
         converter = DocxToPromptsConverter(convert_urls=True)
         prompts = converter.convert(io.BytesIO(content))
@@ -115,7 +119,8 @@ async def on_message(message):
     if not dialog_id in dialog_ids:
         dialog = Dialog(messages=[], dialog_id=dialog_id, reply_to=comradeai_token)
         myceliumRouter.dialogs[dialog_id]=dialog
-        dialog_configurations[dialog_id] = {"agent": "groot", "requestAgentConfig": ""}
+        if dialog_id not in dialog_configurations: #The dialog could be evicted from the store, the selected agent stays
+            dialog_configurations[dialog_id] = {"agent": "groot", "requestAgentConfig": ""}
     if bot.user.mentioned_in(message) and bot.user != message.author:
         attachments = [attachment.url for attachment in message.attachments]
         prompts = [
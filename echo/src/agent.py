@@ -1,5 +1,7 @@
 from ComradeAI.Mycelium import Mycelium, Message, Dialog, UnifiedPrompt, RoutingStrategy
+from ComradeAI.ServerRunner import ServerRunner
 #from Mycelium import Mycelium, Message, Dialog, UnifiedPrompt, RoutingStrategy
+#from ServerRunner import ServerRunner
 from datetime import datetime
 from dotenv import load_dotenv
 import os
@@ -12,6 +14,7 @@ agentRMQPass = os.getenv('RABBITMQ_DEFAULT_AGENT_PASS')
 agentRMQHost = os.getenv('RABBITMQ_HOST')
 agentRMQvHost = os.getenv('RABBITMQ_VHOST')
 agentRMQQueueName = os.getenv('RABBITMQ_QUEUE')
+agentWorkers = int(os.getenv('AGENT_WORKERS', '1')) #Worker processes, 0 for one per core
 
 async def server_logic(dialog):
     try:
@@ -23,7 +26,7 @@ async def server_logic(dialog):
         #If we enable error message for testing, newestMessagesToSend must be set to 2
     except Exception as ex:
         print("Failed to send message. Error: " + str(ex))
-    return False #When False we clean the dialogs dict in Mycelium, when True we recalculate all the total values for the current dialog.
+    return False #When False we drop this dialog from Mycelium.dialogs, when True we recalculate all the total values for the current dialog.
 
 myceliumRouter = Mycelium(host=agentRMQHost, vhost=agentRMQvHost, username=agentRMQLogin, password=agentRMQPass, input_chanel=agentRMQQueueName, message_received_callback=server_logic, serverAsyncModeThreads=1)
 
@@ -32,4 +35,7 @@ async def main():
     await myceliumRouter.start_server(allowNewDialogs=True)
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if agentWorkers == 1:
+        asyncio.run(main())
+    else:
+        ServerRunner(myceliumRouter, workers=agentWorkers or None).run()
\ No newline at end of file
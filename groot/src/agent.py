@@ -1,9 +1,12 @@
 from ComradeAI.Mycelium import Mycelium, Message, Dialog, UnifiedPrompt, RoutingStrategy
+from ComradeAI.ServerRunner import ServerRunner
+from ComradeAI.AgentAssets import AgentAssets
 #from Mycelium import Mycelium, Message, Dialog, UnifiedPrompt, RoutingStrategy
+#from ServerRunner import ServerRunner
+#from AgentAssets import AgentAssets
 from dotenv import load_dotenv
 import os
 import asyncio
-from PIL import Image
 
 load_dotenv()
 agentRMQLogin = os.getenv('RABBITMQ_DEFAULT_AGENT')
@@ -11,21 +14,20 @@ agentRMQPass = os.getenv('RABBITMQ_DEFAULT_AGENT_PASS')
 agentRMQHost = os.getenv('RABBITMQ_HOST')
 agentRMQvHost = os.getenv('RABBITMQ_VHOST')
 agentRMQQueueName = os.getenv('RABBITMQ_QUEUE')
+agentWorkers = int(os.getenv('AGENT_WORKERS', '1')) #Worker processes, 0 for one per core
 script_dir = os.path.dirname(os.path.abspath(__file__))
 
+#Read and base64-encoded once, every reply shares the same prompts
+assets = AgentAssets(baseDir=script_dir)
+assets.load("groot.png")
+assets.load("groot.mp3", mime_type="audio/mp3")
+
 async def server_logic(dialog):
     subAccount = ""
     if len(dialog.messages)>0:
         subAccount = dialog.messages[-1].subAccount
-        
-    image = Image.open(script_dir + "/groot.png")
-    with open(script_dir + "/groot.mp3", 'rb') as mp3_file:
-        mp3 = mp3_file.read()
-        
-    prompts = [UnifiedPrompt(content_type="text", content="I am Groot!", mime_type="text/plain"),
-               UnifiedPrompt(content_type="image", content=image, mime_type="image/png"),
-               UnifiedPrompt(content_type="audio", content=mp3, mime_type="audio/mp3")]
-    message = Message(role="assistant", unified_prompts=prompts, sender_info="Groot", subAccount=subAccount, diagnosticData={"AgentDiagnosticData" : "Non-eror test"}, billingData=[{"agent" : "groot", "currency" : "USD", "cost" : 0.0}])
+
+    message = assets.message("I am Groot!", assets["groot.png"], assets["groot.mp3"], sender_info="Groot", subAccount=subAccount, diagnosticData={"AgentDiagnosticData" : "Non-eror test"}, billingData=[{"agent" : "groot", "currency" : "USD", "cost" : 0.0}])
     myceliumRouter.dialogs[dialog.dialog_id].messages.extend([message])
     #await myceliumRouter.dialogs[dialog.dialog_id].generate_error_message("I am Error!", sender_info="Groot", diagnosticData={"AgentDiagnosticData" : "Error Test"}, billingData = [])
     try:
@@ -33,7 +35,7 @@ async def server_logic(dialog):
         #If we enable error message for testing, newestMessagesToSend must be set to 2
     except Exception as ex:
         print("Failed to send message. Error: " + str(ex))
-    return False #When False we clean the dialogs dict in Mycelium, when True we recalculate all the total values for the current dialog.
+    return False #When False we drop this dialog from Mycelium.dialogs, when True we recalculate all the total values for the current dialog.
 
 myceliumRouter = Mycelium(host=agentRMQHost, vhost=agentRMQvHost, username=agentRMQLogin, password=agentRMQPass, input_chanel=agentRMQQueueName, message_received_callback=server_logic, serverAsyncModeThreads=1)
 
@@ -42,4 +44,7 @@ async def main():
     await myceliumRouter.start_server(allowNewDialogs=True)
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if agentWorkers == 1:
+        asyncio.run(main())
+    else:
+        ServerRunner(myceliumRouter, workers=agentWorkers or None).run()
\ No newline at end of file
@@ -71,7 +71,7 @@ image_mime_types = {
 }
 
 def unifiedPromptToJSON(unified_prompt: UnifiedPrompt):
-    return {"content_type": unified_prompt.content_type, "content": content_to_base64(unified_prompt.content) if unified_prompt.content_type in ['image', 'document', 'audio'] else unified_prompt.content, "mime_type": unified_prompt.mime_type}
+    return {"content_type": unified_prompt.content_type, "content": content_to_base64(unified_prompt.raw_bytes()) if unified_prompt.content_type in ['image', 'document', 'audio'] else unified_prompt.content, "mime_type": unified_prompt.mime_type}
 
 @app.post("/get_agent_response/")
 async def get_agent_response(request: MultiformatRequest):
@@ -127,7 +127,7 @@ async def get_agent_response(request: MultiformatRequest):
             image_file = BytesIO(file_content)
             image = Image.open(image_file)
             mime_type = image_mime_types.get(file_extension, "application/octet-stream")
-            added_prompts.append(UnifiedPrompt(content_type="image", content=image, mime_type=mime_type))
+            added_prompts.append(UnifiedPrompt(content_type="image", content=image, mime_type=mime_type, original_bytes=file_content))
         # elif content_type.startswith("video"):
         #     # Handle video file
         #     added_prompts.append(UnifiedPrompt(content_type="video", content=await file_obj.read(), mime_type=content_type))
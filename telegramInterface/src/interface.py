@@ -1,5 +1,5 @@
 from ComradeAI.DocumentRoutines import DocxToPromptsConverter, XlsxToPromptsConverter
-from ComradeAI.Mycelium import Mycelium, Message, Dialog, UnifiedPrompt, RoutingStrategy
+from ComradeAI.Mycelium import Mycelium, Message, Dialog, UnifiedPrompt, RoutingStrategy, BoundedDialogStore
 
 import asyncio
 from datetime import datetime
@@ -22,6 +22,9 @@ load_dotenv()
 bot = AsyncTeleBot(os.getenv('TELEGRAM_TOKEN'))
 comradeai_token = os.getenv('COMRADEAI_TOKEN')
 max_dialog_len = int(os.getenv('MAX_DIALOG_LEN'))
+max_dialogs = int(os.getenv('MAX_DIALOGS', '100000'))
+max_dialogs_bytes = int(os.getenv('MAX_DIALOGS_BYTES', str(2 * 1024 ** 3)))
+dialog_idle_ttl = int(os.getenv('DIALOG_IDLE_TTL', str(24 * 3600)))
 hello_messages = {
     "russian": os.getenv('HELLO_MESSAGE_RU'),
     "english": os.getenv('HELLO_MESSAGE_EN'),
@@ -65,6 +68,12 @@ async def init_model_for_user(command, dialog_id):
         myceliumRouter.dialogs[dialog_id].requestAgentConfig=dialog_configs[dialog_id]['requestAgentConfig']
     return True
 
+def ensure_dialog(dialog_id):
+    # Idle dialogs are evicted from the store, the agent selected by the user survives in dialog_configs.
+    if dialog_id not in myceliumRouter.dialogs:
+        myceliumRouter.dialogs[dialog_id] = Dialog(messages=[], dialog_id=dialog_id, reply_to=comradeai_token, requestAgentConfig=dialog_configs[dialog_id].get('requestAgentConfig'))
+    return myceliumRouter.dialogs[dialog_id]
+
 async def send_long_message(chat_id, text, max_length=4096):
     parts = textwrap.wrap(text, max_length)
     for part in parts:
@@ -95,7 +104,7 @@ async def start(message):
     dialog_id = str(message.chat.id)
     dialog_ids = dialog_configs.keys()
     if dialog_id in dialog_ids:
-        if len(myceliumRouter.dialogs[dialog_id].messages) > 0:
+        if len(ensure_dialog(dialog_id).messages) > 0:
             await myceliumRouter.send_to_mycelium(dialog_id, isReply=False)
             myceliumRouter.dialogs[dialog_id].messages = []
             dialog_lockers[dialog_id] = False
@@ -112,7 +121,7 @@ async def start(message):
     dialog_id = str(message.chat.id)
     dialog_ids = dialog_configs.keys()
     if dialog_id in dialog_ids:
-        if dialog_modes[dialog_id] == "ctx_amnesia":
+        if dialog_modes[dialog_id] == "ctx_amnesia" and dialog_id in myceliumRouter.dialogs:
             myceliumRouter.dialogs[dialog_id].messages = []
         dialog_lockers[dialog_id] = False
         await bot.send_message(message.chat.id, "Album compose mode calnceled.")
@@ -187,6 +196,7 @@ async def echo_message(message):
         return
     
     chat_id_str = str(message.chat.id)
+    ensure_dialog(chat_id_str)
     dialog_ids = list(myceliumRouter.dialogs.keys())
     if chat_id_str in dialog_ids:
         current_dialog_len = len(myceliumRouter.dialogs[chat_id_str].messages)
@@ -237,7 +247,7 @@ async def echo_message(message):
             downloaded_file = await bot.download_file(file_info.file_path)
             image_stream = BytesIO(downloaded_file)
             image = Image.open(image_stream)
-            unifiedPrompts.append(UnifiedPrompt(content_type='image', content=image, mime_type='image/jpg'))
+            unifiedPrompts.append(UnifiedPrompt(content_type='image', content=image, mime_type='image/jpeg', original_bytes=downloaded_file))
         except Exception as ex:
             print(str(ex))
             sys.stdout.flush()
@@ -255,7 +265,7 @@ async def echo_message(message):
                 downloaded_file = await bot.download_file(file_info.file_path)
                 image_stream = BytesIO(downloaded_file)
                 image = Image.open(image_stream)
-                unifiedPrompts.append(UnifiedPrompt(content_type='image', content=image, mime_type=message.document.mime_type))
+                unifiedPrompts.append(UnifiedPrompt(content_type='image', content=image, mime_type=message.document.mime_type, original_bytes=downloaded_file))
             except Exception as ex:
                 print(str(ex))
                 sys.stdout.flush()
@@ -351,7 +361,7 @@ async def message_received_handler(dialog):
     chat_id = str(dialog.dialog_id)
     if not chat_id in dialog_ids:
         dialog_modes[chat_id] = "ctx_amnesia"
-    if dialog_modes[chat_id] == "ctx_amnesia":
+    if dialog_modes[chat_id] == "ctx_amnesia" and chat_id in myceliumRouter.dialogs:
         myceliumRouter.dialogs[chat_id].messages = []
     return True
 
@@ -417,7 +427,8 @@ dialog_lockers = {}
 dialog_modes = {}
 
 #dialog_configurations = {}
-myceliumRouter = Mycelium(ComradeAIToken=comradeai_token, message_received_callback=message_received_handler, dialogs={})
+myceliumRouter = Mycelium(ComradeAIToken=comradeai_token, message_received_callback=message_received_handler, 
+                         dialogs=BoundedDialogStore(maxDialogs=max_dialogs, maxBytes=max_dialogs_bytes, idleTTL=dialog_idle_ttl))
 
 async def main():
     server_task = myceliumRouter.start_server(allowNewDialogs=False)